@@ -3,6 +3,7 @@ import re
 import sys
 from datetime import datetime
 from io import BytesIO
+from pathlib import Path
 from random import randint
 import traceback
 
@@ -12,19 +13,79 @@ from redbot.core import commands
 sys.path.append(os.getcwd())
 
 from ebird_lookup import ebird_lookup as ebl
-from static_maps.mapper import GBIF, MapBox, eBirdMap, generate_gbif_mapbox_range, get_token
+from static_maps.atlas import TileAtlas
+from static_maps.cache import (
+    ImageCache,
+    MetadataCache,
+    RenderCache,
+    RenderKey,
+    TileCache,
+)
+from static_maps.imager import encode_profiles
+from static_maps.mapper import GBIF, MapBox, eBirdMap, get_token
+from static_maps.render_pool import RenderPool, render_ebird_map, render_gbif_map
+
+
+def make_render_maps(image_cache_bytes=128 * 1024 * 1024):
+    """
+    Makes the maps used for rendering. Each render worker process calls this when it starts, so has its own maps and in memory caches.
+    The disk caches are shared by every process, and their budgets cover all of them together.
+    """
+    # Basemap tiles almost never change, so keep them on disk between commands and restarts.
+    tile_cache = TileCache(path="tile_cache", max_bytes=512 * 1024 * 1024, shared=True)
+    # Decoded tiles shared by every render in the process, so popular species don't need downloading or decoding again.
+    image_cache = ImageCache(max_bytes=image_cache_bytes)
+    # Low zoom basemap tiles, baked with: python -m static_maps.atlas basemap.atlas --tile-cache tile_cache
+    atlas_path = Path("basemap.atlas")
+    atlas = TileAtlas(atlas_path) if atlas_path.exists() else None
+    mapbox = MapBox(
+        token=get_token(),
+        tile_cache=tile_cache,
+        image_cache=image_cache,
+        atlas=atlas,
+    )
+    # Range overlay tiles change as new data comes in, so they're revalidated with the server once they're a few hours old.
+    overlay_cache = TileCache(
+        path="overlay_cache", max_bytes=256 * 1024 * 1024, shared=True
+    )
+    # Species, bounding box and rsid lookups, loaded at startup so warm renders go straight to fetching tiles.
+    metadata_cache = MetadataCache(path="metadata_cache.json")
+    gbif = GBIF(
+        image_cache=image_cache,
+        tile_cache=overlay_cache,
+        metadata_cache=metadata_cache,
+    )
+    ebird = eBirdMap(
+        image_cache=image_cache,
+        tile_cache=overlay_cache,
+        metadata_cache=metadata_cache,
+    )
+    return {"mapbox": mapbox, "gbif": gbif, "ebird": ebird}
 
 
 class GeoCog(commands.Cog):
     def __init__(self, bot):
-        self.mapbox = MapBox(token=get_token())
-        self.gbif = GBIF()
-        self.ebird = eBirdMap()
+        # Maps for lookups and geocoding here. Renders happen in the render pool, which has its own.
+        maps = make_render_maps()
+        self.mapbox = maps["mapbox"]
+        self.gbif = maps["gbif"]
+        self.ebird = maps["ebird"]
+        # Finished maps, so repeat requests for a species don't render again.
+        self.render_cache = RenderCache(ttl=24 * 60 * 60)
+        # Compositing and encoding are CPU bound, so they're done in worker processes to keep the event loop responsive.
+        self.render_pool = RenderPool(
+            make_render_maps, max_workers=2, render_cache=self.render_cache
+        )
         self.typesense = ebl.TypeSenseSearch(api_key="changeMe!")
         self.typesense.connect()
         self.meili = ebl.MeilisearchSearch(api_key="changeMe!")
         self.meili.connect()
         self.map_size = 512
+        # Encode profile for each command's maps, see static_maps.imager.encode_profiles. Satellite basemaps are far smaller as JPEG.
+        self.map_profiles = {"gbifmap": "jpeg", "ebirdmap": "jpeg"}
+
+    def cog_unload(self):
+        self.render_pool.shutdown(wait=False)
 
     def find_species_from_name(self, arg, backend):
         try:
@@ -52,9 +113,13 @@ class GeoCog(commands.Cog):
         print("gbifmap: ", arg)
         scientific_name, taxon_id = self.gbif.lookup_species(arg)
         if all((scientific_name, taxon_id)):
+            profile = self.map_profiles["gbifmap"]
             start = datetime.now()
-            result = generate_gbif_mapbox_range(
-                taxon_id, self.gbif, self.mapbox, self.map_size
+            key = RenderKey(
+                f"gbif+{self.mapbox.map_name}", taxon_id, self.map_size, profile
+            )
+            result = await self.render_pool.render(
+                render_gbif_map, taxon_id, self.map_size, profile, key=key
             )
             dur = datetime.now() - start
             if result is None:
@@ -69,7 +134,8 @@ class GeoCog(commands.Cog):
             embed = discord.Embed(
                 title=scientific_name, description=desc, url=gbif_url, color=0x007F00
             )
-            file = discord.File(result.asbytes(), filename=f"{taxon_id}.png")
+            ext = encode_profiles[profile].extension
+            file = discord.File(BytesIO(result), filename=f"{taxon_id}.{ext}")
             await ctx.send(file=file, embed=embed)
         else:
             embed = discord.Embed(
@@ -108,21 +174,27 @@ class GeoCog(commands.Cog):
             title = f"{common_name} (_{scientific_name}_)."
             ebird_url = f"{self.ebird.species_url}{species_code}"
             try:
+                profile = self.map_profiles["ebirdmap"]
+                ext = encode_profiles[profile].extension
                 start = datetime.now()
-                res_img, no_data = self.ebird.make_map(species_code, self.mapbox, 512)
-                img = res_img.asbytes()
+                key = RenderKey(
+                    f"ebird+{self.mapbox.map_name}", species_code, 512, profile
+                )
+                res_img, no_data = await self.render_pool.render(
+                    render_ebird_map, species_code, 512, profile, key=key
+                )
+                img = BytesIO(res_img)
                 if not no_data:
-                    res_img.save(f"geocog-ebird-{species_code}.png")
                     end = datetime.now()
                     desc = "Source: eBird, Mapbox."
                     desc += f"\nDebug: generated in: {(end - start).seconds}s. Search: {backend_name}."
                     embed = discord.Embed(title=title, url=ebird_url, description=desc, color=0x7F007F)
-                    file = discord.File(img, filename=f"{species_code}.png")
+                    file = discord.File(img, filename=f"{species_code}.{ext}")
                 else:
                     desc = "**No data on eBird**.\nSource: eBird, Mapbox."
                     desc += f"\nDebug: no data, Search: {backend_name}."
                     embed = discord.Embed(title=title, url=ebird_url, description=desc, color=0x7F0000)
-                    file = discord.File(img, filename=f"{species_code}.png")
+                    file = discord.File(img, filename=f"{species_code}.{ext}")
 
             except Exception:
                 traceback.print_exc()
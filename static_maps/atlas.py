@@ -0,0 +1,191 @@
+"""
+Baked basemap atlases: every tile of a map style's lowest zoom levels, stored as raw pixels in one file.
+Build one with: python -m static_maps.atlas basemap.atlas --max-zoom 4
+"""
+import argparse
+import json
+import mmap
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from static_maps.cache import TileCache, TileKey
+from static_maps.imager import Image, resize_square
+from static_maps.tiles import Tile, TileID
+
+# Zooms 0 to 4 cover almost every eBird and GBIF range, and are only 341 tiles.
+default_max_zoom = 4
+
+
+@dataclass
+class TileAtlas:
+    """
+    Read-only tiles for one map style, stored as raw pixels in one file that's memory mapped.
+    Nothing is decoded when a tile is read, and every process with the same atlas open shares it through the page cache.
+    The index is stored next to the atlas, as path with a .json suffix.
+    """
+
+    path: Path
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    # Which tiles these are: a TileKey without z, x and y.
+    provider: str = field(default=None, init=False)
+    style: str = field(default=None, init=False)
+    fmt: str = field(default=None, init=False)
+    resolution: int = field(default=None, init=False)
+    mode: str = field(default="RGB", init=False)
+    max_zoom: int = field(default=None, init=False)
+    _offsets: Dict[str, int] = field(default_factory=dict, init=False, repr=False)
+    _mmap: Optional[mmap.mmap] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.path = Path(self.path)
+        index = json.loads(atlas_index_path(self.path).read_text())
+        self.provider = index["provider"]
+        self.style = index["style"]
+        self.fmt = index["fmt"]
+        self.resolution = index["resolution"]
+        self.mode = index["mode"]
+        self.max_zoom = index["max_zoom"]
+        self._offsets = index["tiles"]
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def tile_bytes(self) -> int:
+        """Bytes of raw pixels per tile."""
+        return self.resolution * self.resolution * len(self.mode)
+
+    def _offset(self, key: TileKey) -> Optional[int]:
+        if (key.provider, key.style, key.fmt) != (self.provider, self.style, self.fmt):
+            return None
+        if key.resolution is not None and key.resolution > self.resolution:
+            return None
+        return self._offsets.get(f"{key.z}/{key.x}/{key.y}")
+
+    def get(self, key: TileKey, resolution: Optional[int] = None) -> Optional["Image"]:
+        """
+        Returns a tile's image, or None if the atlas doesn't have it.
+        Args:
+            key (TileKey): The tile. Its provider, style and fmt have to match the atlas, and its resolution be no larger.
+            resolution (int, optional): Size the tile is needed at, if smaller than the atlas's. Defaults to None, the key's resolution.
+        """
+        offset = self._offset(key)
+        if offset is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        size = (self.resolution, self.resolution)
+        data = memoryview(self._mmap)[offset : offset + self.tile_bytes]
+        img = Image.frombuffer(self.mode, size, data, "raw", self.mode, 0, 1)
+        resolution = resolution or key.resolution
+        if resolution is not None and resolution < self.resolution:
+            img = resize_square(img, resolution, quality=1)
+        return img
+
+    def __contains__(self, key: TileKey) -> bool:
+        return self._offset(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "tiles": len(self)}
+
+
+def atlas_index_path(path: Path) -> Path:
+    return Path(path).with_suffix(".json")
+
+
+def build_atlas(
+    path: Path,
+    key: TileKey,
+    get_tiles: Callable[[List[TileID]], Dict[TileID, Tile]],
+    max_zoom: int = default_max_zoom,
+    mode: str = "RGB",
+) -> TileAtlas:
+    """
+    Fetches every tile from zoom 0 to max_zoom and writes them to an atlas. Tiles that can't be fetched are left out.
+    Args:
+        path (Path): Atlas file to write. Replaced only once the new atlas is complete.
+        key (TileKey): Which tiles these are. z, x and y are ignored. Tiles are scaled to its resolution.
+        get_tiles (Callable[[List[TileID]], Dict[TileID, Tile]]): Fetches tiles, like MapBox.get_tiles().
+        max_zoom (int, optional): Highest zoom level in the atlas. Defaults to default_max_zoom.
+        mode (str, optional): Image mode the pixels are stored in. Defaults to "RGB".
+    Returns:
+        TileAtlas: The new atlas.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    offsets = {}
+    offset = 0
+    with open(tmp_path, "wb") as f:
+        for z in range(max_zoom + 1):
+            tile_ids = [
+                TileID.fast(z, x, y) for x in range(2 ** z) for y in range(2 ** z)
+            ]
+            tiles = get_tiles(tile_ids)
+            for tid in tile_ids:
+                tile = tiles.get(tid)
+                if tile is None:
+                    print(f"atlas: no tile for {tid}, leaving it out.")
+                    continue
+                img = resize_square(tile.img.convert(mode), key.resolution, quality=1)
+                data = img.tobytes()
+                f.write(data)
+                offsets[f"{z}/{tid.x}/{tid.y}"] = offset
+                offset += len(data)
+    index = {
+        "provider": key.provider,
+        "style": key.style,
+        "fmt": key.fmt,
+        "resolution": key.resolution,
+        "mode": mode,
+        "max_zoom": max_zoom,
+        "tiles": offsets,
+    }
+    index_path = atlas_index_path(path)
+    tmp_index_path = index_path.with_name(f"{index_path.name}.tmp")
+    tmp_index_path.write_text(json.dumps(index))
+    os.replace(tmp_path, path)
+    os.replace(tmp_index_path, index_path)
+    return TileAtlas(path)
+
+
+def main(args: Optional[Iterable[str]] = None) -> None:
+    # Here to avoid a circular import, the mapper uses atlases.
+    from static_maps.mapper import MapBox, get_token
+
+    parser = argparse.ArgumentParser(
+        description="Bakes a MapBox style's low zoom tiles into an atlas."
+    )
+    parser.add_argument("path", type=Path, help="Atlas file to write.")
+    parser.add_argument("--max-zoom", type=int, default=default_max_zoom)
+    parser.add_argument("--style", default="satellite")
+    parser.add_argument("--fmt", default="jpg90")
+    parser.add_argument("--low-res", action="store_true", help="256px tiles.")
+    parser.add_argument(
+        "--tile-cache",
+        type=Path,
+        default=None,
+        help="Import tiles already in this tile cache, and cache the ones downloaded.",
+    )
+    opts = parser.parse_args(args)
+    tile_cache = TileCache(path=opts.tile_cache) if opts.tile_cache else None
+    mapbox = MapBox(
+        token=get_token(),
+        style=opts.style,
+        fmt=opts.fmt,
+        high_res=not opts.low_res,
+        tile_cache=tile_cache,
+    )
+    resolution = 256 if opts.low_res else 512
+    key = TileKey(mapbox.map_name, opts.style, opts.fmt, resolution, 0, 0, 0)
+    atlas = build_atlas(opts.path, key, mapbox.get_tiles, opts.max_zoom)
+    print(f"atlas: {len(atlas)} tiles written to {atlas.path}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmarks for static_maps.imager.
+Run from the repo root with: python -m static_maps.benchmarks.bench_imager
+"""
+import os
+import sys
+from io import BytesIO
+from random import Random
+from timeit import timeit
+
+sys.path.append(os.getcwd())
+
+from static_maps import imager
+from static_maps.imager import Image
+
+sizes = (256, 512, 1024, 2048)
+
+
+def reference_transparency_composite(a: "Image", b: "Image", t: int = 200) -> "Image":
+    """
+    The original per-pixel implementation of transparency_composite(), kept to compare against.
+    """
+    t = max(min(t, 255), 0)
+    bp = list(b.getdata())
+    bp2 = [(r, g, b, 255) if a != 0 else (r, b, g, 0) for r, g, b, a in bp]
+    new_b = Image.new("RGBA", b.size)
+    new_b.putdata(bp2)
+    bp2m = [t if a != 0 else a for _, _, _, a in bp]
+    paste_mask = Image.new("L", b.size, 255)
+    paste_mask.putdata(bp2m)
+    temp_image = a.copy()
+    temp_image.paste(new_b, (0, 0, *b.size), mask=paste_mask)
+    return temp_image
+
+
+def reference_composite_mxn(images: dict) -> "Image":
+    """
+    The original composite_mxn(), alpha compositing each tile onto the canvas, kept to compare against.
+    """
+    x_min, x_max = imager.minmax([t[0] for t in images])
+    y_min, y_max = imager.minmax([t[1] for t in images])
+    image_meta = list(images.values())[0]
+    image_size = image_meta.size[0]
+    output_size = (image_size * (x_max - x_min + 1), image_size * (y_max - y_min + 1))
+    if image_meta.mode == "RGB":
+        new_image = Image.new("RGB", output_size)
+    else:
+        new_image = Image.new("RGBA", output_size, (0, 255, 255, 0))
+    for (img_x, img_y), img in images.items():
+        xy = ((img_x - x_min) * image_size, (img_y - y_min) * image_size)
+        new_image = imager.img_comp(new_image, img, xy)
+    return new_image
+
+
+def range_overlay(size: int, seed: int = 0) -> "Image":
+    """
+    Makes a range-map-like overlay: noisy colours with roughly half the pixels fully transparent.
+    """
+    rng = Random(seed)
+    img = Image.frombytes("RGBA", (size, size), rng.randbytes(size * size * 4))
+    alpha = img.getchannel("A").point(lambda v: 0 if v < 128 else v)
+    img.putalpha(alpha)
+    return img
+
+
+def bench_transparency_composite(number: int = 3) -> None:
+    print(f"{'size':>6} {'reference (s)':>14} {'current (s)':>12} {'speedup':>8} same")
+    for size in sizes:
+        background = Image.new("RGB", (size, size), (40, 90, 40))
+        foreground = range_overlay(size)
+        same = list(
+            reference_transparency_composite(background, foreground).getdata()
+        ) == list(imager.transparency_composite(background, foreground).getdata())
+        ref = timeit(
+            lambda: reference_transparency_composite(background, foreground),
+            number=number,
+        )
+        cur = timeit(
+            lambda: imager.transparency_composite(background, foreground),
+            number=number,
+        )
+        print(
+            f"{size:>6} {ref / number:>14.4f} {cur / number:>12.4f} {ref / cur:>7.1f}x {same}"
+        )
+
+
+def bench_composite_mxn(number: int = 5) -> None:
+    print(f"{'mosaic':>10} {'reference (s)':>14} {'current (s)':>12} {'speedup':>8}")
+    for dim, size in ((3, 512), (8, 256), (8, 512)):
+        tile = range_overlay(size)
+        images = {(x, y): tile for x in range(dim) for y in range(dim)}
+        ref = timeit(lambda: reference_composite_mxn(images), number=number)
+        cur = timeit(lambda: imager.composite_mxn(images), number=number)
+        print(
+            f"{f'{dim}x{dim}@{size}':>10} {ref / number:>14.4f} {cur / number:>12.4f} {ref / cur:>7.1f}x"
+        )
+
+
+def bench_encode_profiles(number: int = 5, size: int = 512) -> None:
+    # Noise stands in for a satellite basemap, which compresses about as badly.
+    bands = [Image.effect_noise((size, size), 40) for _ in range(3)]
+    background = Image.merge("RGB", bands)
+    range_map = imager.transparency_composite(background, range_overlay(size))
+    print(f"{'profile':>9} {'bytes':>9} {'encode (s)':>11}")
+    for profile in imager.encode_profiles:
+        encoded = imager.encode_image(range_map, profile)
+        t = timeit(lambda: imager.encode_image(range_map, profile), number=number)
+        print(f"{profile:>9} {encoded.size:>9} {t / number:>11.4f}")
+
+
+def bench_jpeg_decode(number: int = 50) -> None:
+    """
+    Decoding a 512px JPEG tile at 256px, by decoding it in full and scaling it down, and with draft mode (image_from_bytes()).
+    """
+    bands = [Image.effect_noise((512, 512), 40) for _ in range(3)]
+    d = BytesIO()
+    Image.merge("RGB", bands).save(d, "JPEG", quality=90)
+    data = d.getvalue()
+
+    def full() -> None:
+        imager.image_from_bytes(data).resize((256, 256), Image.BILINEAR)
+
+    def draft() -> None:
+        imager.image_from_bytes(data, 256).load()
+
+    ref = timeit(full, number=number)
+    cur = timeit(draft, number=number)
+    print(f"{'decode':>6} {'full (ms)':>10} {'draft (ms)':>11} {'speedup':>8}")
+    print(
+        f"{'512>256':>6} {ref / number * 1000:>10.2f} {cur / number * 1000:>11.2f} {ref / cur:>7.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    bench_transparency_composite()
+    bench_composite_mxn()
+    bench_encode_profiles()
+    bench_jpeg_decode()
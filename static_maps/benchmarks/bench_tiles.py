@@ -0,0 +1,185 @@
+"""
+Benchmarks for static_maps.tiles.
+Run from the repo root with: python -m static_maps.benchmarks.bench_tiles
+"""
+import os
+import sys
+import warnings
+from dataclasses import dataclass
+from timeit import timeit
+
+sys.path.append(os.getcwd())
+
+import mercantile
+
+from static_maps import geo
+from static_maps.imager import Image
+from static_maps.tiles import Tile, TileArray, TileID
+
+array_dims = (3, 8)
+
+
+@dataclass(frozen=True)
+class ReferenceBaseID:
+    z: int
+    x: int
+    y: int
+
+
+class ReferenceTileID(ReferenceBaseID):
+    """
+    The original dataclass TileID, with relatives found through mercantile, kept to compare against.
+    """
+
+    warn: bool = True
+
+    def __init__(self, *args, **kwargs) -> None:
+        new_args = []
+        for a in args:
+            if isinstance(a, mercantile.Tile):
+                new_args += [a.z, a.x, a.y]
+            else:
+                try:
+                    iter(a)
+                    new_args += [x for x in a]
+                except TypeError:
+                    new_args += [a]
+        super().__init__(*tuple(new_args), **kwargs)
+        if self.warn:
+            if self.y > 2 ** self.z or self.x > 2 ** self.z:
+                warnings.warn("x and y should be in the range [0..2 ** z].")
+
+    @property
+    def asmrcantile(self) -> mercantile.Tile:
+        return mercantile.Tile(x=self.x, y=self.y, z=self.z)
+
+    @property
+    def parent(self) -> "ReferenceTileID":
+        return ReferenceTileID(mercantile.parent(self.asmrcantile))
+
+    @property
+    def children(self) -> list:
+        return [ReferenceTileID(mt) for mt in mercantile.children(self.asmrcantile)]
+
+    @property
+    def siblings(self) -> list:
+        return [
+            ReferenceTileID(mt)
+            for mt in mercantile.children(mercantile.parent(self.asmrcantile))
+        ]
+
+
+class ReferenceTileArray(TileArray):
+    """
+    TileArray with the original scanning extents, bounds and compositing, kept to compare against.
+    """
+
+    @property
+    def x_min(self) -> int:
+        return min(t.x for t in self.keys())
+
+    @property
+    def x_max(self) -> int:
+        return max(t.x for t in self.keys())
+
+    @property
+    def y_min(self) -> int:
+        return min(t.y for t in self.keys())
+
+    @property
+    def y_max(self) -> int:
+        return max(t.y for t in self.keys())
+
+    @property
+    def bounds(self) -> geo.LatLonBBox:
+        bboxes = [t.bounds for t in self.values()]
+        left = min([x.left for x in bboxes])
+        right = max([x.right for x in bboxes])
+        top = max([x.top for x in bboxes])
+        bottom = min([x.bottom for x in bboxes])
+        return geo.LatLonBBox(left=left, right=right, top=top, bottom=bottom)
+
+    def _composite_layer(self, foreground_ta: TileArray) -> TileArray:
+        z = self.zoom_level
+        x_range = range(self.x_min, self.x_max + 1)
+        y_range = range(self.y_min, self.y_max + 1)
+        tids_check = [TileID(z, x, y) for x in x_range for y in y_range]
+        fg_tids = [x for x in foreground_ta.keys() if x in tids_check]
+        result = ReferenceTileArray()
+        for tid, tile in self.items():
+            if tid in fg_tids:
+                result[tid] = tile.composite_image(foreground_ta[tid])
+                fg_tids.remove(tid)
+            else:
+                result[tid] = tile
+        for tid in fg_tids:
+            result[tid] = foreground_ta[tid]
+        return result
+
+
+def build(cls: type, dim: int, mode: str, colour: tuple) -> TileArray:
+    """
+    Builds a dim x dim array of 256px tiles, reading the extents and bounds as it goes like the tile planner does.
+    """
+    ta = cls()
+    z = 4
+    for x in range(dim):
+        for y in range(dim):
+            tid = TileID(z, x, y)
+            ta[tid] = Tile(tid, img=Image.new(mode, (256, 256), colour))
+            _ = ta.xy_dims
+            _ = ta.bounds
+    return ta
+
+
+def bench_tilearray(number: int = 5) -> None:
+    print(
+        f"{'array':>6} {'stage':>10} {'reference (s)':>14} {'current (s)':>12} {'speedup':>8}"
+    )
+    for dim in array_dims:
+        for stage in ("build", "composite"):
+            timings = []
+            for cls in (ReferenceTileArray, TileArray):
+                bg = build(cls, dim, "RGB", (40, 90, 40))
+                fg = build(cls, dim, "RGBA", (200, 0, 0, 128))
+                if stage == "build":
+                    func = lambda: build(cls, dim, "RGB", (40, 90, 40))
+                else:
+                    func = lambda: bg.composite_layers_out(fg)
+                timings.append(timeit(func, number=number) / number)
+            ref, cur = timings
+            print(
+                f"{f'{dim}x{dim}':>6} {stage:>10} {ref:>14.4f} {cur:>12.4f} {ref / cur:>7.1f}x"
+            )
+
+
+def bench_tileid(number: int = 20000) -> None:
+    cases = {
+        "create": (
+            lambda: ReferenceTileID(12, 1000, 1200),
+            lambda: TileID(12, 1000, 1200),
+        ),
+        "fast": (
+            lambda: ReferenceTileID(12, 1000, 1200),
+            lambda: TileID.fast(12, 1000, 1200),
+        ),
+        "hash": (
+            lambda: hash(ref_tid),
+            lambda: hash(tid),
+        ),
+        "parent": (lambda: ref_tid.parent, lambda: tid.parent),
+        "children": (lambda: ref_tid.children, lambda: tid.children),
+        "siblings": (lambda: ref_tid.siblings, lambda: tid.siblings),
+    }
+    ref_tid = ReferenceTileID(12, 1000, 1200)
+    tid = TileID(12, 1000, 1200)
+    print(f"{'op':>9} {'reference (us)':>15} {'current (us)':>13} {'speedup':>8}")
+    for op, (ref_func, cur_func) in cases.items():
+        ref = timeit(ref_func, number=number) / number * 1e6
+        cur = timeit(cur_func, number=number) / number * 1e6
+        print(f"{op:>9} {ref:>15.2f} {cur:>13.2f} {ref / cur:>7.1f}x")
+
+
+if __name__ == "__main__":
+    bench_tileid()
+    bench_tilearray()
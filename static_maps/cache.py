@@ -0,0 +1,845 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, Optional, Tuple
+
+from static_maps.imager import Image, shared_view
+
+try:
+    import fcntl
+except ImportError:
+    # Windows doesn't have it, so saves from different processes aren't serialized there.
+    fcntl = None
+
+TileKey = namedtuple("TileKey", "provider, style, fmt, resolution, z, x, y")
+# A cached tile with its HTTP validators. stored is when it was downloaded or last revalidated, as a unix time.
+CachedTile = namedtuple("CachedTile", "data, etag, last_modified, stored")
+
+
+# Shared tile caches evict down to this fraction of their budget.
+shared_eviction_target = 0.9
+
+
+@dataclass
+class TileCache:
+    """
+    Disk-backed store for downloaded tile bytes, bounded by a byte budget.
+    Tiles are stored as one file each under path, laid out as provider/style/fmt/resolution/z/x/y. Fields that aren't safe as directory names are hashed.
+    The least recently used tiles are evicted once the budget is exceeded.
+    Recency survives restarts, as file modification times are updated on every hit and used to rebuild the index.
+    Tiles stored with validators (ETag and Last-Modified) keep them, and when they were stored, in a .meta file next to the tile.
+    """
+
+    path: Path = Path("tile_cache")
+    max_bytes: int = 256 * 1024 * 1024
+    # Set when other processes use the same path. Tiles they store are found on disk, and the directory is rescanned every so often, so the budget covers all of them.
+    shared: bool = False
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    evictions: int = field(default=0, init=False)
+    _index: "OrderedDict[Path, int]" = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+    _size: int = field(default=0, init=False, repr=False)
+    # Bytes stored since the directory was last scanned.
+    _unscanned: int = field(default=0, init=False, repr=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self) -> None:
+        self.path = Path(self.path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self) -> None:
+        self._scan()
+        self._evict()
+
+    def _scan(self) -> None:
+        """
+        Rebuilds the LRU index from the files on disk, oldest first.
+        """
+        entries = []
+        for fn in self.path.rglob("*.tile"):
+            try:
+                st = fn.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, fn, st.st_size))
+        entries.sort()
+        self._index.clear()
+        self._size = 0
+        self._unscanned = 0
+        for _, fn, size in entries:
+            self._index[fn] = size
+            self._size += size
+
+    def _known(self, fn: Path) -> bool:
+        """
+        True if the tile file is in the index. Shared caches also look on disk for tiles other processes stored, and add them.
+        """
+        if fn in self._index:
+            return True
+        if not self.shared:
+            return False
+        try:
+            size = fn.stat().st_size
+        except FileNotFoundError:
+            return False
+        self._index[fn] = size
+        self._size += size
+        return True
+
+    def _file(self, key: TileKey) -> Path:
+        parts = [_path_part(p) for p in key[:-1]]
+        return self.path.joinpath(*parts, f"{key.y}.tile")
+
+    def get(self, key: TileKey) -> Optional[bytes]:
+        """
+        Returns the cached bytes for a tile, or None if it isn't cached.
+        """
+        fn = self._file(key)
+        with self._lock:
+            if not self._known(fn):
+                self.misses += 1
+                return None
+            self._index.move_to_end(fn)
+            self.hits += 1
+        try:
+            data = fn.read_bytes()
+            os.utime(fn)
+        except FileNotFoundError:
+            # Removed from under us, treat it as a miss.
+            with self._lock:
+                self._forget(fn)
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return data
+
+    def get_entry(self, key: TileKey) -> Optional[CachedTile]:
+        """
+        Returns the cached bytes for a tile along with its validators, or None if it isn't cached.
+        Tiles stored without validators have no etag or last_modified, and a stored time of 0.
+        """
+        data = self.get(key)
+        if data is None:
+            return None
+        try:
+            meta = json.loads(_meta_file(self._file(key)).read_text())
+        except (FileNotFoundError, ValueError):
+            meta = {}
+        return CachedTile(
+            data, meta.get("etag"), meta.get("last_modified"), meta.get("stored", 0.0)
+        )
+
+    def stored(self, key: TileKey) -> Optional[Tuple[float, int]]:
+        """
+        When a tile was stored or last revalidated, without reading it. Doesn't count as a hit or miss.
+        Returns:
+            Optional[Tuple[float, int]]: (stored time, size in bytes), or None if it isn't cached. Tiles stored without validators have a stored time of 0.
+        """
+        fn = self._file(key)
+        with self._lock:
+            if not self._known(fn):
+                return None
+            size = self._index[fn]
+        try:
+            meta = json.loads(_meta_file(fn).read_text())
+        except (FileNotFoundError, ValueError):
+            meta = {}
+        return meta.get("stored", 0.0), size
+
+    def put(
+        self, key: TileKey, data: bytes, validators: Optional[Dict[str, str]] = None
+    ) -> None:
+        """
+        Stores the bytes for a tile, evicting the least recently used tiles if this goes over budget.
+        Tiles larger than the whole budget aren't stored.
+        Args:
+            validators (Dict[str, str], optional): If set, the tile's "etag" and "last_modified" (either can be missing), stored along with the time.
+        """
+        if len(data) > self.max_bytes:
+            return
+        fn = self._file(key)
+        fn.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fn = fn.with_name(f"{fn.name}.{_tmp_suffix()}")
+        tmp_fn.write_bytes(data)
+        os.replace(tmp_fn, fn)
+        if validators is not None:
+            self._write_meta(fn, validators)
+        else:
+            _unlink(_meta_file(fn))
+        with self._lock:
+            self._forget(fn)
+            self._index[fn] = len(data)
+            self._size += len(data)
+            self._unscanned += len(data)
+            self._evict()
+
+    def revalidated(self, key: TileKey, validators: Dict[str, str]) -> None:
+        """
+        Marks a cached tile as still current, after the server said it's not modified. Validators not given are kept.
+        """
+        entry = self.get_entry(key)
+        if entry is not None:
+            old = {"etag": entry.etag, "last_modified": entry.last_modified}
+            self._write_meta(self._file(key), {**old, **validators})
+
+    def _write_meta(self, fn: Path, validators: Dict[str, str]) -> None:
+        meta = {k: v for k, v in validators.items() if v is not None}
+        meta["stored"] = time()
+        meta_fn = _meta_file(fn)
+        tmp_fn = meta_fn.with_name(f"{meta_fn.name}.{_tmp_suffix()}")
+        tmp_fn.write_text(json.dumps(meta))
+        os.replace(tmp_fn, meta_fn)
+
+    def _forget(self, fn: Path) -> None:
+        size = self._index.pop(fn, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self) -> None:
+        target = self.max_bytes
+        if self.shared:
+            # Other processes' tiles are only counted once the directory is rescanned.
+            # That's done when this one goes over budget, or has stored the room eviction leaves since it last looked.
+            room = self.max_bytes * (1 - shared_eviction_target)
+            if self._size > self.max_bytes or self._unscanned > room:
+                self._scan()
+            # Evicts a little extra, so the next put doesn't rescan too.
+            if self._size > self.max_bytes:
+                target = int(self.max_bytes * shared_eviction_target)
+        while self._size > target and self._index:
+            fn, size = self._index.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            _unlink(fn)
+            _unlink(_meta_file(fn))
+
+    def __contains__(self, key: TileKey) -> bool:
+        with self._lock:
+            return self._known(self._file(key))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def size(self) -> int:
+        """Total bytes of tiles currently stored."""
+        return self._size
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "tiles": len(self),
+            "bytes": self.size,
+        }
+
+
+# Key fields made of only these are used as directory names as they are.
+_safe_part = re.compile(r"[\w@-][\w.@-]*", re.ASCII)
+
+
+def _path_part(part: Any) -> str:
+    """
+    A key field as a directory name. Fields that aren't safe as one on every filesystem, like a query string, are replaced by a hash of them.
+    """
+    part = str(part)
+    if _safe_part.fullmatch(part):
+        return part
+    return hashlib.sha1(part.encode()).hexdigest()[:16]
+
+
+def _meta_file(fn: Path) -> Path:
+    return fn.with_suffix(".meta")
+
+
+def _unlink(fn: Path) -> None:
+    try:
+        fn.unlink()
+    except FileNotFoundError:
+        pass
+
+
+@dataclass
+class RevalidationStats:
+    """
+    How revalidating cached tiles with conditional requests compares to downloading them again.
+    """
+
+    # Served from the cache without a request, as they were recent enough.
+    fresh: int = 0
+    # Revalidated, and served from the cache on a 304.
+    not_modified: int = 0
+    # Revalidated, but had changed, so were downloaded again.
+    modified: int = 0
+    # Downloaded in full: not cached, or modified.
+    full_fetches: int = 0
+    # Bytes of tiles that weren't downloaded again, as they were fresh or not modified.
+    bytes_saved: int = 0
+    # Total seconds spent on 304 requests, and on full downloads.
+    not_modified_seconds: float = 0.0
+    full_fetch_seconds: float = 0.0
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def record(
+        self, status: int, seconds: float, saved: int = 0, stale: bool = False
+    ) -> None:
+        """
+        Records a request made for a tile. stale is set if it was a revalidation of a cached tile.
+        """
+        with self._lock:
+            if status == 304:
+                self.not_modified += 1
+                self.bytes_saved += saved
+                self.not_modified_seconds += seconds
+            elif status == 200:
+                self.modified += stale
+                self.full_fetches += 1
+                self.full_fetch_seconds += seconds
+
+    def record_fresh(self, saved: int) -> None:
+        with self._lock:
+            self.fresh += 1
+            self.bytes_saved += saved
+
+    @property
+    def added_latency(self) -> Optional[float]:
+        """
+        Seconds a 304 takes on average, less a full download. Negative if revalidating is quicker. None until there's one of each.
+        """
+        if not self.not_modified or not self.full_fetches:
+            return None
+        return (
+            self.not_modified_seconds / self.not_modified
+            - self.full_fetch_seconds / self.full_fetches
+        )
+
+    def __str__(self) -> str:
+        latency = self.added_latency
+        latency = "n/a" if latency is None else f"{latency * 1000:+.1f}ms"
+        return f"fresh: {self.fresh}, not modified: {self.not_modified}, modified: {self.modified}, full fetches: {self.full_fetches}, bytes saved: {self.bytes_saved}, added latency per 304: {latency}."
+
+
+def image_bytes(image: "Image") -> int:
+    """
+    Approximate memory used by an image's pixels. Pillow stores multi-band images with 4 bytes per pixel.
+    """
+    w, h = image.size
+    return w * h * (1 if len(image.getbands()) == 1 else 4)
+
+
+@dataclass
+class ImageCache:
+    """
+    In-memory LRU of decoded tile images, bounded by the memory their pixels use rather than the number of entries.
+    Images are returned as copy-on-write views (see imager.shared_view), so callers can composite on them without touching the cached copy.
+    Keys can be anything hashable, but are usually a TileKey.
+    """
+
+    max_bytes: int = 256 * 1024 * 1024
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    evictions: int = field(default=0, init=False)
+    _index: "OrderedDict[Hashable, Image]" = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+    _size: int = field(default=0, init=False, repr=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def get(self, key: Hashable) -> Optional["Image"]:
+        """
+        Returns a copy-on-write view of the cached image, or None if it isn't cached.
+        """
+        with self._lock:
+            image = self._index.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+        return shared_view(image)
+
+    def put(self, key: Hashable, image: "Image") -> "Image":
+        """
+        Caches an image, evicting the least recently used images if this goes over budget.
+        The image passed in is marked read only too, so later changes to it copy its pixels first and aren't seen by the cache.
+        Returns:
+            Image: a copy-on-write view of the cached image, to use in place of the one passed in.
+        """
+        image.load()
+        image.readonly = 1
+        image = shared_view(image)
+        size = image_bytes(image)
+        if size > self.max_bytes:
+            return shared_view(image)
+        with self._lock:
+            old = self._index.pop(key, None)
+            if old is not None:
+                self._size -= image_bytes(old)
+            self._index[key] = image
+            self._size += size
+            while self._size > self.max_bytes and self._index:
+                _, evicted = self._index.popitem(last=False)
+                self._size -= image_bytes(evicted)
+                self.evictions += 1
+        return shared_view(image)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def size(self) -> int:
+        """Approximate bytes of pixel data currently cached."""
+        return self._size
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "tiles": len(self),
+            "bytes": self.size,
+        }
+
+
+@dataclass
+class EmptyTileCache:
+    """
+    Negative cache of tiles a provider has said have no data, like GBIF's 204 responses, so they aren't asked for again until ttl runs out.
+    Only the keys are stored, bounded by their number, and the least recently used are evicted first.
+    Keys can be anything hashable, but are usually a TileKey.
+    """
+
+    ttl: float = 24 * 60 * 60
+    max_tiles: int = 100_000
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    _index: "OrderedDict[Hashable, float]" = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def is_empty(self, key: Hashable) -> bool:
+        """
+        True if the tile is known to be empty. Counts as a hit or miss.
+        """
+        with self._lock:
+            expires = self._index.get(key)
+            if expires is not None and expires <= monotonic():
+                del self._index[key]
+                expires = None
+            if expires is None:
+                self.misses += 1
+                return False
+            self._index.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, key: Hashable) -> None:
+        with self._lock:
+            self._index.pop(key, None)
+            self._index[key] = monotonic() + self.ttl
+            while len(self._index) > self.max_tiles:
+                self._index.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        expires = self._index.get(key)
+        return expires is not None and expires > monotonic()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "tiles": len(self)}
+
+
+# Seconds each metadata lookup is cached for, see MetadataCache.
+metadata_ttls = {
+    # Taxonomy barely changes.
+    "gbif.species": 30 * 24 * 60 * 60,
+    # Ranges change as new data comes in.
+    "gbif.bbox": 24 * 60 * 60,
+    "ebird.env": 24 * 60 * 60,
+    "ebird.rsid": 24 * 60 * 60,
+}
+
+
+@dataclass
+class MetadataCache:
+    """
+    Persistent cache for the small lookups made before a map's tiles can be fetched, like a species' taxon key or bounding box.
+    Each lookup is cached for its endpoint's TTL. Entries in the last part of it are still used, but are refreshed in the background,
+    so lookups people keep making never have to wait for the server.
+    Entries are saved as JSON to path whenever they change, and loaded from it when made, so they survive restarts.
+    """
+
+    # Where entries are saved. None keeps them in memory.
+    path: Optional[Path] = None
+    ttls: Dict[str, float] = field(default_factory=lambda: dict(metadata_ttls))
+    # For endpoints not in ttls.
+    default_ttl: float = 24 * 60 * 60
+    # Entries older than this fraction of their TTL are refreshed in the background when used.
+    refresh_after: float = 0.8
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    refreshes: int = field(default=0, init=False)
+    # {endpoint: {key: [stored, value]}}, stored as a unix time.
+    _entries: Dict[str, Dict[str, list]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _refreshing: set = field(default_factory=set, init=False, repr=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+    _executor: Optional[ThreadPoolExecutor] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self) -> None:
+        if self.path is None:
+            return
+        self.path = Path(self.path)
+        self._entries = self._read()
+
+    def _read(self) -> Dict[str, Dict[str, list]]:
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            print(f"metadata cache {self.path} couldn't be read, starting empty.")
+        return {}
+
+    def ttl(self, endpoint: str) -> float:
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def get_or_fetch(
+        self,
+        endpoint: str,
+        key: Any,
+        fetch: Callable[[], Any],
+        encode: Callable[[Any], Any] = lambda v: v,
+        decode: Callable[[Any], Any] = lambda v: v,
+    ) -> Any:
+        """
+        Returns the cached result of a lookup, or calls fetch() to make it. None results aren't cached.
+        Args:
+            endpoint (str): Which lookup this is, for its TTL. See metadata_ttls.
+            key (Any): What's being looked up, like a species code. Turned into a string.
+            fetch (Callable[[], Any]): Makes the lookup.
+            encode (Callable[[Any], Any], optional): Turns fetch()'s result into something JSON can store. Defaults to as is.
+            decode (Callable[[Any], Any], optional): Turns it back again. Defaults to as is.
+        """
+        key = str(key)
+        ttl = self.ttl(endpoint)
+        with self._lock:
+            entry = self._entries.get(endpoint, {}).get(key)
+            age = time() - entry[0] if entry is not None else None
+            if age is not None and age < ttl:
+                self.hits += 1
+                stale = age >= ttl * self.refresh_after
+                if stale and (endpoint, key) not in self._refreshing:
+                    self._refreshing.add((endpoint, key))
+                    self.refreshes += 1
+                    self.executor.submit(self._refresh, endpoint, key, fetch, encode)
+                return decode(entry[1])
+            self.misses += 1
+        value = fetch()
+        if value is not None:
+            self.put(endpoint, key, encode(value))
+        return value
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix="metadata-refresh"
+            )
+        return self._executor
+
+    def _refresh(
+        self,
+        endpoint: str,
+        key: str,
+        fetch: Callable[[], Any],
+        encode: Callable[[Any], Any],
+    ) -> None:
+        try:
+            value = fetch()
+            if value is not None:
+                self.put(endpoint, key, encode(value))
+        except Exception as e:
+            print(f"metadata refresh of {endpoint} {key} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard((endpoint, key))
+
+    def put(self, endpoint: str, key: Any, value: Any) -> None:
+        """
+        Stores an already encoded lookup result, and saves the cache.
+        """
+        with self._lock:
+            self._entries.setdefault(endpoint, {})[str(key)] = [time(), value]
+            self._save()
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Held from reading the file to replacing it, so a save from another process can't land in between and be lost.
+        with _file_lock(self.path.with_name(f"{self.path.name}.lock")):
+            # Other processes may share the file, so keep what they've saved since, unless this one's newer.
+            for endpoint, keys in self._read().items():
+                ours = self._entries.setdefault(endpoint, {})
+                for k, v in keys.items():
+                    if k not in ours or ours[k][0] < v[0]:
+                        ours[k] = v
+            # Expired entries would only be fetched again, so they aren't kept.
+            now = time()
+            entries = {
+                endpoint: {
+                    k: v for k, v in keys.items() if now - v[0] < self.ttl(endpoint)
+                }
+                for endpoint, keys in self._entries.items()
+            }
+            tmp_path = self.path.with_name(f"{self.path.name}.{_tmp_suffix()}")
+            tmp_path.write_text(json.dumps(entries))
+            os.replace(tmp_path, self.path)
+        self._entries = entries
+
+    def __contains__(self, item: Tuple[str, Any]) -> bool:
+        endpoint, key = item
+        entry = self._entries.get(endpoint, {}).get(str(key))
+        return entry is not None and time() - entry[0] < self.ttl(endpoint)
+
+    def __len__(self) -> int:
+        return sum(len(keys) for keys in self._entries.values())
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "entries": len(self),
+        }
+
+
+# profile is the encode profile of the render, see imager.encode_profiles.
+RenderKey = namedtuple(
+    "RenderKey", "provider, subject, size, profile", defaults=("png",)
+)
+
+
+@dataclass
+class RenderCache:
+    """
+    Cache of finished renders, usually encoded PNG bytes, with a time to live.
+    Identical requests that arrive while a render is running wait for it and share its result, rather than each rendering again.
+    Keys can be anything hashable, but are usually a RenderKey.
+    """
+
+    ttl: float = 24 * 60 * 60
+    max_bytes: int = 64 * 1024 * 1024
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    coalesced: int = field(default=0, init=False)
+    _index: "OrderedDict[Hashable, Tuple[float, Any]]" = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+    _in_flight: Dict[Hashable, Future] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _size: int = field(default=0, init=False, repr=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Returns a cached render if there's one that hasn't expired, or None.
+        """
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: Hashable) -> Optional[Any]:
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= monotonic():
+            self._forget(key)
+            return None
+        self._index.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._forget(key)
+            self._index[key] = (monotonic() + self.ttl, value)
+            self._size += render_bytes(value)
+            while self._size > self.max_bytes and self._index:
+                self._forget(next(iter(self._index)))
+
+    def _forget(self, key: Hashable) -> None:
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._size -= render_bytes(entry[1])
+
+    def get_or_render(self, key: Hashable, render: Callable[[], Any]) -> Any:
+        """
+        Returns the cached render for key, or calls render() to make it.
+        If another thread is already rendering the same key, waits for that render instead of starting another one.
+        Exceptions from render() are raised in every waiting caller, and nothing is cached.
+        """
+        value, future, owner = self._claim(key)
+        if value is not None:
+            return value
+        if not owner:
+            return future.result()
+        try:
+            value = render()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, value)
+        return value
+
+    async def get_or_render_async(
+        self, key: Hashable, render: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        get_or_render() for asyncio code. render() returns an awaitable, and waiting for a render doesn't block the event loop.
+        Renders are coalesced with those of get_or_render() too.
+        The render carries on if its caller is cancelled, so it's still cached and other callers waiting for it still get it.
+        """
+        value, future, owner = self._claim(key)
+        if value is not None:
+            return value
+        if not owner:
+            return await asyncio.shield(asyncio.wrap_future(future))
+        task = asyncio.ensure_future(render())
+
+        def finish(task: "asyncio.Future") -> None:
+            if task.cancelled():
+                self._finish(key, future, error=asyncio.CancelledError())
+            elif task.exception() is not None:
+                self._finish(key, future, error=task.exception())
+            else:
+                self._finish(key, future, task.result())
+
+        task.add_done_callback(finish)
+        return await asyncio.shield(task)
+
+    def _claim(self, key: Hashable) -> Tuple[Optional[Any], Optional[Future], bool]:
+        """
+        Looks up a render, counting it as a hit, miss or coalesced.
+        Returns:
+            Tuple[Optional[Any], Optional[Future], bool]: (the cached render or None, the future of the render in progress, True if the caller has to render it and _finish() it)
+        """
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+                return value, None, False
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return None, future, False
+            self.misses += 1
+            future = Future()
+            self._in_flight[key] = future
+            return None, future, True
+
+    def _finish(
+        self,
+        key: Hashable,
+        future: Future,
+        value: Any = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        """
+        Caches a render made after _claim(), and passes it or its error on to everyone waiting for it.
+        """
+        if error is None and value is not None:
+            self.put(key, value)
+        with self._lock:
+            del self._in_flight[key]
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "renders": len(self),
+            "bytes": self._size,
+        }
+
+
+def _tmp_suffix() -> str:
+    """
+    Temporary file suffix, unique to the writing process and thread so concurrent writers don't clobber each other's files.
+    """
+    return f"{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+@contextmanager
+def _file_lock(path: Path) -> Iterator[None]:
+    """
+    Holds an exclusive lock on path, made if needed, shared with other processes and threads that lock it. Does nothing without fcntl.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def render_bytes(value: Any) -> int:
+    """
+    Size of a cached render. Renders are bytes, or tuples starting with bytes.
+    """
+    if isinstance(value, tuple):
+        value = value[0]
+    return len(value) if isinstance(value, (bytes, bytearray)) else 0
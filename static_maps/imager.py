@@ -3,7 +3,18 @@ from dataclasses import dataclass, field
 from io import BytesIO
 from numbers import Number
 from pathlib import Path
-from typing import Any, Dict, Iterable, NamedTuple, Tuple, Union
+from time import perf_counter
+from typing import (
+    Any,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import PIL.Image as BaseImage
 import PIL.ImageDraw as ImageDraw
@@ -28,14 +39,96 @@ def new_getbbox(self: Any) -> "PixBbox":
 Image.Image.getbbox = new_getbbox
 
 
-def asbytes(self) -> bytes:
-    d = BytesIO()
-    self.save(d, "png")
-    return BytesIO(d.getvalue())
+def asbytes(self, profile: str = "png") -> bytes:
+    return encode_image(self, profile).data
 
 
 Image.Image.asbytes = asbytes
 
+
+@dataclass(frozen=True)
+class EncodeProfile:
+    """
+    How to encode a finished image, see encode_profiles.
+    """
+
+    fmt: str
+    extension: str
+    # Passed on to Image.save().
+    options: Dict[str, Any] = field(default_factory=dict)
+    # Quantize to a palette of this many colours before saving. None keeps full colour.
+    colours: Optional[int] = None
+    # Formats that can't store alpha get the image flattened to RGB first.
+    alpha: bool = True
+
+    def prepare(self, image: "Image") -> "Image":
+        if self.colours is not None:
+            # Not Image.Quantize.FASTOCTREE, which needs pillow 9.1. Pipfile.lock pins 8.4.
+            return image.quantize(self.colours, method=Image.FASTOCTREE)
+        if not self.alpha and image.mode != "RGB":
+            return image.convert("RGB")
+        return image
+
+
+# Satellite basemaps compress badly losslessly, so the lossy profiles are much smaller for finished maps.
+encode_profiles = {
+    # Lossless, same as Image.save(fp, "png").
+    "png": EncodeProfile("PNG", "png", {"compress_level": 6}),
+    # Lossless, larger but several times faster to encode.
+    "png_fast": EncodeProfile("PNG", "png", {"compress_level": 1}),
+    # 256 colour palette. The range overlay's flat colours survive it well.
+    "png8": EncodeProfile("PNG", "png", {"compress_level": 6}, colours=256),
+    "webp": EncodeProfile("WEBP", "webp", {"quality": 80, "method": 4}),
+    "jpeg": EncodeProfile(
+        "JPEG", "jpg", {"quality": 85, "optimize": True}, alpha=False
+    ),
+}
+
+
+@dataclass
+class EncodedImage:
+    """
+    An encoded image, along with what it cost to encode.
+    """
+
+    data: bytes
+    profile: str
+    extension: str
+    # Wall time of the encode, including any quantizing or conversion.
+    seconds: float
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def __str__(self) -> str:
+        return f"{self.profile}: {self.size} bytes in {self.seconds:.3f}s"
+
+
+def encode_image(image: "Image", profile: str = "png") -> EncodedImage:
+    """
+    Encodes an image with one of the encode_profiles.
+    Args:
+        image (Image): Image to encode.
+        profile (str, optional): Name of the profile in encode_profiles. Defaults to "png".
+    Raises:
+        ValueError: If there's no profile with that name.
+    Returns:
+        EncodedImage: The encoded bytes, their size and the time taken.
+    """
+    if profile not in encode_profiles:
+        raise ValueError(
+            f"Unknown encode profile: {profile}, expected one of {list(encode_profiles)}."
+        )
+    p = encode_profiles[profile]
+    start = perf_counter()
+    d = BytesIO()
+    p.prepare(image).save(d, p.fmt, **p.options)
+    # getvalue() hands over the buffer without copying it, as nothing else writes to d.
+    data = d.getvalue()
+    return EncodedImage(data, profile, p.extension, perf_counter() - start)
+
+
 Pixel = namedtuple("Pixel", "x, y")
 
 
@@ -72,23 +165,19 @@ def transparency_composite(a: "Image", b: "Image", t: int = 200) -> "Image":
     Returns:
         Image: Composited image.
     """
-    # print(f"trans_comp:\na: {a}\nb: {b}")
     t = max(min(t, 255), 0)
     if b.mode != "RGBA":
         raise NotRGBAError
     # We want to convert our transparent image to a non-transparent image only where there are pixels with a not fully-transparent alpha value.
     # So we end up with two transparency levels, either fully transparent or not at all.
-    bp = list(b.getdata())
-    bp2 = [(r, g, b, 255) if a != 0 else (r, b, g, 0) for r, g, b, a in bp]
-    new_b = Image.new("RGBA", b.size)
-    new_b.putdata(bp2)
+    # Dropping the alpha band does this, as pasting an RGB image gives every pixel an alpha of 255.
+    # Where alpha was 0 the colour doesn't matter, as the mask below stops it being pasted.
+    new_b = b.convert("RGB")
 
     # Generate transparency mask.
-    # If there's a non fully-transparent pixel in b, this should be added to the mast at the specified transparency level.
-    # And if it isn't, it can stay at 0 (a==0).
-    bp2m = [t if a != 0 else a for _, _, _, a in bp]
-    paste_mask = Image.new("L", b.size, 255)
-    paste_mask.putdata(bp2m)
+    # If there's a non fully-transparent pixel in b, this should be added to the mask at the specified transparency level.
+    # And if it isn't, it can stay at 0 (a==0). A lookup table keeps this in C rather than per pixel in Python.
+    paste_mask = b.getchannel("A").point(_alpha_mask_lut(t))
 
     # best not to clobber a, just in case.
     temp_image = a.copy()
@@ -96,22 +185,68 @@ def transparency_composite(a: "Image", b: "Image", t: int = 200) -> "Image":
     return temp_image
 
 
-def image_from_response(response: Response) -> Image:
+def _alpha_mask_lut(t: int) -> List[int]:
+    """
+    Lookup table for Image.point() that maps alpha 0 to 0 and everything else to t.
+    """
+    return [0] + [t] * 255
+
+
+def image_from_response(response: Response, size: Optional[int] = None) -> Image:
     """
     Converts the content from a response object into an image.
     Args:
         response (Response): Response object.
+        size (int, optional): Width and height the image is needed at, see image_from_bytes(). Defaults to None, full size.
     Raises:
         ImageLoadError: If the loading fails for any reason.
     Returns:
         Image: Image from the response.
     """
+    return image_from_bytes(response.content, size)
+
+
+def image_from_bytes(data: bytes, size: Optional[int] = None) -> Image:
+    """
+    Converts encoded image bytes into an image.
+    Given a size smaller than the (square) image, it's decoded at that size.
+        JPEGs are decoded straight to 1/2, 1/4 or 1/8 scale with pillow's draft mode, which skips most of the decoding.
+    Args:
+        data (bytes): Encoded image, in any format pillow can open.
+        size (int, optional): Width and height the image is needed at. Defaults to None, full size.
+    Raises:
+        ImageLoadError: If the loading fails for any reason.
+    Returns:
+        Image: Image from the bytes.
+    """
     try:
-        return Image.open(BytesIO(response.content))
+        img = Image.open(BytesIO(data))
+        if size is not None and size < img.size[0]:
+            if img.format == "JPEG":
+                img.draft(img.mode, (size, size))
+            if img.size != (size, size):
+                img = img.resize((size, size), Image.BILINEAR)
+        return img
     except Exception as e:
         raise ImageLoadError(f"An error occured in image loading: {e}.")
 
 
+def shared_view(image: "Image") -> "Image":
+    """
+    Returns a new Image sharing the pixel data of image, without copying it.
+    The view is marked read only, so pillow copies the pixel data the first time anything (paste, alpha_composite, ImageDraw, ...) tries to modify it.
+    This makes it copy-on-write: changes to the view never reach the original image.
+    Args:
+        image (Image): Image to share. Should already be loaded.
+    Returns:
+        Image: copy-on-write view of the image.
+    """
+    image.load()
+    view = image._new(image.im)
+    view.readonly = 1
+    return view
+
+
 class ImageLoadError(Exception):
     def __init__(self, message="An error occured in image loading."):
         self.message = message
@@ -129,7 +264,89 @@ class ImageLoadError(Exception):
 #     return (left, upper, right, lower)
 
 
-def find_crop_bounds(image: "Image", output_size: int = 512) -> Tuple[PixBbox]:
+def content_bbox(
+    image: "Image", box: Optional[Tuple[int, int, int, int]] = None
+) -> Optional[PixBbox]:
+    """
+    Finds the bounding box of the non-transparent pixels in an image.
+    Only the alpha channel is scanned. Images without transparency are all content, so aren't scanned at all.
+    Args:
+        image (Image): Image to check.
+        box (Tuple[int, int, int, int], optional): Only check this (left, top, right, bottom) part of the image. The result is still in the image's coordinates. Defaults to the whole image.
+    Returns:
+        Optional[PixBbox]: Bounding box of the content, or None if it's all transparent.
+    """
+    if isinstance(image, WrappedView) and box is None:
+        return image.content_bbox()
+    if box is None:
+        box = (0, 0, *image.size)
+    left, top, right, bottom = box
+    if image.mode in ("RGBA", "LA", "PA"):
+        alpha = image.getchannel("A")
+    elif "transparency" in image.info:
+        alpha = image.convert("RGBA").getchannel("A")
+    else:
+        return PixBbox(*box)
+    if box != (0, 0, *image.size):
+        alpha = alpha.crop(box)
+    r = alpha._getbbox()
+    if r is None:
+        return None
+    return PixBbox(r[0] + left, r[1] + top, r[2] + left, r[3] + top)
+
+
+def merge_bboxes(bboxes: Iterable[Optional[PixBbox]]) -> Optional[PixBbox]:
+    """
+    Finds the bounding box covering all of the given ones. None (no content) is skipped.
+    Returns:
+        Optional[PixBbox]: The merged bounding box, or None if there was nothing to merge.
+    """
+    merged = None
+    for b in bboxes:
+        if b is None:
+            continue
+        if merged is None:
+            merged = b.pillow
+        else:
+            merged = (
+                min(merged[0], b.left),
+                min(merged[1], b.top),
+                max(merged[2], b.right),
+                max(merged[3], b.bottom),
+            )
+    return PixBbox(*merged) if merged is not None else None
+
+
+def shift_bbox(bbox: Optional[PixBbox], x: int, y: int = 0) -> Optional[PixBbox]:
+    """
+    Moves a bounding box by x and y pixels.
+    """
+    if bbox is None:
+        return None
+    return PixBbox(bbox.left + x, bbox.top + y, bbox.right + x, bbox.bottom + y)
+
+
+def wrapped_content_bboxes(
+    image: "Image",
+) -> Tuple[Optional[PixBbox], Optional[PixBbox]]:
+    """
+    Finds the content bounding box of an image, and of the same image with its halves swapped (see swap_left_right()).
+    Both come from one scan of the image, without making the swapped image.
+    Returns:
+        Tuple[Optional[PixBbox], Optional[PixBbox]]: bbox, swapped_bbox
+    """
+    size_x, size_y = image.size
+    half = size_x // 2
+    left = content_bbox(image, (0, 0, half, size_y))
+    right = content_bbox(image, (half, 0, size_x, size_y))
+    bbox = merge_bboxes((left, right))
+    swapped_bbox = merge_bboxes((shift_bbox(right, -half), shift_bbox(left, half)))
+    return bbox, swapped_bbox
+
+
+def find_crop_bounds(
+    image: "Image", output_size: int = 512, bbox: Optional[PixBbox] = None
+) -> Tuple[PixBbox]:
     """
     Calculates the crop bounds for a given image. Returns two different crops.
     For the first, returns a crop fitted within the bounds of the input image.
@@ -137,6 +354,7 @@ def find_crop_bounds(image: "Image", output_size: int = 512) -> Tuple[PixBbox]:
     Args:
         image (Image): [description]
         output_size (int, optional): [description]. Defaults to 512.
+        bbox (PixBbox, optional): Bounding box of the image's content, if it's already known (see TileArray.content_bbox). Otherwise the image is scanned for it.
 
     Raises:
         NotRGBAError: [description]
@@ -146,7 +364,8 @@ def find_crop_bounds(image: "Image", output_size: int = 512) -> Tuple[PixBbox]:
     """
     if image.mode != "RGBA":
         raise NotRGBAError
-    bbox = image.getbbox()
+    if bbox is None:
+        bbox = content_bbox(image)
     size_x, size_y = image.size
     center = bbox.center
     left = center[0] - output_size // 2
@@ -174,18 +393,23 @@ def find_crop_bounds(image: "Image", output_size: int = 512) -> Tuple[PixBbox]:
     return fitted_crop, center_crop
 
 
-def find_crop_bounds2(image: "Image", output_size: int = 512) -> Tuple:
+def find_crop_bounds2(
+    image: "Image",
+    output_size: int = 512,
+    bboxes: Optional[Tuple[Optional[PixBbox], Optional[PixBbox]]] = None,
+) -> Tuple:
     """
     Calculates the crop for a given image.
     Args:
         image (Image): input image to calculate the crop for.
         output_size (int, optional): [description]. Defaults to 512.
+        bboxes (Tuple[PixBbox, PixBbox], optional): The content bounding box of the image and of the image with its halves swapped, if they're already known (see TileArray.wrapped_content_bboxes()). Otherwise the image is scanned for them.
     Raises:
         NotRGBAError: We can only find pixels that contain data on RGBA images, as alpha = 0 is no data.
     Returns:
         [tuple]: (swapped_image, crop_area, center, bbox, extra_tiles, fill_crop)
             Where:
-            "swapped_image" is None if the image doesn't need to cross the antimeridian, otherwise an image with both sides of the antimerdian stuck together.
+            "swapped_image" is None if the image doesn't need to cross the antimeridian, otherwise a WrappedView with both sides of the antimerdian stuck together.
             "crop_area" is the area this tile would be cropped to if it was output_size pixels on a side.
             "center" is the center of the area that was cropped.
             "bbox" is the maximum bounding box for the pixels in the source image.
@@ -196,7 +420,9 @@ def find_crop_bounds2(image: "Image", output_size: int = 512) -> Tuple:
     """
     if image.mode != "RGBA":
         raise NotRGBAError
-    bbox = image.getbbox()
+    if bboxes is None:
+        bboxes = wrapped_content_bboxes(image)
+    bbox, swapped_bbox = bboxes
     x_dim, y_dim = bbox.xy_dims
     size_x, size_y = image.size
     swapped_image = None
@@ -205,10 +431,10 @@ def find_crop_bounds2(image: "Image", output_size: int = 512) -> Tuple:
         print("Wrapping Detected.")
         print(f"orig crop area: {x_dim}, {y_dim}")
         print("orig bbox:", bbox)
-        swapped_image = swap_left_right(image)
+        swapped_image = as_wrapped(image).swapped()
         image = swapped_image
+        bbox = swapped_bbox
 
-    bbox = image.getbbox()
     x_dim, y_dim = bbox.xy_dims
     print(f"minimal crop area: {x_dim}, {y_dim}")
     center = bbox.center
@@ -263,27 +489,117 @@ def draw_pixel_bounds(
     return bg_img
 
 
-def swap_left_right(image):
+def swap_left_right(image: Union["Image", "WrappedView"]) -> "Image":
     """
     Swaps the left half and the right half of an image. The split is always at the halfway mark.
     This is useful when the map crosses the anti-meridian.
+    Use WrappedView(...).swapped() instead if the swapped image is only needed for bounding boxes or a crop.
     Args:
         image (Image): Image to swap.
 
     Returns:
         Image: The swapped image.
     """
-    mode = image.mode
-    if mode == "RGBA":
-        new_image = Image.new("RGBA", image.size, (0, 0, 0, 0))
-    else:
-        new_image = Image.new("RGB", image.size, (0, 0, 0))
-    size_x, size_y = image.size
-    left = image.crop((0, 0, size_x // 2, size_y))
-    right = image.crop((size_x // 2, 0, size_x, size_y))
-    new_image = img_comp(new_image, right, (0, 0))
-    new_image = img_comp(new_image, left, (size_x // 2, 0))
-    return new_image
+    return as_wrapped(image).swapped().copy()
+
+
+@dataclass
+class WrappedView:
+    """
+    A view of images pasted left to right (as paste_halves() does) that wraps around horizontally, like a map across the antimeridian.
+    The view can be shifted, with pixels going off the right edge coming back on the left, without building the shifted image.
+    Bounding boxes come from the parts directly, and crop() only copies the cropped area, so the whole image is never built.
+    Enough like an Image (mode, size, crop(), copy() and save()) to be used in place of one for cropping.
+    Args:
+        parts (List[Image]): Images from left to right. They need the same mode and height.
+        shift (int, optional): Pixels to shift the view to the right by. Defaults to 0.
+    Raises:
+        MixedImageModesError: If the parts have different modes.
+        CompositingError: If the parts have different heights.
+    """
+
+    parts: List["Image"]
+    shift: int = 0
+
+    def __post_init__(self) -> None:
+        if len(set(p.mode for p in self.parts)) != 1:
+            raise MixedImageModesError
+        heights = [p.size[1] for p in self.parts]
+        if len(set(heights)) != 1:
+            raise CompositingError(f"Images need to be the same height. Got {heights}")
+
+    @property
+    def mode(self) -> str:
+        return self.parts[0].mode
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return sum(p.size[0] for p in self.parts), self.parts[0].size[1]
+
+    def swapped(self) -> "WrappedView":
+        """
+        The view with its left and right halves swapped, same as swap_left_right().
+        """
+        return WrappedView(self.parts, self.shift + self.size[0] // 2)
+
+    def _placed(self) -> Iterable[Tuple[int, "Image"]]:
+        """
+        Yields (x, part) for every place a part shows up in the view. A part that wraps around the edge shows up twice.
+        """
+        width = self.size[0]
+        offset = 0
+        for part in self.parts:
+            x = (offset + self.shift) % width
+            yield x, part
+            if x + part.size[0] > width:
+                yield x - width, part
+            offset += part.size[0]
+
+    def content_bbox(self) -> Optional[PixBbox]:
+        """
+        Bounding box of the non-transparent pixels in the view. See content_bbox().
+        Each part is scanned once, split where it wraps around the edge.
+        """
+        width, height = self.size
+        pieces = []
+        for x, part in self._placed():
+            # Only the part of the image that lands inside the view.
+            left = max(0, -x)
+            right = min(part.size[0], width - x)
+            pieces.append(shift_bbox(content_bbox(part, (left, 0, right, height)), x))
+        return merge_bboxes(pieces)
+
+    def getbbox(self) -> Optional[PixBbox]:
+        return self.content_bbox()
+
+    def crop(self, box: Tuple[int, int, int, int]) -> "Image":
+        """
+        Copies a (left, top, right, bottom) area of the view into a new image. Areas outside the view are left empty, as with Image.crop().
+        """
+        left, top, right, bottom = box
+        new_image = Image.new(self.mode, (right - left, bottom - top))
+        for x, part in self._placed():
+            if x < right and x + part.size[0] > left:
+                new_image.paste(part, (x - left, -top))
+        return new_image
+
+    def copy(self) -> "Image":
+        """
+        Builds the whole view as an image.
+        """
+        return self.crop((0, 0, *self.size))
+
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        self.copy().save(*args, **kwargs)
+
+
+def as_wrapped(image: Union["Image", WrappedView]) -> WrappedView:
+    """
+    Returns image as a WrappedView, if it isn't one already.
+    """
+    if isinstance(image, WrappedView):
+        return image
+    return WrappedView([image])
 
 
 def img_comp(a: "Image", b: "Image", xy: Tuple[int], mode: str = None) -> "Image":
@@ -298,7 +614,6 @@ def img_comp(a: "Image", b: "Image", xy: Tuple[int], mode: str = None) -> "Image
     Returns:
         Image: output_image
     """
-    print("modes", mode, a.mode, b.mode)
     if not mode:
         mode = a.mode
     if mode == "RGBA":
@@ -317,52 +632,92 @@ class MixedImageModesError(Exception):
 
 
 def composite_mxn(
-    images: Dict[Tuple[int, int], "Image"], strict: bool = False
+    images: Dict[Tuple[int, int], Optional["Image"]],
+    strict: bool = False,
+    blank: Collection[Tuple[int, int]] = (),
+    max_bytes: Optional[int] = None,
 ) -> "Image":
     """
     Composites MxN images together based on their image index.
+    The images are pasted straight into one preallocated image at their offsets, so they mustn't overlap.
+    Pasting copies every pixel as it is: partly transparent pixels replace the background rather than being alpha composited onto it (see img_comp()).
+    Missing (None) and blank images aren't copied, and are left as the background.
     Args:
         images Dict[Tuple[int, int], 'Image']: a Dictionary containing an image and its coordinates from an xy plane of images.
         strict (bool, optional): If true, mixed modes and sparse (holey) images are disallowed. Defaults to False.
+        blank (Collection[Tuple[int, int]], optional): Coordinates of images known to be blank. They count towards the output size, but aren't copied. Defaults to none.
+        max_bytes (int, optional): Largest output image allowed, in bytes. Defaults to None, no limit.
     Raises:
-        CompositingError: If compositing can't be carrier out.
+        CompositingError: If compositing can't be carrier out, or the output would be larger than max_bytes.
     Returns:
         Image: composited image.
     """
-    x_dim = minmax_range([t[0] for t in images])
-    y_dim = minmax_range([t[1] for t in images])
-    x_min, _ = minmax([t[0] for t in images])
-    y_min, _ = minmax([t[1] for t in images])
+    placed = [(xy, img) for xy, img in images.items() if img is not None]
+    if not placed:
+        raise CompositingError("No images to composite.")
+    x_min, x_max = minmax([t[0] for t in images])
+    y_min, y_max = minmax([t[1] for t in images])
+    x_dim = x_max - x_min + 1
+    y_dim = y_max - y_min + 1
     # Check for holes.
     if x_dim * y_dim != len(images) and strict:
         msg = f"{len(images)} expected, got {x_dim * y_dim}."
         raise CompositingError(msg)
-    # Make sure that all of the tiles are the same size.
-    if len(set(im.size for im in images.values())) != 1:
-        print([im.size for im in images.values()])
-        msg = "All tiles need to be the same size."
-        raise CompositingError(msg)
-    # Make sure images are the same mode.
-    if len(set(im.mode for im in images.values())) != 1 and strict:
-        msg = "Mixed tile image modes."
-        raise CompositingError(msg)
-    image_meta = list(images.values())[0]
-    image_size = image_meta.size[0]
-    output_size = (image_size * x_dim, image_size * y_dim)
+    image_meta = placed[0][1]
+    size = image_meta.size
     mode = image_meta.mode
+    for _, img in placed:
+        # Make sure that all of the tiles are the same size.
+        if img.size != size:
+            print([im.size for _, im in placed])
+            msg = "All tiles need to be the same size."
+            raise CompositingError(msg)
+        # Make sure images are the same mode.
+        if img.mode != mode and strict:
+            msg = "Mixed tile image modes."
+            raise CompositingError(msg)
+    image_size = size[0]
+    output_size = (image_size * x_dim, image_size * y_dim)
+    # Pillow stores both RGB and RGBA images with 4 bytes per pixel.
+    output_bytes = output_size[0] * output_size[1] * 4
+    if max_bytes is not None and output_bytes > max_bytes:
+        msg = f"{x_dim}x{y_dim} mosaic of {image_size}px tiles needs {output_bytes} bytes, over the limit of {max_bytes}."
+        raise CompositingError(msg)
 
     if mode == "RGB":
         new_image = Image.new("RGB", output_size)
     else:
         new_image = Image.new("RGBA", output_size, (0, 255, 255, 0))
-    for (img_x, img_y), img in images.items():
+    for (img_x, img_y), img in placed:
+        if (img_x, img_y) in blank:
+            continue
         # Normalize tile coordinates where x_min and/or y_min are not 0.
-        img_x -= x_min
-        img_y -= y_min
-        x_coord = img_x * image_size
-        y_coord = img_y * image_size
-        img_topleft = (x_coord, y_coord)
-        new_image = img_comp(new_image, img, img_topleft)
+        x_coord = (img_x - x_min) * image_size
+        y_coord = (img_y - y_min) * image_size
+        new_image.paste(img, (x_coord, y_coord))
+    return new_image
+
+
+def composite_window(
+    images: Iterable[Tuple[Tuple[int, int], "Image"]],
+    window: Tuple[int, int, int, int],
+    mode: str = "RGB",
+) -> "Image":
+    """
+    Builds only a window of a larger mosaic, without building the whole mosaic first.
+    Images are pasted, not alpha composited, so they shouldn't overlap.
+    Args:
+        images (Iterable[Tuple[Tuple[int, int], Image]]): ((x, y), image) pairs, where x and y are the top left corner of the image in the full mosaic.
+            Images that fall outside the window are clipped or ignored.
+        window (Tuple[int, int, int, int]): (left, top, right, bottom) of the window in the full mosaic, as per pillow's coordinates.
+        mode (str, optional): mode of the output image. Defaults to "RGB".
+    Returns:
+        Image: The window of the mosaic.
+    """
+    left, top, right, bottom = window
+    new_image = Image.new(mode, (right - left, bottom - top))
+    for (x, y), img in images:
+        new_image.paste(img, (x - left, y - top))
     return new_image
 
 
@@ -396,6 +751,29 @@ def scale_image(image: Image, scale_factor: int = -1, quality: int = 4) -> Image
     Returns:
         Image: resized version of the original image.
     """
+    if scale_factor == 0:
+        return image
+    size0 = max(int((2 ** scale_factor) * image.size[0]), 1)
+    size1 = max(int((2 ** scale_factor) * image.size[1]), 1)
+    return image.resize((size0, size1), resample=_resample(quality))
+
+
+def resize_square(
+    image: Image,
+    size: int,
+    quality: int = 4,
+    box: Optional[Tuple[float, float, float, float]] = None,
+) -> Image:
+    """
+    Resizes an image, or the box (left, top, right, bottom) out of it, to size x size. Returns image as-is if there's nothing to do.
+    quality is the same as for scale_image().
+    """
+    if box is None and image.size == (size, size):
+        return image
+    return image.resize((size, size), resample=_resample(quality), box=box)
+
+
+def _resample(quality: int) -> int:
     quality = max(min(quality, 4), 0)
     resample = [
         Image.NEAREST,
@@ -405,11 +783,7 @@ def scale_image(image: Image, scale_factor: int = -1, quality: int = 4) -> Image
         Image.BICUBIC,
         Image.LANCZOS,
     ]
-    if scale_factor == 0:
-        return image
-    size0 = max((2 ** scale_factor) * image.size[0], 1)
-    size1 = max((2 ** scale_factor) * image.size[1], 1)
-    return image.resize((size0, size1), resample=resample[quality])
+    return resample[quality]
 
 
 def quad_split(input_image: Image, fpath: str = None) -> NamedTuple:
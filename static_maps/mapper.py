@@ -1,13 +1,30 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from io import BytesIO
-from typing import Dict, List, Optional, Tuple, Union
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 from pprint import pprint
+import mercantile
 import requests
 from copy import deepcopy
+import math
 from json.decoder import JSONDecodeError
 
+import static_maps.geo as geo
 import static_maps.imager as imager
+from static_maps.atlas import TileAtlas
+from static_maps.cache import (
+    EmptyTileCache,
+    ImageCache,
+    MetadataCache,
+    RenderCache,
+    RenderKey,
+    RevalidationStats,
+    TileCache,
+    TileKey,
+)
 from static_maps.geo import (
     LatLon,
     LatLonBBox,
@@ -22,7 +39,17 @@ from static_maps.imager import (
     find_crop_bounds,
     find_crop_bounds2,
 )
-from static_maps.tiles import Tile, TileArray, TileID, bounding_box_to_tiles
+from static_maps.session import ProviderSession
+from static_maps.tiles import (
+    Tile,
+    TileArray,
+    TileID,
+    bounding_box_to_tiles,
+    make_child,
+    make_parent,
+    mosaic_content_bboxes,
+    split_mosaic,
+)
 
 
 def get_token():
@@ -34,22 +61,346 @@ def get_token():
 class BaseMap:
     base_url: str
     map_name: str = "maptile"
+    # Maximum number of tiles downloaded at once from this provider.
+    max_workers: int = 4
+    # If set, downloaded tiles are stored here and read back instead of being downloaded again.
+    tile_cache: Optional[TileCache] = None
+    # If set, decoded tile images are kept in memory here, so they don't need decoding again.
+    image_cache: Optional[ImageCache] = None
+    # Tiles with all 4 children cached are built from them instead of downloaded. When a download fails, the tile is built from a cached tile up to this many zoom levels out.
+    # Only for maps whose tiles look the same at every zoom, like imagery. 0 turns both off.
+    pyramid_levels: int = 0
+    # Connections kept open to each of this provider's hosts. Defaults to max_workers, so every download can reuse one.
+    pool_size: Optional[int] = None
+    # Times a request is retried, with backoff, after a connection error or a 429 or 5xx response.
+    retries: int = 3
+    # Tiles fetched with revalidating_get() are used from tile_cache without asking the server for this many seconds, then revalidated.
+    max_age: float = 6 * 60 * 60
+    # How revalidating tiles compares to downloading them again.
+    revalidation: RevalidationStats = field(
+        default_factory=RevalidationStats, compare=False
+    )
+    # If set, the lookups made before a map's tiles are fetched (species, bounding boxes, rsids) are cached here.
+    metadata_cache: Optional[MetadataCache] = None
+    _executor: Optional[ThreadPoolExecutor] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _session: Optional[ProviderSession] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        Thread pool used for downloading tiles. Shared by every fetch on this map, so max_workers bounds the whole provider.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix=self.map_name
+            )
+        return self._executor
+
+    @property
+    def session(self) -> ProviderSession:
+        """
+        Pooled HTTP session every request to this provider goes through, so connections are kept alive and reused.
+        """
+        if self._session is None:
+            self._session = ProviderSession(
+                pool_size=self.pool_size or self.max_workers, retries=self.retries
+            )
+        return self._session
+
+    @property
+    def connection_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Requests, new connections and reused connections for each host this provider has talked to. See ProviderSession.stats.
+        """
+        if self._session is None:
+            return {}
+        return self._session.stats
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_session"] = None
+        return state
+
+    def fetch_tiles(
+        self,
+        tile_ids: Iterable[TileID],
+        fetch: Callable[[TileID], Optional[Tile]],
+        name: str = "TileArray",
+    ) -> TileArray:
+        """
+        Downloads tiles concurrently and assembles them into a TileArray.
+        Args:
+            tile_ids (Iterable[TileID]): Tiles to download.
+            fetch (Callable[[TileID], Optional[Tile]]): Function that downloads a single tile.
+            name (str, optional): Name of the resulting TileArray. Defaults to "TileArray".
+        Returns:
+            TileArray: The downloaded tiles, in the same order as tile_ids.
+                Tiles that failed are left out of the array and recorded in its failed dict, along with the reason.
+        """
+        tile_ids = list(tile_ids)
+        futures = [self.executor.submit(fetch, tid) for tid in tile_ids]
+        tile_array = TileArray(name=name)
+        for tid, future in zip(tile_ids, futures):
+            try:
+                tile = future.result()
+            except Exception as e:
+                tile_array.failed[tid] = e
+                print(f"{self.map_name} tile {tid} failed: {e}")
+                continue
+            if tile is None:
+                tile_array.failed[tid] = self.TileFetchError(
+                    f"No tile returned for {tid}."
+                )
+                print(f"{self.map_name} tile {tid} failed: no tile returned.")
+                continue
+            tile_array[tid] = tile
+        return tile_array
 
     def download_tile_url(
-        self, tid: TileID, tile_url: str, params: Dict[str, str] = {}
+        self,
+        tid: TileID,
+        tile_url: str,
+        params: Dict[str, str] = {},
+        cache_key: Optional[TileKey] = None,
+        resolution: Optional[int] = None,
     ) -> Optional[Tile]:
-        res = requests.get(self.base_url + tile_url, params=params)
+        """
+        Downloads a tile from a url relative to base_url.
+        Args:
+            tid (TileID): tile id of the tile being downloaded.
+            tile_url (str): url of the tile, relative to base_url.
+            params (Dict[str, str], optional): url parameters. Defaults to {}.
+            cache_key (TileKey, optional): If set, and this map has a tile_cache, the cache is checked before downloading and filled after.
+            resolution (int, optional): Size the tile is needed at, if smaller than the tile downloaded. It's decoded straight to this size. Defaults to None, full size.
+        Returns:
+            Optional[Tile]: The tile, or None if the download failed.
+        """
+        img = self.cached_tile_image(cache_key, resolution)
+        if img is not None:
+            return Tile(tid=tid, img=img, name=self.map_name)
+        pyramid = self.pyramid_levels > 0 and cache_key is not None
+        if pyramid:
+            tile = self.tile_from_children(tid, cache_key, resolution)
+            if tile is not None:
+                return tile
+        res = self.session.get(self.base_url + tile_url, params=params)
         if res.status_code == 200:
-            img = imager.image_from_response(res)
+            img = imager.image_from_response(res, resolution)
+            img = self.cache_image(_image_key(cache_key, resolution), img)
+            if self.tile_cache is not None and cache_key is not None:
+                self.tile_cache.put(cache_key, res.content)
             tile = Tile(tid=tid, img=img, name=self.map_name)
             return tile
         else:
             print(res.status_code, res.url)
+            if pyramid:
+                return self.tile_from_parent(tid, cache_key, resolution)
+            return None
+
+    def revalidating_get(
+        self, url: str, cache_key: Optional[TileKey], **kwargs: Any
+    ) -> requests.Response:
+        """
+        GETs a tile that changes now and then, like an overlay, through tile_cache.
+        Tiles cached less than max_age seconds ago are served without a request.
+        Older ones are revalidated with a conditional request (If-None-Match and If-Modified-Since), and served from the cache if the server answers 304.
+        Args:
+            url (str): The tile's url.
+            cache_key (TileKey): Key of the tile in tile_cache. None, or no tile_cache, is a plain GET.
+            kwargs: Passed on to the request.
+        Returns:
+            requests.Response: The response. Tiles served from the cache have a status of 304 and the cached bytes as their content.
+        """
+        if self.tile_cache is None or cache_key is None:
+            return self.session.get(url, **kwargs)
+        entry = self.tile_cache.get_entry(cache_key)
+        if entry is not None and time() - entry.stored < self.max_age:
+            self.revalidation.record_fresh(len(entry.data))
+            return _cached_response(url, entry.data)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        start = perf_counter()
+        res = self.session.get(url, headers=headers, **kwargs)
+        seconds = perf_counter() - start
+        validators = {
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+        }
+        if res.status_code == 304 and entry is not None:
+            res._content = entry.data
+            self.tile_cache.revalidated(cache_key, validators)
+            self.revalidation.record(304, seconds, saved=len(entry.data))
+        elif res.status_code == 200:
+            self.tile_cache.put(cache_key, res.content, validators)
+            self.revalidation.record(200, seconds, stale=entry is not None)
+        return res
+
+    def fresh_image(self, cache_key: Optional[TileKey]) -> Optional["Image"]:
+        """
+        Returns the decoded image of a tile fetched with revalidating_get() from image_cache, if it's still fresh.
+        Images of tiles older than max_age aren't returned, so the tile is revalidated rather than served from memory indefinitely.
+        """
+        if self.image_cache is None or cache_key is None:
+            return None
+        if self.tile_cache is None:
+            return self.cached_image(cache_key)
+        stored = self.tile_cache.stored(cache_key)
+        if stored is None or time() - stored[0] >= self.max_age:
+            return None
+        img = self.cached_image(cache_key)
+        if img is not None:
+            self.revalidation.record_fresh(stored[1])
+        return img
+
+    def revalidated_image(
+        self, res: requests.Response, cache_key: Optional[TileKey]
+    ) -> "Image":
+        """
+        Decodes a 200 or 304 response from revalidating_get(). Tiles that weren't modified reuse their image from image_cache, if it's still there.
+        """
+        img = None
+        if res.status_code == 304 and self.image_cache is not None:
+            if cache_key is not None and cache_key in self.image_cache:
+                img = self.cached_image(cache_key)
+        if img is None:
+            img = self.cache_image(cache_key, imager.image_from_response(res))
+        return img
+
+    def cached_tile_image(
+        self, cache_key: Optional[TileKey], resolution: Optional[int] = None
+    ) -> Optional["Image"]:
+        """
+        Returns a tile's image from image_cache, or decoded from tile_cache, or None if neither has it. Never downloads anything.
+        Args:
+            cache_key (TileKey): Key of the downloaded tile.
+            resolution (int, optional): Size the tile is needed at, see download_tile_url(). Defaults to None, full size.
+        """
+        if cache_key is None:
+            return None
+        image_key = _image_key(cache_key, resolution)
+        img = self.cached_image(image_key)
+        if img is None and self.tile_cache is not None:
+            data = self.tile_cache.get(cache_key)
+            if data is not None:
+                img = imager.image_from_bytes(data, resolution)
+                img = self.cache_image(image_key, img)
+        if img is None and image_key != cache_key:
+            # Only decoded at full size, so scale that down.
+            full = self.cached_image(cache_key)
+            if full is not None:
+                img = imager.resize_square(full, resolution, quality=1)
+        return img
+
+    def has_cached_tile(
+        self, cache_key: TileKey, resolution: Optional[int] = None
+    ) -> bool:
+        """
+        True if the tile's bytes are cached, or its image is at full size or resolution. Doesn't count as a cache hit or miss.
+        """
+        if self.tile_cache is not None and cache_key in self.tile_cache:
+            return True
+        if self.image_cache is None:
+            return False
+        image_key = _image_key(cache_key, resolution)
+        return cache_key in self.image_cache or image_key in self.image_cache
+
+    def tile_from_children(
+        self, tid: TileID, cache_key: TileKey, resolution: Optional[int] = None
+    ) -> Optional[Tile]:
+        """
+        Builds a tile from its 4 children, if they're all cached. The children are decoded at half size, so they only need pasting together.
+        Returns:
+            Optional[Tile]: The tile, or None if any of the children aren't cached.
+        """
+        children = tid.normalized.children
+        keys = [cache_key._replace(z=c.z, x=c.x, y=c.y) for c in children]
+        size = resolution or cache_key.resolution
+        half = size // 2 if size else None
+        if not all(self.has_cached_tile(k, half) for k in keys):
+            return None
+        tiles = []
+        for child, key in zip(children, keys):
+            img = self.cached_tile_image(key, half)
+            if img is None:
+                return None
+            tiles.append(Tile(child, img=img, name=self.map_name))
+        parent = make_parent(tiles, size)
+        img = self.cache_image(_image_key(cache_key, resolution), parent.img)
+        return Tile(tid=tid, img=img, name=self.map_name)
+
+    def tile_from_parent(
+        self, tid: TileID, cache_key: TileKey, resolution: Optional[int] = None
+    ) -> Optional[Tile]:
+        """
+        Builds a tile by scaling up part of the closest cached tile up to pyramid_levels zoom levels out.
+        The result is blurrier than the real tile, so it isn't cached.
+        Returns:
+            Optional[Tile]: The tile, or None if there isn't a cached tile to build it from.
+        """
+        target = tid.normalized
+        ancestor = target
+        size = resolution or cache_key.resolution
+        for _ in range(self.pyramid_levels):
+            ancestor = ancestor.parent
+            if ancestor is None:
+                break
+            key = cache_key._replace(z=ancestor.z, x=ancestor.x, y=ancestor.y)
+            if not self.has_cached_tile(key):
+                continue
+            img = self.cached_tile_image(key)
+            if img is None:
+                continue
+            child = make_child(Tile(ancestor, img=img), target, size)
+            if child is not None:
+                print(f"{self.map_name} tile {tid} built from cached {ancestor}.")
+                return Tile(tid=tid, img=child.img, name=self.map_name)
+        return None
+
+    def cached_image(self, cache_key: Optional[TileKey]) -> Optional["Image"]:
+        """
+        Returns a copy-on-write view of a decoded tile from image_cache, or None if there isn't one.
+        """
+        if self.image_cache is None or cache_key is None:
             return None
+        return self.image_cache.get(cache_key)
+
+    def cache_image(self, cache_key: Optional[TileKey], img: "Image") -> "Image":
+        """
+        Stores a decoded tile in image_cache, if there is one.
+        Returns:
+            Image: The image to use from now on. Cached images are replaced by a copy-on-write view.
+        """
+        if self.image_cache is None or cache_key is None:
+            return img
+        return self.image_cache.put(cache_key, img)
+
+    def cached_lookup(
+        self,
+        endpoint: str,
+        key: Any,
+        fetch: Callable[[], Any],
+        encode: Callable[[Any], Any] = lambda v: v,
+        decode: Callable[[Any], Any] = lambda v: v,
+    ) -> Any:
+        """
+        Makes a metadata lookup through metadata_cache, if there is one. See MetadataCache.get_or_fetch().
+        """
+        if self.metadata_cache is None:
+            return fetch()
+        return self.metadata_cache.get_or_fetch(endpoint, key, fetch, encode, decode)
 
     def get_bbox_meta(self, bbox_url: str, url_params: Dict = {}) -> requests.Response:
         try:
-            res = requests.get(self.base_url + bbox_url, params=url_params).json()
+            res = self.session.get(self.base_url + bbox_url, params=url_params).json()
         except JSONDecodeError:
             return None
         bounding_values = LatLonBBox(0, 0, 0, 0).all_aliases
@@ -71,8 +422,13 @@ class BaseMap:
             self.message = message
             super().__init__(self.message)
 
+    class TileFetchError(Exception):
+        def __init__(self, message="Tile download failed.") -> None:
+            self.message = message
+            super().__init__(self.message)
+
     def rget(self, url, **kwargs):
-        return requests.get(url, **kwargs)
+        return self.session.get(url, **kwargs)
 
     def find_image_bbox(
         self, test_img: Union["Image", Tile], zoom: int = 0
@@ -92,10 +448,8 @@ class BaseMap:
         if isinstance(test_img, Tile):
             test_img = test_img.img
         tile_size = test_img.size[0]
-        bbox = test_img.getbbox()
+        bbox, swapped_bbox = imager.wrapped_content_bboxes(test_img)
         print("bbox:", bbox)
-        swapped_image = swap_left_right(test_img)
-        swapped_bbox = swapped_image.getbbox()
 
         if zoom > 0 or swapped_bbox.area >= bbox.area:
             res = bounding_pixels_to_lat_lon(bbox, zoom, tile_size)
@@ -129,40 +483,272 @@ class BaseMap:
         bg_layer: "BaseMap",
         fg_layer: "BaseMap",
         map_size: int,
-        range_tiles: List[TileArray],
+        range_tiles: TileArray,
         transparency: int = 200,
+        bg_tiles: Optional[Dict[TileID, Tile]] = None,
+        stats: Optional["RenderStats"] = None,
     ) -> Image:
         """
         Generates a range map with the given foreground layer and background layer
+        The crop is found from the foreground layer first, so only the background tiles inside the crop are downloaded.
         Args:
             bg_layer (BaseMap): Map layer
             fg_layer (BaseMap): Range map layer
             map_size (int): Size of the map, in pixels.
-            range_tiles (List[TileArray]): Tiles to generate the map for.
+            range_tiles (TileArray): Tiles to generate the map for. May cross the antimeridian.
             transparency (int, optional): Transparency of the range layer. Defaults to 200.
+            bg_tiles (Dict[TileID, Tile], optional): Background tiles that have already been fetched. Only the missing ones inside the crop are downloaded.
+            stats (RenderStats, optional): Stats to add this render's counters and stage times to. A new one is made if not given.
+        Returns:
+            Image: Finished range map. Its info["render_stats"] is the RenderStats for this render.
+        """
+        stats = stats if stats is not None else RenderStats()
+        bg_tiles = bg_tiles if bg_tiles is not None else {}
+        tile_size = fg_layer._tile_size
+        with stats.stage("crop"):
+            fg_image = range_tiles._composite_all()
+            content = range_tiles.content_bbox
+            fitted, center = find_crop_bounds(fg_image, map_size, content)
+            window = fitted.pillow
+
+        bg_image = None
+        if bg_layer.fetches_windows:
+            with stats.stage("basemap_window"):
+                bg_image = bg_layer.get_window(range_tiles, window, tile_size)
+            stats.bg_requests = 1
+        if bg_image is None:
+            bg_image = BaseMap._background_from_tiles(
+                bg_layer, range_tiles, window, tile_size, bg_tiles, stats
+            )
+
+        with stats.stage("composite"):
+            # Only the part of the window with range pixels is blended, empty tiles are skipped completely.
+            cropped = bg_image.copy()
+            region = _intersection(content.pillow, window) if content else None
+            if region is not None:
+                left, top = region[0] - window[0], region[1] - window[1]
+                box = (
+                    left,
+                    top,
+                    left + region[2] - region[0],
+                    top + region[3] - region[1],
+                )
+                blended = imager.transparency_composite(
+                    bg_image.crop(box), fg_image.crop(region), transparency
+                )
+                cropped.paste(blended, box)
+        print(f"range map: {stats}")
+        cropped.info["render_stats"] = stats
+        return cropped
+
+    @staticmethod
+    def _background_from_tiles(
+        bg_layer: "BaseMap",
+        range_tiles: TileArray,
+        window: Tuple[int, int, int, int],
+        tile_size: int,
+        bg_tiles: Dict[TileID, Tile],
+        stats: "RenderStats",
+    ) -> "Image":
+        """
+        Builds the background under a crop window from tiles, downloading the ones overlapping the window that aren't in bg_tiles.
+        """
+        # Tiles that failed to prefetch aren't tried again, they'd most likely fail again.
+        skip = set(bg_tiles) | set(getattr(bg_tiles, "failed", {}))
+        # Find which background tiles overlap the crop.
+        positions = {}
+        needed = []
+        for tid in range_tiles:
+            x = (tid.x - range_tiles.x_min) * tile_size
+            y = (tid.y - range_tiles.y_min) * tile_size
+            positions[tid] = (x, y)
+            inside = _overlaps((x, y, x + tile_size, y + tile_size), window)
+            if inside and tid not in skip:
+                needed.append(tid)
+        if needed:
+            with stats.stage("basemap_crop"):
+                fetched = bg_layer.get_tiles(needed, resolution=tile_size)
+                bg_tiles = {**bg_tiles, **fetched}
+        stats.bg_tiles_fetched = len(skip) + len(needed)
+        stats.bg_tiles_saved = len(positions) - stats.bg_tiles_fetched
+        stats.bg_requests += stats.bg_tiles_fetched
+
+        with stats.stage("basemap_composite"):
+            placed = [
+                (positions[tid], t.img)
+                for tid, t in bg_tiles.items()
+                if tid in positions
+            ]
+            mode = placed[0][1].mode if placed else "RGB"
+            return imager.composite_window(placed, window, mode)
+
+    @property
+    def fetches_windows(self) -> bool:
+        """
+        True if get_window() fetches a range map's background in one request, so its tiles shouldn't be fetched.
+        """
+        return False
+
+    def get_window(
+        self, tile_array: TileArray, window: Tuple[int, int, int, int], tile_size: int
+    ) -> Optional["Image"]:
+        """
+        Fetches this map under a pixel window of a TileArray's mosaic as one image, for maps that can.
+        Args:
+            tile_array (TileArray): Tiles the window is in. May cross the antimeridian.
+            window (Tuple[int, int, int, int]): (left, top, right, bottom) of the window, in pixels of the mosaic.
+            tile_size (int): Size of the mosaic's tiles.
+        Returns:
+            Optional[Image]: Image of the window. None if it can't be fetched, and the tiles should be used instead.
+        """
+        return None
+
+    def render_range_map(
+        self,
+        bg_layer: "BaseMap",
+        plan: TileArray,
+        bbox: LatLonBBox,
+        fetch: Callable[[TileArray], TileArray],
+        map_size: int,
+        stats: Optional["RenderStats"] = None,
+    ) -> Image:
+        """
+        Renders a range map from a tile plan, fetching this (foreground) layer and the background layer at the same time.
+        The background tiles covering the range's bounding box are fetched alongside the foreground, as they're almost always inside the crop.
+        Any others needed for the crop are fetched once the crop is known.
+        If the background layer fetches windows, nothing is prefetched, and the crop window is fetched as one image instead.
+        Args:
+            bg_layer (BaseMap): Map layer.
+            plan (TileArray): Tiles to generate the map for, from get_bbox_tiles().
+            bbox (LatLonBBox): Bounding box of the range.
+            fetch (Callable[[TileArray], TileArray]): Fetches the foreground tiles for the plan.
+            map_size (int): Size of the map, in pixels.
+            stats (RenderStats, optional): Stats to add this render's counters and stage times to.
         Returns:
             Image: Finished range map.
         """
-        high_res = True if fg_layer._tile_size == 512 else False
-        bg_tiles = [
-            bg_layer.get_tiles(a.copy(), high_res=high_res) for a in range_tiles
-        ]
-        if len(range_tiles) == 2:
-            left = range_tiles[0]._composite_all()
-            right = range_tiles[1]._composite_all()
-            fg_layer = imager.paste_halves(left, right)
-            m_left = bg_tiles[0]._composite_all()
-            m_right = bg_tiles[1]._composite_all()
-            bg_layer = imager.paste_halves(m_left, m_right)
-        else:
-            fg_layer = range_tiles[0]._composite_all()
-            bg_layer = bg_tiles[0]._composite_all()
-        fitted, center = find_crop_bounds(fg_layer, map_size)
-        uncropped_image = imager.transparency_composite(
-            bg_layer, fg_layer, transparency
+        stats = stats if stats is not None else RenderStats()
+        bounds = (bbox.left, bbox.bottom, bbox.right, bbox.top)
+        covered = {
+            TileID.fast(t.z, t.x, t.y) for t in mercantile.tiles(*bounds, plan.zoom)
+        }
+        # mercantile only gives x in [0..2 ** z), the plan's tiles may wrap past that.
+        likely = [tid for tid in plan if tid.normalized in covered]
+        if bg_layer.fetches_windows:
+            # The window is fetched once the crop is known.
+            likely = []
+        fg_future = stats.run_stage("overlay", fetch, plan)
+        bg_future = stats.run_stage(
+            "basemap", bg_layer.get_tiles, likely, resolution=self._tile_size
         )
-        cropped = uncropped_image.crop(fitted.pillow)
-        return cropped
+        range_tiles = fg_future.result()
+        bg_tiles = bg_future.result()
+        return self.generate_range_map(
+            bg_layer, self, map_size, range_tiles, bg_tiles=bg_tiles, stats=stats
+        )
+
+
+def _image_key(
+    cache_key: Optional[TileKey], resolution: Optional[int]
+) -> Optional[TileKey]:
+    """
+    Key for a tile's decoded image in image_cache. The downloaded bytes are the same whatever size they're decoded at, the decoded image isn't.
+    """
+    if cache_key is None or resolution is None:
+        return cache_key
+    return cache_key._replace(resolution=resolution)
+
+
+def _bbox_to_json(bbox: LatLonBBox) -> Dict[str, float]:
+    return {
+        "left": bbox.left,
+        "top": bbox.top,
+        "right": bbox.right,
+        "bottom": bbox.bottom,
+    }
+
+
+def _bbox_from_json(d: Dict[str, float]) -> LatLonBBox:
+    return LatLonBBox(**d)
+
+
+def _cached_response(url: str, data: bytes) -> requests.Response:
+    """
+    A 304 response carrying a tile's cached bytes, for tiles revalidating_get() didn't need to ask the server for.
+    """
+    res = requests.Response()
+    res.status_code = 304
+    res.url = url
+    res._content = data
+    return res
+
+
+def _overlaps(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> bool:
+    """
+    True if two (left, top, right, bottom) pixel boxes overlap.
+    """
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _intersection(
+    a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]
+) -> Optional[Tuple[int, int, int, int]]:
+    """
+    The overlap of two (left, top, right, bottom) pixel boxes, or None if they don't overlap.
+    """
+    if not _overlaps(a, b):
+        return None
+    return (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+
+
+@dataclass
+class RenderStats:
+    """
+    Counters and timings for a single range map render. Attached to the finished image as image.info["render_stats"].
+    """
+
+    # Background tiles downloaded (or read from cache) for the render.
+    bg_tiles_fetched: int = 0
+    # Background tiles skipped because they fall outside the final crop.
+    bg_tiles_saved: int = 0
+    # Background requests made, one per tile or one for a whole window. Tiles read from a cache count too.
+    bg_requests: int = 0
+    # Wall time, in seconds, of each stage of the render. Stages can overlap.
+    stage_times: Dict[str, float] = field(default_factory=dict)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Times the body of the with statement as the named stage.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_times[name] = perf_counter() - start
+
+    def run_stage(
+        self, name: str, func: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> Future:
+        """
+        Starts a stage in the background, so it can run alongside stages it doesn't depend on.
+        Returns:
+            Future: The stage's result.
+        """
+
+        def timed() -> Any:
+            with self.stage(name):
+                return func(*args, **kwargs)
+
+        return _stage_pool.submit(timed)
+
+    def __str__(self) -> str:
+        times = ", ".join(f"{k}: {v:.2f}s" for k, v in self.stage_times.items())
+        return f"bg tiles fetched: {self.bg_tiles_fetched}, saved: {self.bg_tiles_saved}, bg requests: {self.bg_requests}. Stages: {times}."
+
+
+# Runs render stages. Separate from the map providers' pools, as stages wait on those.
+_stage_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="render-stage")
 
 
 @dataclass
@@ -173,12 +759,69 @@ class MapBox(BaseMap):
     style: str = "satellite"
     high_res: bool = True
     map_name: str = "mapbox"
+    pyramid_levels: int = 2
+    # If set, tiles in the atlas are read from it instead of being downloaded or cached.
+    atlas: Optional[TileAtlas] = None
+    # If set, range map backgrounds are fetched as one image of the crop window from the Static Images API, instead of tile by tile.
+    static_images: bool = False
+    # Style the Static Images API uses, which names styles differently to the tile API.
+    static_style: str = "mapbox/satellite-v9"
+    # Largest width or height the Static Images API serves.
+    _static_max_size: int = field(default=1280, init=False, repr=False)
+
+    @property
+    def fetches_windows(self) -> bool:
+        return self.static_images
+
+    def get_window(
+        self, tile_array: TileArray, window: Tuple[int, int, int, int], tile_size: int
+    ) -> Optional["Image"]:
+        """
+        Fetches the window from the Static Images API, centered on the window's middle and zoomed to match the mosaic's scale.
+        See BaseMap.get_window().
+        """
+        if not self.static_images:
+            return None
+        if not self.token:
+            raise self.AuthMissingError("Mapbox auth token not set.")
+        left, top, right, bottom = window
+        width, height = right - left, bottom - top
+        if max(width, height) > self._static_max_size:
+            return None
+        center = geo.Pixel(
+            tile_array.x_min * tile_size + (left + right) / 2,
+            tile_array.y_min * tile_size + (top + bottom) / 2,
+        )
+        lat, lon = geo.pixels_to_lat_lon(center, tile_array.zoom, tile_size, False)
+        # Wrapped tiles give longitudes past 180.
+        lon = (lon + 180) % 360 - 180
+        # The Static Images API uses 512px tiles.
+        zoom = tile_array.zoom + math.log2(tile_size / 512)
+        url = f"styles/v1/{self.static_style}/static/{lon:.6f},{lat:.6f},{zoom:.4f}/{width}x{height}"
+        print("murl:", self.base_url + url)
+        params = {"access_token": self.token}
+        try:
+            res = self.session.get(self.base_url + url, params=params)
+        except requests.RequestException as e:
+            print(f"mapbox static image failed: {e}")
+            return None
+        if res.status_code != 200:
+            print(res.status_code, res.url)
+            return None
+        try:
+            img = imager.image_from_response(res)
+        except imager.ImageLoadError as e:
+            print(f"mapbox static image couldn't be loaded: {e}")
+            return None
+        if img.size != (width, height):
+            print(f"mapbox static image is {img.size}, not {(width, height)}.")
+            return None
+        return img.convert("RGB")
 
     def get_tiles(self, tile_ids: List[TileID], **kwargs) -> TileArray:
-        tile_array = TileArray(name="Mapbox")
-        for tid in tile_ids:
-            tile_array[tid] = self.get_tile(tid, **kwargs)
-        return tile_array
+        return self.fetch_tiles(
+            tile_ids, lambda tid: self.get_tile(tid, **kwargs), name="Mapbox"
+        )
 
     def get_tile(self, tid: TileID, **kwargs) -> Tile:
         """
@@ -189,6 +832,7 @@ class MapBox(BaseMap):
             fmt (str, optional): mapbox format. Defaults to "jpg90".
             style (str, optional): mapbox style. Defaults to "satellite".
             high_res (bool, optional): Enable high res (512x512) mode. Defaults to True.
+            resolution (int, optional): Size the tile is needed at. Picks high_res by whether a 256x256 tile is big enough, unless a high res tile is already cached. Smaller tiles are decoded straight to this size.
         Raises:
             self.TokenMissingError: If there isn't a token.
         Returns:
@@ -203,12 +847,32 @@ class MapBox(BaseMap):
             style = kwargs["style"]
         if "high_res" in kwargs:
             high_res = kwargs["high_res"]
+        resolution = kwargs.get("resolution")
 
-        z, x, y = tid
+        # Only the url and cache key use the wrapped x, the tile keeps its place in the array.
+        z, x, y = tid.normalized
+        if resolution is not None:
+            # Download the smallest tile that's big enough. A high res tile that's already cached is decoded down instead.
+            high_res_key = TileKey(self.map_name, style, fmt, 512, z, x, y)
+            high_res = resolution > 256 or (
+                high_res
+                and (
+                    self.has_cached_tile(high_res_key)
+                    or (self.atlas is not None and high_res_key in self.atlas)
+                )
+            )
         # If the resolution is douled, MapBox only server every 2nd zoom level.
         # So if we're in this state, we need to take the next higher zoom level.
         # if high_res and z % 2 != 0:
         #     z += 1
+        served = 512 if high_res else 256
+        cache_key = TileKey(self.map_name, style, fmt, served, z, x, y)
+        if resolution is not None and resolution >= served:
+            resolution = None
+        if self.atlas is not None:
+            img = self.atlas.get(cache_key, resolution)
+            if img is not None:
+                return Tile(tid=tid, img=img, name=self.map_name)
         if not self.token:
             raise self.AuthMissingError("Mapbox auth token not set.")
         params = {"access_token": self.token}
@@ -217,8 +881,13 @@ class MapBox(BaseMap):
             hr = "@2x"
         url = f"v4/mapbox.{style}/{z}/{x}/{y}{hr}.{fmt}"
         print("murl:", self.base_url + url)
-        tile_id = TileID(z=z, x=x, y=y)
-        tile = self.download_tile_url(tid=tile_id, tile_url=url, params=params)
+        tile = self.download_tile_url(
+            tid=tid,
+            tile_url=url,
+            params=params,
+            cache_key=cache_key,
+            resolution=resolution,
+        )
         return tile
 
     def get_geocode(
@@ -243,7 +912,7 @@ class MapBox(BaseMap):
         if bbox:
             params["bbox"] = ",".join(bbox)
         url = f"geocoding/v5/mapbox.places/{input_string}.json?"
-        res = requests.get(self.base_url + url, params=params).json()
+        res = self.session.get(self.base_url + url, params=params).json()
         lat_lon = res["features"][0]["center"]
         return LatLon(*lat_lon)
 
@@ -266,6 +935,8 @@ class GBIF(BaseMap):
             "squareSize": 32,
         }
     )
+    # Tiles GBIF has no data for (204 responses), keyed by the tile and every parameter, taxon key included. None turns it off.
+    empty_tiles: Optional[EmptyTileCache] = field(default_factory=EmptyTileCache)
     # Currently doesn't support vector tiles.
     _tile_size: int = field(default=512, init=False, repr=True)
 
@@ -284,12 +955,10 @@ class GBIF(BaseMap):
         funcmap = {"hex": self.get_hex_tile, "square": self.get_square_tile}
         func = funcmap.get(mode, self.get_hex_tile)
 
-        new_tilearray = TileArray()
-        for tid in tile_array:
-            # TODO: this call can return None on HTTP errors. Handle that.
-            tile = func(tile_id=tid, **params)
-            new_tilearray[tid] = tile
-        return new_tilearray
+        # Tiles that fail are recorded in the returned TileArray's failed dict.
+        return self.fetch_tiles(
+            tile_array, lambda tid: func(tile_id=tid, **params), name="GBIF"
+        )
 
     def _get_tile(self, tile_id: TileID = None, **params) -> Tile:
         """
@@ -311,20 +980,31 @@ class GBIF(BaseMap):
         taxon_key = params.get("taxonKey", "None")
         if params.get("tile_size", None):
             params.pop("tile_size")
-        url = f"v2/map/occurrence/density/{tile_id.z}/{tile_id.x}/{tile_id.y}{fmt}"
-        resp = requests.get(self.base_url + url, params=params)
+        url = f"v2/map/occurrence/density/{tile_id.normalized.urlform}{fmt}"
+        # Every parameter changes the tile's contents, so they all go in the key.
+        layer = "&".join(f"{k}={v}" for k, v in sorted(params.items()))
+        cache_key = TileKey(self.map_name, layer, fmt, None, *tile_id.normalized)
+        name = f"gbifmap_{taxon_key}"
+        if self.empty_tiles is not None and self.empty_tiles.is_empty(cache_key):
+            return Tile.new_empty(tile_id, self._tile_size, name=name)
+        img = self.fresh_image(cache_key)
+        if img is not None:
+            return Tile(tile_id, img=img, name=name)
+        resp = self.revalidating_get(self.base_url + url, cache_key, params=params)
         print("gurl:", resp.url)
         sc = resp.status_code
         if sc in (200, 304):
-            img = imager.image_from_response(resp)
+            img = self.revalidated_image(resp, cache_key)
         # the gbif api seems to return this in both error conditions and when there legitimately isn't any data.
         elif sc == 204:
-            img = imager.blank("RGBA", (self._tile_size, self._tile_size)), True
+            if self.empty_tiles is not None:
+                self.empty_tiles.add(cache_key)
+            return Tile.new_empty(tile_id, self._tile_size, name=name)
         else:
             if self.noisy_http_errors:
                 resp.raise_for_status()
             return None
-        return Tile(tile_id, img=img, name=f"gbifmap_{taxon_key}")
+        return Tile(tile_id, img=img, name=name)
 
     def get_hex_tile(self, tile_id: TileID, **params) -> Tile:
         """
@@ -365,18 +1045,25 @@ class GBIF(BaseMap):
         Returns:
             Optional[Tuple[str, str]]: ("species", "taxon_key") or (None, None)
         """
+        # Not found is None from _lookup_species, so it isn't cached and a later lookup tries again.
+        res = self.cached_lookup(
+            "gbif.species", name, lambda: self._lookup_species(name), decode=tuple
+        )
+        return (None, None) if res is None else res
+
+    def _lookup_species(self, name: str) -> Optional[Tuple[str, str]]:
         name = requests.utils.quote(name)
         u = f"{self.base_url}v1/species/search/?q={name}&rank=SPECIES&limit=1&datasetKey={self.dataset_key}"
-        r = requests.get(u)
+        r = self.session.get(u)
         # print("url", u)
         # print("r", r, r.json())
         if r.json()["count"] == 0:
-            return (None, None)
+            return None
         r = r.json()["results"][0]
         if "nubKey" in r.keys():
             res = (r["species"], r["nubKey"])
         else:
-            return (None, None)
+            return None
         return res
 
     def get_bbox(self, taxon_key: int) -> LatLonBBox:
@@ -389,7 +1076,13 @@ class GBIF(BaseMap):
         """
         params = {"taxonKey": taxon_key}
         url = "v2/map/occurrence/density/capabilities.json"
-        metadata = self.get_bbox_meta(url, params)
+        metadata = self.cached_lookup(
+            "gbif.bbox",
+            taxon_key,
+            lambda: self.get_bbox_meta(url, params),
+            _bbox_to_json,
+            _bbox_from_json,
+        )
         left = metadata.left
         right = metadata.right
         top = metadata.top
@@ -400,10 +1093,18 @@ class GBIF(BaseMap):
     def make_map(
         self, taxon_key: str, mapbox: MapBox, map_size: int = 512, start_zoom: int = 0
     ) -> "Image":
-        range_bbox = self.get_bbox(taxon_key)
-        range_tiles = self.get_bbox_tiles(range_bbox, size=map_size // 2)
-        range_map = self.generate_range_map(mapbox, self, map_size, range_tiles)
-        return range_map
+        stats = RenderStats()
+        with stats.stage("bbox"):
+            range_bbox = self.get_bbox(taxon_key)
+        plan = self.get_bbox_tiles(range_bbox, size=map_size // 2)
+        return self.render_range_map(
+            mapbox,
+            plan,
+            range_bbox,
+            lambda a: self.get_tiles(taxon_key, a),
+            map_size,
+            stats,
+        )
 
 
 @dataclass
@@ -412,6 +1113,9 @@ class eBirdMap(BaseMap):
     base_url: str = "https://ebird.org/map/"
     map_tile_url: str = "https://geowebcache.birds.cornell.edu/ebird/gmaps"
     species_url: str = "https://ebird.org/species/"
+    # If set, the range layer for a whole plan is fetched from this WMS endpoint with one GetMap request, instead of tile by tile.
+    # It has to serve the same layer as map_tile_url in EPSG:3857. If the request fails, the tiles are fetched one by one.
+    wms_url: Optional[str] = None
     _tile_size: int = field(default=256, init=False, repr=True)
     """
     Generates an eBird range map.
@@ -421,60 +1125,193 @@ class eBirdMap(BaseMap):
     def get_bbox(self, species_code: str) -> LatLonBBox:
         params = {"rsid": "", "speciesCode": species_code}
         endpoint = "env"
-        bbox = self.get_bbox_meta(endpoint, params)
+        bbox = self.cached_lookup(
+            "ebird.env",
+            species_code,
+            lambda: self.get_bbox_meta(endpoint, params),
+            _bbox_to_json,
+            _bbox_from_json,
+        )
         print("ebird bbox: ", bbox)
         return bbox
 
     def get_rsid(self, species_code: str, zoom: int = 0) -> str:
         grid_scale = 20 if zoom >= 6 else 100
+        return self.cached_lookup(
+            "ebird.rsid",
+            f"{species_code}/{grid_scale}",
+            lambda: self._get_rsid(species_code, grid_scale),
+        )
+
+    def _get_rsid(self, species_code: str, grid_scale: int) -> Optional[str]:
         url = self.base_url + "rsid"
         params = {
             "speciesCode": species_code,
             "gridScale": grid_scale,
         }
         resp = self.rget(url, params=params)
+        # Not cached, whatever the error page says.
+        if resp.status_code != 200:
+            return None
         try:
             return resp.content.decode("ascii")
         except Exception:
             return None
 
-    def get_tiles(self, species_code: str, zoom: int = 0, map_size: int = 512):
-        bbox = self.get_bbox(species_code)
+    def get_tiles(
+        self, species_code: str, zoom: int = 0, map_size: int = 512
+    ) -> TileArray:
+        tiles, rsid, _ = self.plan_tiles(species_code, zoom, map_size)
+        if not tiles:
+            return tiles
+        return self.fetch_range_layer(tiles, rsid)
+
+    def plan_tiles(
+        self,
+        species_code: str,
+        zoom: int = 0,
+        map_size: int = 512,
+        stats: Optional[RenderStats] = None,
+    ) -> Tuple[TileArray, Optional[str], Optional[LatLonBBox]]:
+        """
+        Finds the tiles, rsid and bounding box for a species' range map, without downloading any tiles.
+        The bounding box and rsid lookups run at the same time.
+        Returns:
+            Tuple[TileArray, Optional[str], Optional[LatLonBBox]]: (tiles, rsid, bbox). tiles is empty if there's no range data.
+        """
+        stats = stats if stats is not None else RenderStats()
+        bbox_future = stats.run_stage("bbox", self.get_bbox, species_code)
+        rsid_future = stats.run_stage("rsid", self.get_rsid, species_code, 0)
+        bbox = bbox_future.result()
         if not bbox:
-            return []
+            return TileArray(), None, None
         tiles = self.get_bbox_tiles(bbox, zoom, map_size)
+        rsid = rsid_future.result()
         # eBird doesn't handle crossing the antimeridian well, so we need to "improvise" one.
-        rsid = ""
         if not tiles:
-            rsid = self.get_rsid(species_code, 0)
             proxy_tile = self.download_tile(TileID(0, 0, 0), rsid)
-            _, _, proxy_bbox = self.find_image_bbox(proxy_tile.img, 0)
-            print("proxy bbox:", proxy_bbox)
-            tiles = self.get_bbox_tiles(proxy_bbox, zoom, map_size, True)
+            _, _, bbox = self.find_image_bbox(proxy_tile.img, 0)
+            print("proxy bbox:", bbox)
+            tiles = self.get_bbox_tiles(bbox, zoom, map_size, True)
             print("ebgt2")
             pprint(tiles)
-        if tiles[0].zoom >= 6 or not rsid:
-            rsid = self.get_rsid(species_code, tiles[0].zoom)
+        # The rsid above was for the zoomed out grid, zoomed in maps need the finer one.
+        if tiles.zoom >= 6 or not rsid:
+            with stats.stage("rsid_zoomed"):
+                rsid = self.get_rsid(species_code, tiles.zoom)
+        return tiles, rsid, bbox
+
+    def fetch_range_layer(self, tile_array: TileArray, rsid: str) -> TileArray:
+        """
+        Fetches the range layer for a plan, with fetch_range_window() if wms_url is set, otherwise with fetch_range_tiles().
+        """
+        if self.wms_url:
+            return self.fetch_range_window(tile_array, rsid)
+        return self.fetch_range_tiles(tile_array, rsid)
+
+    def fetch_range_tiles(self, tile_array: TileArray, rsid: str) -> TileArray:
+        return self.fetch_tiles(
+            tile_array, lambda tid: self.download_tile(tid, rsid), name="eBird"
+        )
 
-        filled_tiles = [
-            TileArray.from_dict({tid: self.download_tile(tid, rsid) for tid in a})
-            for a in tiles
-        ]
-        return filled_tiles
+    def fetch_range_window(self, tile_array: TileArray, rsid: str) -> TileArray:
+        """
+        Fetches the range layer for every tile in tile_array as one image from wms_url, and splits it back into tiles.
+        That's one request instead of one per tile, or two if the tiles cross the antimeridian, one for each side.
+        Args:
+            tile_array (TileArray): Tiles to fetch, from get_bbox_tiles().
+            rsid (str): Result set id of the range, from get_rsid().
+        Returns:
+            TileArray: The tiles. If any request fails, they're all fetched with fetch_range_tiles() instead.
+        """
+        z = tile_array.zoom
+        world = 1 << z
+        size = self._tile_size
+        x_dim, y_dim = tile_array.xy_dims
+        mosaic = None
+        x = tile_array.x_min
+        while x <= tile_array.x_max:
+            # The window can't wrap, so split it at the antimeridian.
+            end = min(tile_array.x_max, (x // world + 1) * world - 1)
+            img = self.download_window(
+                z, x % world, end % world, tile_array.y_min, tile_array.y_max, rsid
+            )
+            if img is None:
+                print(f"ebird wms failed, fetching {len(tile_array)} tiles instead.")
+                return self.fetch_range_tiles(tile_array, rsid)
+            if x == tile_array.x_min and end == tile_array.x_max:
+                mosaic = img
+            else:
+                if mosaic is None:
+                    mosaic = imager.blank("RGBA", (x_dim * size, y_dim * size))
+                mosaic.paste(img, ((x - tile_array.x_min) * size, 0))
+            x = end + 1
+        return split_mosaic(mosaic, tile_array, name=f"ebird-{rsid}")
+
+    def download_window(
+        self, z: int, x_min: int, x_max: int, y_min: int, y_max: int, rsid: str
+    ) -> Optional["Image"]:
+        """
+        Downloads the range layer for a block of tiles, which can't cross the antimeridian, with one WMS GetMap request.
+        Returns:
+            Optional[Image]: RGBA image of the block, tiles laid out like TileArray._composite_all(). None if the request failed.
+        """
+        top_left = mercantile.xy_bounds(x_min, y_min, z)
+        bottom_right = mercantile.xy_bounds(x_max, y_max, z)
+        width = (x_max - x_min + 1) * self._tile_size
+        height = (y_max - y_min + 1) * self._tile_size
+        params = {
+            "SERVICE": "WMS",
+            "VERSION": "1.1.1",
+            "REQUEST": "GetMap",
+            "LAYERS": "EBIRD_GRIDS_WS2",
+            "STYLES": "",
+            "FORMAT": "image/png",
+            "TRANSPARENT": "true",
+            "SRS": "EPSG:3857",
+            "BBOX": f"{top_left.left},{bottom_right.bottom},{bottom_right.right},{top_left.top}",
+            "WIDTH": width,
+            "HEIGHT": height,
+            "CQL_FILTER": f"result_set_id='{rsid}'",
+        }
+        print(f"ebird wms url: {self.wms_url}")
+        try:
+            resp = self.rget(self.wms_url, params=params)
+        except requests.RequestException as e:
+            print(f"ebird wms request failed: {e}")
+            return None
+        # WMS servers report errors as a 200 with an XML body.
+        content_type = resp.headers.get("Content-Type", "")
+        if resp.status_code != 200 or not content_type.startswith("image/"):
+            print(resp.status_code, content_type, resp.url)
+            return None
+        try:
+            img = imager.image_from_response(resp)
+        except imager.ImageLoadError as e:
+            print(f"ebird wms image couldn't be loaded: {e}")
+            return None
+        if img.size != (width, height):
+            print(f"ebird wms returned {img.size}, not {(width, height)}.")
+            return None
+        return img.convert("RGBA")
 
     def download_tile(self, tile_id: TileID, rsid: str) -> Tile:
         params = {
             "layers": "EBIRD_GRIDS_WS2",
             "format": "image/png",
             "zoom": tile_id.zoom,
-            "x": tile_id.x,
+            "x": tile_id.normalized.x,
             "y": tile_id.y,
             "CQL_FILTER": f"result_set_id='{rsid}'",
         }
+        cache_key = TileKey("ebird", rsid, "png", self._tile_size, *tile_id.normalized)
+        img = self.fresh_image(cache_key)
+        if img is not None:
+            return Tile(tile_id, img=img, name=f"ebird-{rsid}")
         url = self.map_tile_url
         print(f"ebird url: {url}")
-        resp = self.rget(url, params=params)
-        img = imager.image_from_response(resp)
+        resp = self.revalidating_get(url, cache_key, params=params)
+        img = self.revalidated_image(resp, cache_key)
         return Tile(tile_id, img=img, name=f"ebird-{rsid}")
 
     def make_map(
@@ -484,13 +1321,46 @@ class eBirdMap(BaseMap):
         map_size: int = 512,
         start_zoom: int = 0,
     ) -> "Image":
-        range_tiles = self.get_tiles(species_code, start_zoom, map_size)
-        if not range_tiles:
+        stats = RenderStats()
+        plan, rsid, bbox = self.plan_tiles(species_code, start_zoom, map_size, stats)
+        if not plan:
             img = mapbox.get_tile(TileID(0, 0, 0), high_res=True).img
             return img, True
-        range_map = self.generate_range_map(mapbox, self, map_size, range_tiles)
+        range_map = self.render_range_map(
+            mapbox,
+            plan,
+            bbox,
+            lambda a: self.fetch_range_layer(a, rsid),
+            map_size,
+            stats,
+        )
         return range_map, False
 
+    def make_map_png(
+        self,
+        species_code: str,
+        mapbox: MapBox,
+        map_size: int = 512,
+        render_cache: Optional[RenderCache] = None,
+        profile: str = "png",
+    ) -> Tuple[bytes, bool]:
+        """
+        Same as make_map(), but returns the map as encoded bytes and uses render_cache, if given, to avoid rendering it again.
+        Args:
+            profile (str, optional): Encode profile, see imager.encode_profiles. Defaults to "png".
+        Returns:
+            Tuple[bytes, bool]: (encoded bytes, no_data)
+        """
+
+        def render() -> Tuple[bytes, bool]:
+            img, no_data = self.make_map(species_code, mapbox, map_size)
+            return encode_render(img, profile), no_data
+
+        if render_cache is None:
+            return render()
+        key = RenderKey(f"ebird+{mapbox.map_name}", species_code, map_size, profile)
+        return render_cache.get_or_render(key, render)
+
 
 def generate_gbif_mapbox_range(
     taxon_key: int, gbif: GBIF, mapbox: MapBox, map_size: int = 512, debug: bool = True
@@ -506,48 +1376,37 @@ def generate_gbif_mapbox_range(
     Returns:
         Image: The finished range map image.
     """
-    range_bbox = gbif.get_bbox(taxon_key)
+    stats = RenderStats()
+    with stats.stage("bbox"):
+        range_bbox = gbif.get_bbox(taxon_key)
     print("range_bbox:", range_bbox)
-    gbif_tilearrays = gbif.get_bbox_tiles(range_bbox, size=map_size // 2)
-    # TODO: Handle AM crossing and bad bbox.
-
-    output_tiles = []
-
-    for gbta in gbif_tilearrays:
-        mbta = deepcopy(gbta)
-        print("gbta", gbta)
-        gbif_tiles = gbif.get_tiles(taxon_key, gbta)
-        mapbox_tiles = mapbox.get_tiles(mbta)
-        output_tiles += [{"mapbox": mapbox_tiles, "gbif": gbif_tiles}]
-
-    if len(output_tiles) == 2:
-        mapbox_left, gbif_left = output_tiles[0].values()
-        mapbox_right, gbif_right = output_tiles[1].values()
-        left = gbif_left._composite_all()
-        right = gbif_right._composite_all()
-        gbif_layer = imager.paste_halves(left, right)
-        if debug:
-            left.save("am_left.png")
-            right.save("am_right.png")
-            gbif_layer.save("am_both.png")
-
-        c_tiles_left = mapbox_left._composite_layer(gbif_left)
-        c_tiles_right = mapbox_right._composite_layer(gbif_right)
-        img_left = c_tiles_left._composite_all()
-        img_right = c_tiles_right._composite_all()
-        uncropped_result = imager.paste_halves(img_left, img_right)
-    else:
-        mapbox_tiles = output_tiles[0]["mapbox"]
-        gbif_tiles = output_tiles[0]["gbif"]
-        gbif_layer = gbif_tiles._composite_all()
-        c_tiles = mapbox_tiles._composite_layer(gbif_tiles)
-        uncropped_result = c_tiles._composite_all()
+    gbif_tilearray = gbif.get_bbox_tiles(range_bbox, size=map_size // 2)
+    # TODO: Handle bad bbox.
 
+    if not debug:
+        # Only the debug images need the whole uncropped basemap.
+        return gbif.render_range_map(
+            mapbox,
+            gbif_tilearray,
+            range_bbox,
+            lambda a: gbif.get_tiles(taxon_key, a),
+            map_size,
+            stats,
+        )
+
+    mbta = deepcopy(gbif_tilearray)
+    print("gbta", gbif_tilearray)
+    gbif_tiles = gbif.get_tiles(taxon_key, gbif_tilearray)
+    mapbox_tiles = mapbox.get_tiles(mbta)
+    gbif_layer = gbif_tiles._composite_all()
+    c_tiles = mapbox_tiles._composite_layer(gbif_tiles)
+    uncropped_result = c_tiles._composite_all()
+
+    bboxes = mosaic_content_bboxes([gbif_tiles])
     swapped_image, crop_area, _, _, _, fill_crop = find_crop_bounds2(
-        gbif_layer, map_size
+        gbif_layer, map_size, bboxes
     )
-    # This would be better handled if the TileArray knew the bounding box of the pixels it contained.
-    fitted, center = find_crop_bounds(gbif_layer, map_size)
+    fitted, center = find_crop_bounds(gbif_layer, map_size, bboxes[0])
     if debug:
         uncropped = uncropped_result.copy()
         if swapped_image:
@@ -573,3 +1432,42 @@ def generate_gbif_mapbox_range(
     if debug:
         final_image.save(f"final-{taxon_key}-{map_size}.png")
     return final_image
+
+
+def gbif_mapbox_range_png(
+    taxon_key: int,
+    gbif: GBIF,
+    mapbox: MapBox,
+    map_size: int = 512,
+    render_cache: Optional[RenderCache] = None,
+    debug: bool = True,
+    profile: str = "png",
+) -> bytes:
+    """
+    Same as generate_gbif_mapbox_range(), but returns the map as encoded bytes and uses render_cache, if given, to avoid rendering it again.
+    Args:
+        profile (str, optional): Encode profile, see imager.encode_profiles. Defaults to "png".
+    Returns:
+        bytes: The finished range map, encoded.
+    """
+
+    def render() -> bytes:
+        img = generate_gbif_mapbox_range(taxon_key, gbif, mapbox, map_size, debug)
+        return encode_render(img, profile)
+
+    if render_cache is None:
+        return render()
+    key = RenderKey(f"gbif+{mapbox.map_name}", taxon_key, map_size, profile)
+    return render_cache.get_or_render(key, render)
+
+
+def encode_render(img: "Image", profile: str = "png") -> bytes:
+    """
+    Encodes a finished map, adding the encode time to its RenderStats if it has them.
+    """
+    encoded = imager.encode_image(img, profile)
+    print(f"encoded: {encoded}")
+    stats = img.info.get("render_stats")
+    if stats is not None:
+        stats.stage_times["encode"] = encoded.seconds
+    return encoded.data
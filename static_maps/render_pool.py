@@ -0,0 +1,177 @@
+"""
+Renders maps in worker processes, so compositing, cropping and encoding neither hold the GIL nor block an asyncio event loop.
+Finished images come back through shared memory rather than being pickled through the pool's pipe.
+"""
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing import resource_tracker, shared_memory
+from time import perf_counter
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from static_maps.cache import RenderCache
+from static_maps.mapper import gbif_mapbox_range_png
+
+# Maps built by the pool's make_maps in each worker process, passed to every job run there.
+_worker_maps: Optional[Dict[str, Any]] = None
+
+
+def _init_worker(make_maps: Callable[[], Dict[str, Any]]) -> None:
+    global _worker_maps
+    _worker_maps = make_maps()
+
+
+def _to_shared(data: bytes) -> Tuple[Optional[str], int]:
+    """
+    Copies bytes into a new shared memory block, left for the parent process to read and unlink.
+    Returns:
+        Tuple[Optional[str], int]: (name of the block, size). The name is None for empty data, which can't have a block.
+    """
+    if not data:
+        return None, 0
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    shm.buf[: len(data)] = data
+    # The parent unlinks it, so this process mustn't clean it up when it exits.
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return shm.name, len(data)
+
+
+def _from_shared(name: Optional[str], size: int) -> bytes:
+    """
+    Reads bytes from a shared memory block made by _to_shared(), and frees the block.
+    """
+    if name is None:
+        return b""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _run_job(
+    job: Callable[..., Any], args: Tuple[Any, ...]
+) -> Tuple[Optional[str], Optional[int], Optional[Tuple[Any, ...]]]:
+    """
+    Runs a job in a worker. The encoded image goes into shared memory, anything else returned with it is pickled as usual.
+    """
+    result = job(_worker_maps, *args)
+    rest = None
+    if isinstance(result, tuple):
+        result, rest = result[0], result[1:]
+    # A failed render, passed on as it is.
+    if result is None:
+        return None, None, rest
+    name, size = _to_shared(result)
+    return name, size, rest
+
+
+@dataclass
+class RenderPool:
+    """
+    Pool of worker processes for rendering maps, for use from asyncio code.
+    Each worker builds its own maps with make_maps when it starts. It has to be a module level function, so it can be sent to the workers.
+    Workers are started with spawn rather than fork, as forking a process that already has threads (sessions, caches, the event loop) can copy locks that are held.
+    Jobs are module level functions too, called as job(maps, *args). They return encoded image bytes, or a tuple starting with them.
+    """
+
+    make_maps: Callable[[], Dict[str, Any]]
+    max_workers: int = 2
+    # If set, finished renders are cached here, and identical renders that are already running are waited on instead of run again.
+    render_cache: Optional[RenderCache] = None
+    renders: int = field(default=0, init=False)
+    running: int = field(default=0, init=False)
+    render_seconds: float = field(default=0.0, init=False)
+    _executor: Optional[ProcessPoolExecutor] = field(
+        default=None, init=False, repr=False
+    )
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_init_worker,
+                initargs=(self.make_maps,),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    async def render(
+        self, job: Callable[..., Any], *args: Any, key: Optional[Hashable] = None
+    ) -> Any:
+        """
+        Runs a render job in a worker process, and waits for it without blocking the event loop.
+        Args:
+            job (Callable[..., Any]): The job, like render_gbif_map.
+            args: Arguments for the job, after the maps.
+            key (Hashable, optional): Key for the render in render_cache. Defaults to None, not cached.
+        Returns:
+            Any: What the job returned, encoded image bytes first.
+        """
+        if key is not None and self.render_cache is not None:
+            return await self.render_cache.get_or_render_async(
+                key, lambda: self._render(job, args)
+            )
+        # Shielded, so a caller giving up doesn't leave its image in shared memory.
+        return await asyncio.shield(self._render(job, args))
+
+    async def _render(self, job: Callable[..., Any], args: Tuple[Any, ...]) -> Any:
+        loop = asyncio.get_running_loop()
+        start = perf_counter()
+        self.running += 1
+        try:
+            name, size, rest = await loop.run_in_executor(
+                self.executor, _run_job, job, args
+            )
+        finally:
+            self.running -= 1
+        data = None if size is None else _from_shared(name, size)
+        self.renders += 1
+        self.render_seconds += perf_counter() - start
+        return data if rest is None else (data, *rest)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "renders": self.renders,
+            "running": self.running,
+            "seconds": self.render_seconds,
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+def render_gbif_map(
+    maps: Dict[str, Any], taxon_key: int, map_size: int = 512, profile: str = "png"
+) -> bytes:
+    """
+    Job for a GBIF range map on a MapBox basemap. Needs maps["gbif"] and maps["mapbox"].
+    """
+    return gbif_mapbox_range_png(
+        taxon_key,
+        maps["gbif"],
+        maps["mapbox"],
+        map_size,
+        debug=False,
+        profile=profile,
+    )
+
+
+def render_ebird_map(
+    maps: Dict[str, Any], species_code: str, map_size: int = 512, profile: str = "png"
+) -> Tuple[bytes, bool]:
+    """
+    Job for an eBird range map on a MapBox basemap. Needs maps["ebird"] and maps["mapbox"].
+    Returns:
+        Tuple[bytes, bool]: (encoded bytes, no_data)
+    """
+    return maps["ebird"].make_map_png(
+        species_code, maps["mapbox"], map_size, profile=profile
+    )
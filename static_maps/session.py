@@ -0,0 +1,103 @@
+"""
+Pooled HTTP sessions for the map providers, so tiles reuse connections instead of each paying for a new TCP and TLS handshake.
+"""
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Rate limited, or the server is having a bad moment. Worth trying again.
+retry_statuses = (429, 500, 502, 503, 504)
+
+
+@dataclass
+class ProviderSession:
+    """
+    A requests session for one map provider. Connections to each host are kept alive and shared by every thread using it.
+    Read errors and 429 or 5xx responses are retried with exponential backoff, honouring Retry-After.
+    Once the retries run out, the last response is returned like any other.
+    Failing to connect at all (refused, DNS, connect timeout) is only retried connect_retries times, so an unreachable host fails fast.
+    """
+
+    # Connections kept open to each host. Downloads past this many at once open connections that are closed after use.
+    pool_size: int = 4
+    # Times a request is retried, not counting the first try.
+    retries: int = 3
+    # Times a request that couldn't connect is retried, counted in retries too.
+    connect_retries: int = 0
+    # Retries wait backoff * 2 ** (retry - 1) seconds.
+    backoff: float = 0.3
+    # Seconds to wait to connect, and then for each read. Used for requests that don't set their own.
+    timeout: float = 30
+    # Hosts that have a pool of connections. Pools past this many are closed, least recently used first, and their stats lost.
+    max_hosts: int = 8
+    _session: Optional[requests.Session] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _adapter: Optional[HTTPAdapter] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            retry = Retry(
+                total=self.retries,
+                connect=self.connect_retries,
+                backoff_factor=self.backoff,
+                status_forcelist=retry_statuses,
+                allowed_methods=["GET", "HEAD"],
+                raise_on_status=False,
+            )
+            self._adapter = HTTPAdapter(
+                pool_connections=self.max_hosts,
+                pool_maxsize=self.pool_size,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+            self._session = session
+        return self._session
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Connection reuse for each host, as {"host:port": {"requests": n, "connections": n, "reused": n}}.
+        Retries count as requests. Requests that reused a connection are the ones that skipped a handshake.
+        """
+        if self._adapter is None:
+            return {}
+        pools = self._adapter.poolmanager.pools
+        stats = {}
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.host}:{pool.port}"
+            host_stats = stats.setdefault(
+                host, {"requests": 0, "connections": 0, "reused": 0}
+            )
+            host_stats["requests"] += pool.num_requests
+            host_stats["connections"] += pool.num_connections
+            host_stats["reused"] += max(pool.num_requests - pool.num_connections, 0)
+        return stats
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+        self._session = None
+        self._adapter = None
+
+    def __getstate__(self) -> Dict:
+        # Open connections can't be pickled, a new session is made when it's next used.
+        state = self.__dict__.copy()
+        state["_session"] = None
+        state["_adapter"] = None
+        return state
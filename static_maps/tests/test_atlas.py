@@ -0,0 +1,86 @@
+import pytest
+import sys
+import os
+
+sys.path.append(os.getcwd())
+
+from static_maps.atlas import TileAtlas, build_atlas
+from static_maps.cache import TileKey
+from static_maps.imager import Image
+from static_maps.mapper import MapBox
+from static_maps.tiles import Tile, TileArray, TileID
+
+
+def make_key(x=0, y=0, z=0, resolution=64, fmt="jpg90"):
+    return TileKey("mapbox", "satellite", fmt, resolution, z, x, y)
+
+
+def colour(tid):
+    return (tid.z * 40, tid.x * 10, tid.y * 10)
+
+
+def fake_tiles(tile_ids):
+    # The last tile of each zoom can't be fetched.
+    tiles = TileArray()
+    for tid in tile_ids[:-1]:
+        tiles[tid] = Tile(tid, img=Image.new("RGB", (128, 128), colour(tid)))
+    return tiles
+
+
+@pytest.fixture
+def atlas(tmp_path):
+    return build_atlas(tmp_path / "basemap.atlas", make_key(), fake_tiles, max_zoom=2)
+
+
+class TestTileAtlas:
+    def test_build(self, atlas, tmp_path):
+        assert len(atlas) == (1 - 1) + (4 - 1) + (16 - 1)
+        assert (tmp_path / "basemap.json").exists()
+        assert not list(tmp_path.glob("*.tmp"))
+        # Stored at the key's resolution.
+        assert atlas.path.stat().st_size == len(atlas) * 64 * 64 * 3
+
+    def test_get(self, atlas):
+        tid = TileID(2, 1, 3)
+        img = atlas.get(make_key(tid.x, tid.y, z=2))
+        assert img.size == (64, 64)
+        assert img.mode == "RGB"
+        assert img.getpixel((10, 10)) == colour(tid)
+        assert atlas.get(make_key(1, 1, z=2), 32).size == (32, 32)
+        assert atlas.stats == {"hits": 2, "misses": 0, "tiles": len(atlas)}
+
+    @pytest.mark.parametrize(
+        "key",
+        [
+            # Couldn't be fetched.
+            make_key(1, 1, 1),
+            # Past max_zoom.
+            make_key(0, 0, 3),
+            make_key(fmt="png"),
+            make_key(resolution=128),
+        ],
+    )
+    def test_missing(self, atlas, key):
+        assert key not in atlas
+        assert atlas.get(key) is None
+        assert atlas.misses == 1
+
+    def test_reopen(self, atlas):
+        again = TileAtlas(atlas.path)
+        assert (again.resolution, again.max_zoom, len(again)) == (64, 2, len(atlas))
+        key = make_key(1, 0, 1)
+        assert list(again.get(key).getdata()) == list(atlas.get(key).getdata())
+
+    def test_mapbox(self, tmp_path):
+        key = make_key(resolution=256)
+        atlas = build_atlas(tmp_path / "low_res.atlas", key, fake_tiles, max_zoom=1)
+        # No token, so anything not in the atlas would fail.
+        mapbox = MapBox(token="", fmt="jpg90", atlas=atlas, high_res=False)
+        tile = mapbox.get_tile(TileID(1, 1, 0), resolution=32)
+        assert tile.tid == TileID(1, 1, 0)
+        assert tile.size == (32, 32)
+        # Wrapped tiles are the same tile.
+        wrapped = mapbox.get_tile(TileID(1, 3, 0), resolution=32)
+        assert list(wrapped.img.getdata()) == list(tile.img.getdata())
+        with pytest.raises(MapBox.AuthMissingError):
+            mapbox.get_tile(TileID(1, 1, 1))
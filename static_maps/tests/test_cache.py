@@ -0,0 +1,395 @@
+import asyncio
+import pytest
+import re
+import sys
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.getcwd())
+
+from static_maps.cache import (
+    EmptyTileCache,
+    ImageCache,
+    MetadataCache,
+    RenderCache,
+    RenderKey,
+    TileCache,
+    TileKey,
+)
+from static_maps.imager import Image
+
+
+def make_key(x, y=0, z=4):
+    return TileKey("mapbox", "satellite", "jpg90", 512, z, x, y)
+
+
+class TestTileCache:
+    def test_put_get(self, tmp_path):
+        cache = TileCache(path=tmp_path)
+        key = make_key(1)
+        assert cache.get(key) is None
+        cache.put(key, b"tile data")
+        assert cache.get(key) == b"tile data"
+        assert key in cache
+        assert cache.stats == {
+            "hits": 1,
+            "misses": 1,
+            "evictions": 0,
+            "tiles": 1,
+            "bytes": 9,
+        }
+
+    def test_key_fields(self, tmp_path):
+        cache = TileCache(path=tmp_path)
+        cache.put(make_key(1), b"a")
+        other = TileKey("mapbox", "satellite", "png", 512, 4, 1, 0)
+        assert cache.get(other) is None
+
+    def test_unsafe_key_fields(self, tmp_path):
+        cache = TileCache(path=tmp_path)
+        layers = ["srs=EPSG:3857&style=classic.poly&taxonKey=1", "..", "a/b"]
+        for layer in layers:
+            cache.put(TileKey("gbif", layer, "@1x.png", None, 4, 1, 0), layer.encode())
+        for layer in layers:
+            key = TileKey("gbif", layer, "@1x.png", None, 4, 1, 0)
+            assert cache.get(key) == layer.encode()
+        for fn in tmp_path.rglob("*.tile"):
+            style = fn.relative_to(tmp_path).parts[1]
+            assert re.fullmatch(r"[0-9a-f]{16}", style)
+
+    def test_lru_eviction(self, tmp_path):
+        cache = TileCache(path=tmp_path, max_bytes=30)
+        for x in range(3):
+            cache.put(make_key(x), b"0123456789")
+        # Touch the oldest, so the next put evicts the second tile instead.
+        assert cache.get(make_key(0)) is not None
+        cache.put(make_key(3), b"0123456789")
+        assert make_key(0) in cache
+        assert make_key(1) not in cache
+        assert cache.size == 30
+        assert cache.evictions == 1
+        assert len(list(tmp_path.rglob("*.tile"))) == 3
+
+    def test_shared(self, tmp_path):
+        # Like two processes using one directory.
+        first = TileCache(path=tmp_path, max_bytes=100, shared=True)
+        second = TileCache(path=tmp_path, max_bytes=100, shared=True)
+        first.put(make_key(0), b"0123456789")
+        # Found on disk, though it was stored by the other one.
+        assert make_key(0) in second
+        assert second.get(make_key(0)) == b"0123456789"
+        for x in range(1, 40):
+            (first, second)[x % 2].put(make_key(x), b"0123456789")
+            on_disk = sum(fn.stat().st_size for fn in tmp_path.rglob("*.tile"))
+            # Each one only sees the other's new tiles when it rescans, so they can go over by what each stored since.
+            assert on_disk <= 100 + 2 * 10
+        assert make_key(39) in first
+        assert make_key(0) not in first
+
+    def test_too_large(self, tmp_path):
+        cache = TileCache(path=tmp_path, max_bytes=4)
+        cache.put(make_key(0), b"0123456789")
+        assert len(cache) == 0
+
+    def test_persistence(self, tmp_path):
+        cache = TileCache(path=tmp_path)
+        cache.put(make_key(0), b"abc")
+        cache.put(make_key(1, 2), b"defg")
+        reloaded = TileCache(path=tmp_path)
+        assert len(reloaded) == 2
+        assert reloaded.size == 7
+        assert reloaded.get(make_key(1, 2)) == b"defg"
+
+    def test_reload_over_budget(self, tmp_path):
+        cache = TileCache(path=tmp_path)
+        for x in range(4):
+            cache.put(make_key(x), b"0123456789")
+            os.utime(cache._file(make_key(x)), (x, x))
+        reloaded = TileCache(path=tmp_path, max_bytes=20)
+        assert len(reloaded) == 2
+        assert make_key(0) not in reloaded
+        assert make_key(3) in reloaded
+
+    def test_validators(self, tmp_path):
+        cache = TileCache(path=tmp_path)
+        cache.put(make_key(1), b"old")
+        entry = cache.get_entry(make_key(1))
+        assert entry == (b"old", None, None, 0.0)
+        before = time.time()
+        cache.put(make_key(1), b"new", {"etag": '"a"', "last_modified": None})
+        entry = cache.get_entry(make_key(1))
+        assert (entry.data, entry.etag, entry.last_modified) == (b"new", '"a"', None)
+        assert entry.stored >= before
+        cache.revalidated(
+            make_key(1), {"last_modified": "Wed, 21 Oct 2026 07:28:00 GMT"}
+        )
+        entry = cache.get_entry(make_key(1))
+        assert entry.etag == '"a"'
+        assert entry.last_modified == "Wed, 21 Oct 2026 07:28:00 GMT"
+        assert cache.get_entry(make_key(2)) is None
+        hits, misses = cache.hits, cache.misses
+        assert cache.stored(make_key(1)) == (entry.stored, 3)
+        assert cache.stored(make_key(2)) is None
+        # Not read, so not a hit or miss.
+        assert (cache.hits, cache.misses) == (hits, misses)
+
+    def test_validators_evicted(self, tmp_path):
+        cache = TileCache(path=tmp_path, max_bytes=10)
+        cache.put(make_key(1), b"123456", {"etag": '"a"'})
+        cache.put(make_key(2), b"123456", {"etag": '"b"'})
+        assert list(tmp_path.rglob("*.meta")) == [
+            cache._file(make_key(2)).with_suffix(".meta")
+        ]
+
+
+class TestImageCache:
+    def test_put_get(self):
+        cache = ImageCache()
+        img = Image.new("RGBA", (256, 256), (1, 2, 3, 255))
+        cache.put(make_key(0), img)
+        res = cache.get(make_key(0))
+        assert res.size == (256, 256)
+        assert res.getpixel((0, 0)) == (1, 2, 3, 255)
+        assert cache.get(make_key(1)) is None
+        assert cache.stats["hits"] == 1
+        assert cache.stats["misses"] == 1
+        assert cache.size == 256 * 256 * 4
+
+    def test_copy_on_write(self):
+        cache = ImageCache()
+        img = Image.new("RGBA", (16, 16), (1, 2, 3, 255))
+        view = cache.put(make_key(0), img)
+        view.alpha_composite(Image.new("RGBA", (16, 16), (200, 0, 0, 255)))
+        img.paste((9, 9, 9, 9), (0, 0, 8, 8))
+        res = cache.get(make_key(0))
+        res.putpixel((1, 1), (5, 5, 5, 5))
+        assert cache.get(make_key(0)).getpixel((1, 1)) == (1, 2, 3, 255)
+        assert view.getpixel((1, 1)) == (200, 0, 0, 255)
+
+    def test_pixel_budget(self):
+        # Room for two 256px RGBA tiles or eight 256px L tiles.
+        cache = ImageCache(max_bytes=2 * 256 * 256 * 4)
+        for x in range(2):
+            cache.put(make_key(x), Image.new("RGBA", (256, 256)))
+        assert cache.get(make_key(0)) is not None
+        cache.put(make_key(2), Image.new("L", (256, 256)))
+        assert make_key(0) in cache
+        assert make_key(1) not in cache
+        assert make_key(2) in cache
+        assert cache.evictions == 1
+
+
+class TestEmptyTileCache:
+    def test_add(self):
+        cache = EmptyTileCache()
+        assert not cache.is_empty(make_key(1))
+        cache.add(make_key(1))
+        assert cache.is_empty(make_key(1))
+        assert make_key(1) in cache
+        assert make_key(2) not in cache
+        assert cache.stats == {"hits": 1, "misses": 1, "tiles": 1}
+
+    def test_ttl(self):
+        cache = EmptyTileCache(ttl=0)
+        cache.add(make_key(1))
+        assert not cache.is_empty(make_key(1))
+        assert len(cache) == 0
+
+    def test_max_tiles(self):
+        cache = EmptyTileCache(max_tiles=2)
+        for x in range(3):
+            cache.add(make_key(x))
+        assert len(cache) == 2
+        assert make_key(0) not in cache
+
+
+class TestMetadataCache:
+    def test_get_or_fetch(self):
+        cache = MetadataCache()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return ("Psaltriparus minimus", 2494988)
+
+        for _ in range(2):
+            res = cache.get_or_fetch("gbif.species", "Bushtit", fetch, decode=tuple)
+            assert res == ("Psaltriparus minimus", 2494988)
+        assert len(calls) == 1
+        assert ("gbif.species", "Bushtit") in cache
+        assert cache.stats == {"hits": 1, "misses": 1, "refreshes": 0, "entries": 1}
+
+    def test_none_not_cached(self):
+        cache = MetadataCache()
+        assert cache.get_or_fetch("ebird.rsid", "dodo1/100", lambda: None) is None
+        assert len(cache) == 0
+
+    def test_ttl(self):
+        cache = MetadataCache(ttls={"ebird.rsid": 0})
+        cache.put("ebird.rsid", "bushti/100", "RS1")
+        assert cache.get_or_fetch("ebird.rsid", "bushti/100", lambda: "RS2") == "RS2"
+
+    def test_refresh(self):
+        cache = MetadataCache(ttls={"ebird.rsid": 60}, refresh_after=0)
+        cache.put("ebird.rsid", "bushti/100", "RS1")
+        refreshed = threading.Event()
+
+        def fetch():
+            refreshed.set()
+            return "RS2"
+
+        # The cached value is used, and replaced in the background.
+        assert cache.get_or_fetch("ebird.rsid", "bushti/100", fetch) == "RS1"
+        assert refreshed.wait(5)
+        cache.refresh_after = 1
+        for _ in range(50):
+            if cache.get_or_fetch("ebird.rsid", "bushti/100", lambda: None) == "RS2":
+                break
+            time.sleep(0.1)
+        assert cache.get_or_fetch("ebird.rsid", "bushti/100", lambda: None) == "RS2"
+        assert cache.refreshes == 1
+
+    def test_persistence(self, tmp_path):
+        path = tmp_path / "metadata.json"
+        cache = MetadataCache(path=path, ttls={"gbif.bbox": 60, "ebird.env": 0})
+        cache.put("gbif.bbox", 2494988, {"left": -127})
+        cache.put("ebird.env", "bushti", {"left": -128})
+        again = MetadataCache(path=path, ttls={"gbif.bbox": 60, "ebird.env": 0})
+        assert again.get_or_fetch("gbif.bbox", 2494988, lambda: None) == {"left": -127}
+        # Expired entries aren't kept.
+        assert ("ebird.env", "bushti") not in again
+        assert len(again) == 1
+
+    def test_shared_file(self, tmp_path):
+        # Like two processes sharing a file, neither loses what the other saved.
+        path = tmp_path / "metadata.json"
+        first = MetadataCache(path=path)
+        second = MetadataCache(path=path)
+        first.put("gbif.bbox", 2494988, {"left": -127})
+        second.put("ebird.rsid", "bushti/100", "RS1")
+        again = MetadataCache(path=path)
+        assert len(again) == 2
+        assert not list(tmp_path.glob("*.tmp"))
+
+    def test_concurrent_saves(self, tmp_path):
+        path = tmp_path / "metadata.json"
+        caches = [MetadataCache(path=path) for _ in range(4)]
+
+        def save(i):
+            for key in range(20):
+                caches[i].put("gbif.bbox", f"{i}/{key}", key)
+
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(save, range(4)))
+        # Each save merged what the others saved before it, so none were lost.
+        assert len(MetadataCache(path=path)) == 80
+
+
+class TestRenderCache:
+    def test_get_or_render(self):
+        cache = RenderCache()
+        key = RenderKey("gbif+mapbox", 2494988, 512)
+        calls = []
+
+        def render():
+            calls.append(1)
+            return b"png"
+
+        assert cache.get_or_render(key, render) == b"png"
+        assert cache.get_or_render(key, render) == b"png"
+        assert len(calls) == 1
+        assert cache.stats["hits"] == 1
+        assert cache.stats["misses"] == 1
+
+    def test_ttl(self):
+        cache = RenderCache(ttl=0)
+        key = RenderKey("gbif+mapbox", 2494988, 512)
+        cache.put(key, b"png")
+        assert cache.get(key) is None
+        assert len(cache) == 0
+
+    def test_budget(self):
+        cache = RenderCache(max_bytes=10)
+        for x in range(3):
+            cache.put(RenderKey("ebird+mapbox", x, 512), (b"01234", False))
+        assert RenderKey("ebird+mapbox", 0, 512) not in cache
+        assert cache.get(RenderKey("ebird+mapbox", 2, 512)) == (b"01234", False)
+
+    def test_coalescing(self):
+        cache = RenderCache()
+        key = RenderKey("ebird+mapbox", "tui1", 512)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def render():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return (b"png", False)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            first = pool.submit(cache.get_or_render, key, render)
+            started.wait(5)
+            others = [pool.submit(cache.get_or_render, key, render) for _ in range(3)]
+            while cache.coalesced < 3:
+                time.sleep(0.01)
+            release.set()
+            results = [f.result(5) for f in [first] + others]
+        assert results == [(b"png", False)] * 4
+        assert len(calls) == 1
+
+    def test_render_error(self):
+        cache = RenderCache()
+        key = RenderKey("ebird+mapbox", "dodo1", 512)
+
+        def render():
+            raise ValueError("failed")
+
+        with pytest.raises(ValueError):
+            cache.get_or_render(key, render)
+        assert key not in cache
+        assert cache.get_or_render(key, lambda: b"png") == b"png"
+
+    def test_coalescing_async(self):
+        cache = RenderCache()
+        key = RenderKey("gbif+mapbox", 2494988, 512)
+        calls = []
+
+        async def render():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return b"png"
+
+        async def renders():
+            return await asyncio.gather(
+                *(cache.get_or_render_async(key, render) for _ in range(3))
+            )
+
+        assert asyncio.run(renders()) == [b"png"] * 3
+        assert len(calls) == 1
+        assert (cache.misses, cache.coalesced) == (1, 2)
+        assert asyncio.run(cache.get_or_render_async(key, render)) == b"png"
+        assert cache.hits == 1
+
+    def test_cancelled_async(self):
+        cache = RenderCache()
+        key = RenderKey("gbif+mapbox", 2494988, 512)
+
+        async def render():
+            await asyncio.sleep(0.05)
+            return b"png"
+
+        async def renders():
+            first = asyncio.ensure_future(cache.get_or_render_async(key, render))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(cache.get_or_render_async(key, render))
+            await asyncio.sleep(0)
+            first.cancel()
+            # The render carries on for the other caller, and is cached.
+            return await second
+
+        assert asyncio.run(renders()) == b"png"
+        assert cache.get(key) == b"png"
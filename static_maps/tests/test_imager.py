@@ -1,6 +1,7 @@
 import pytest
 import sys
 import os
+from io import BytesIO
 from pathlib import Path
 
 sys.path.append(os.getcwd())
@@ -221,6 +222,23 @@ class TestImage:
         back = imager.swap_left_right(swap)
         assert self.compare_images(back, img)
 
+    @pytest.mark.parametrize(
+        "box",
+        [(0, 0, 512, 512), (100, 50, 612, 562), (-20, 0, 300, 256), (700, 0, 800, 512)],
+    )
+    @pytest.mark.parametrize("swapped", [False, True])
+    def test_wrapped_view(self, box, swapped):
+        left = self.open_image("test_paste_halves_left.png")
+        right = self.open_image("test_paste_halves_right.png")
+        whole = imager.paste_halves(left, right)
+        view = imager.WrappedView([left, right])
+        if swapped:
+            whole = imager.swap_left_right(whole)
+            view = view.swapped()
+        assert view.size == whole.size
+        assert self.compare_images(view.crop(box), whole.crop(box))
+        assert view.content_bbox() == imager.content_bbox(whole)
+
     @pytest.mark.parametrize(
         "images, result",
         [
@@ -250,6 +268,30 @@ class TestImage:
         sp = imager.quad_split(res)
         assert all([self.compare_images(*a) for a in zip(sp, imgs)])
 
+    def test_composite_blank_and_missing(self):
+        red = Image.new("RGBA", (256, 256), (255, 0, 0, 255))
+        # Blank tiles aren't copied, so these pixels would show up if they were.
+        blank = Image.new("RGBA", (256, 256), (0, 0, 255, 255))
+        idx_imgs = {(3, 5): red, (4, 5): blank, (3, 6): None, (4, 6): red}
+        res = imager.composite_mxn(idx_imgs, blank={(4, 5)})
+        assert res.size == (512, 512)
+        assert res.getpixel((0, 0)) == (255, 0, 0, 255)
+        assert res.getpixel((300, 0)) == (0, 255, 255, 0)
+        assert res.getpixel((0, 300)) == (0, 255, 255, 0)
+        assert res.getpixel((300, 300)) == (255, 0, 0, 255)
+
+    def test_composite_memory_bound(self):
+        tile = Image.new("RGB", (256, 256))
+        four = {(x, y): tile for x in range(4) for y in range(4)}
+        # No limit unless one's given.
+        assert imager.composite_mxn(four).size == (1024, 1024)
+        assert imager.composite_mxn(four, max_bytes=1024 * 1024 * 4).size == (
+            1024,
+            1024,
+        )
+        with pytest.raises(imager.CompositingError):
+            imager.composite_mxn(four, max_bytes=1024 * 1024)
+
     @pytest.mark.parametrize(
         "left_image, right_image, result, error",
         [
@@ -320,3 +362,53 @@ class TestImage:
         image = self.open_image(image_fn)
         fitted_crop, center_crop = imager.find_crop_bounds(image, crop_size)
         assert fitted_crop == expected_bounds
+
+    @pytest.mark.parametrize(
+        "image_fn",
+        ["test_crop_bounds_512-normal.png", "test_crop_bounds_512-am.png"],
+    )
+    def test_wrapped_content_bboxes(self, image_fn):
+        image = self.open_image(image_fn)
+        bbox, swapped_bbox = imager.wrapped_content_bboxes(image)
+        assert bbox == image.getbbox()
+        assert swapped_bbox == imager.swap_left_right(image).getbbox()
+
+    @pytest.mark.parametrize(
+        "profile, fmt, mode",
+        [
+            ("png", "PNG", "RGBA"),
+            ("png_fast", "PNG", "RGBA"),
+            ("png8", "PNG", "P"),
+            ("webp", "WEBP", "RGBA"),
+            ("jpeg", "JPEG", "RGB"),
+        ],
+    )
+    def test_encode_image(self, profile, fmt, mode):
+        image = self.open_image("transparency-test-paw_RGBA.png")
+        encoded = imager.encode_image(image, profile)
+        assert encoded.size == len(encoded.data) > 0
+        assert encoded.seconds >= 0
+        decoded = Image.open(BytesIO(encoded.data))
+        assert decoded.format == fmt
+        assert decoded.mode == mode
+        assert decoded.size == image.size
+        if profile in ("png", "png_fast"):
+            assert list(decoded.getdata()) == list(image.getdata())
+        assert image.asbytes(profile) == encoded.data
+
+    def test_encode_image_unknown_profile(self):
+        with pytest.raises(ValueError):
+            imager.encode_image(Image.new("RGB", (8, 8)), "gif")
+
+    @pytest.mark.parametrize("fmt", ["JPEG", "PNG"])
+    @pytest.mark.parametrize("size, expected", [(None, 512), (512, 512), (256, 256)])
+    def test_image_from_bytes_size(self, fmt, size, expected):
+        image = self.open_image("background_RGB.png")
+        d = BytesIO()
+        image.save(d, fmt)
+        res = imager.image_from_bytes(d.getvalue(), size)
+        assert res.size == (expected, expected)
+        assert res.mode == "RGB"
+        if fmt == "JPEG" and size == 256:
+            # Draft mode, so never decoded at full size.
+            assert res.format == "JPEG"
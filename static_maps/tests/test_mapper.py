@@ -1,8 +1,16 @@
-from typing import Any
+from typing import Any, Iterator
+import json
 
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
 from pathlib import Path
+from urllib.parse import parse_qsl, urlparse
+import threading
 
+import mercantile
 import pytest
+from static_maps.cache import ImageCache, MetadataCache, TileCache, TileKey
 from static_maps.geo import LatLonBBox, LatLon
 from static_maps.mapper import (
     GBIF,
@@ -12,13 +20,106 @@ from static_maps.mapper import (
     generate_gbif_mapbox_range,
     eBirdMap,
 )
-from static_maps.tiles import Tile, TileArray, TileID
+from static_maps.tiles import Tile, TileArray, TileID, empty_tilearray_from_ids
 from static_maps.imager import Image
+from static_maps import imager
 
 mapbox = MapBox(token=get_token())
 gbif = GBIF()
 
 
+@contextmanager
+def local_server(handler: BaseHTTPRequestHandler) -> Iterator[str]:
+    """
+    Runs a stand-in server on localhost for the duration of the with statement. Gives its base url.
+    """
+    server = HTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class NotFoundHandler(BaseHTTPRequestHandler):
+    requests = []
+    status = 404
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        self.send_response(self.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class WMSHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the eBird WMS and tile servers. Each 256px block of an image is coloured by its place in the image,
+    with blue set for images east of the prime meridian.
+    """
+
+    requests = []
+    # GetMap requests get a WMS error report.
+    broken = False
+
+    def do_GET(self):
+        query = dict(parse_qsl(urlparse(self.path).query, keep_blank_values=True))
+        self.requests.append(query)
+        if "REQUEST" in query and self.broken:
+            body = b"<ServiceExceptionReport/>"
+            content_type = "application/vnd.ogc.se_xml"
+        else:
+            width = int(query.get("WIDTH", 256))
+            height = int(query.get("HEIGHT", 256))
+            east = float(query.get("BBOX", "0").split(",")[0]) >= 0
+            img = Image.new("RGBA", (width, height))
+            for x in range(0, width, 256):
+                for y in range(0, height, 256):
+                    colour = (x // 256 * 50, y // 256 * 50, 255 * east, 255)
+                    img.paste(colour, (x, y, x + 256, y + 256))
+            body = img.asbytes()
+            content_type = "image/png"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MapBoxHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the MapBox tile and Static Images APIs. Everything it serves is blue.
+    """
+
+    requests = []
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.requests.append(path)
+        if path.startswith("/styles/"):
+            size = tuple(int(v) for v in path.rsplit("/", 1)[1].split("x"))
+        else:
+            size = (512, 512) if "@2x" in path else (256, 256)
+        d = BytesIO()
+        Image.new("RGB", size, (0, 0, 255)).save(d, "JPEG")
+        body = d.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
 class TestMapBox:
     mapbox: MapBox = MapBox(token=get_token())
 
@@ -339,6 +440,220 @@ class TestBaseMap:
             assert res[1] == bbox_parts[1]
             assert res[2] == bbox_parts[2]
 
+    def test_fetch_tiles(self):
+        tile_ids = [TileID(2, x, y) for x in range(2) for y in range(2)]
+        bad_id = TileID(2, 1, 1)
+        missing_id = TileID(2, 0, 1)
+
+        def fetch(tid):
+            if tid == bad_id:
+                raise ValueError("bad tile")
+            if tid == missing_id:
+                return None
+            return Tile(tid, img=Image.new("RGB", (256, 256)))
+
+        res = self.base_map.fetch_tiles(tile_ids, fetch)
+        assert list(res.keys()) == [TileID(2, 0, 0), TileID(2, 1, 0)]
+        assert isinstance(res.failed[bad_id], ValueError)
+        assert isinstance(res.failed[missing_id], BaseMap.TileFetchError)
+
+    @pytest.mark.parametrize(
+        "tile_ids, needed",
+        [
+            # Range in the top left tile of a 3x3, so the crop only needs the top left 2x2.
+            (
+                [TileID(4, x, y) for x in range(3, 6) for y in range(6, 9)],
+                [TileID(4, x, y) for x in range(3, 5) for y in range(6, 8)],
+            ),
+            # Range in the middle of a 2x2 needs every tile.
+            ([TileID(4, x, y) for x in range(3, 5) for y in range(6, 8)], None),
+            # Crossing the antimeridian, as one array.
+            ([TileID(4, x, y) for x in range(15, 17) for y in range(9, 11)], None),
+        ],
+    )
+    def test_crop_aware_range_map(self, tile_ids, needed):
+        if needed is None:
+            needed = tile_ids
+        fetched = []
+
+        class FakeBackground(BaseMap):
+            def get_tiles(self, tids, **kwargs):
+                fetched.extend(tids)
+                return TileArray.from_dict(
+                    {
+                        t: Tile(
+                            t, img=Image.new("RGB", (256, 256), (t.x * 20, t.y * 20, 0))
+                        )
+                        for t in tids
+                    }
+                )
+
+        class FakeRange(BaseMap):
+            _tile_size: int = 256
+
+        fg = TileArray()
+        for tid in tile_ids:
+            img = Image.new("RGBA", (256, 256))
+            if tid == min(tile_ids):
+                img.paste((255, 0, 0, 255), (100, 100, 200, 200))
+            fg[tid] = Tile(tid, img=img)
+        res = BaseMap.generate_range_map(FakeBackground(""), FakeRange(""), 512, fg)
+        # Only the background tiles under the crop were asked for.
+        assert sorted(fetched) == sorted(needed)
+
+        # Compare against compositing everything and then cropping.
+        everything = FakeBackground("").get_tiles(list(fg.keys()))
+        fg_image = fg._composite_all()
+        fitted, _ = imager.find_crop_bounds(fg_image, 512)
+        full = imager.transparency_composite(everything._composite_all(), fg_image)
+        expected = full.crop(fitted.pillow)
+        assert list(res.getdata()) == list(expected.getdata())
+        assert res.info["render_stats"].bg_tiles_saved == len(tile_ids) - len(needed)
+        assert res.info["render_stats"].bg_tiles_fetched == len(needed)
+
+    def test_render_range_map_parallel(self):
+        tile_ids = [TileID(4, x, y) for x in range(3, 6) for y in range(6, 9)]
+        bg_started = threading.Event()
+        fetched = []
+
+        class FakeBackground(BaseMap):
+            def get_tiles(self, tids, **kwargs):
+                bg_started.set()
+                fetched.append(list(tids))
+                return TileArray.from_dict(
+                    {
+                        t: Tile(t, img=Image.new("RGB", (256, 256), (0, 0, 255)))
+                        for t in tids
+                    }
+                )
+
+        class FakeRange(BaseMap):
+            _tile_size: int = 256
+
+        def fetch(tile_array):
+            # Only returns once the basemap has started, so this fails if the stages run one after the other.
+            assert bg_started.wait(5)
+            for tid in tile_array:
+                img = Image.new("RGBA", (256, 256))
+                if tid == min(tile_ids):
+                    img.paste((255, 0, 0, 255), (100, 100, 200, 200))
+                tile_array[tid] = Tile(tid, img=img)
+            return tile_array
+
+        plan = TileArray.from_dict({t: Tile(t) for t in tile_ids})
+        left, bottom, right, top = mercantile.bounds(3, 6, 4)
+        bbox = LatLonBBox(left=left, bottom=bottom, right=right, top=top)
+        res = FakeRange("").render_range_map(FakeBackground(""), plan, bbox, fetch, 512)
+        stats = res.info["render_stats"]
+        # The range's own tile is prefetched, the rest of the crop is fetched after.
+        assert fetched[0] == [TileID(4, 3, 6)]
+        assert sorted(fetched[1]) == [TileID(4, 3, 7), TileID(4, 4, 6), TileID(4, 4, 7)]
+        assert stats.bg_tiles_fetched == 4
+        assert stats.bg_tiles_saved == 5
+        assert {"overlay", "basemap", "crop", "composite"} <= set(stats.stage_times)
+        assert res.getpixel((0, 0)) == (0, 0, 255)
+
+    @pytest.mark.parametrize("static_images", [False, True])
+    def test_static_images(self, static_images):
+        handler = type("Handler", (MapBoxHandler,), {"requests": []})
+        tile_ids = [TileID(4, x, y) for x in range(3, 6) for y in range(6, 9)]
+
+        class FakeRange(BaseMap):
+            _tile_size: int = 256
+
+        plan = TileArray.from_dict({t: Tile(t) for t in tile_ids})
+
+        def fetch(tile_array):
+            for tid in tile_array:
+                img = Image.new("RGBA", (256, 256))
+                if tid == min(tile_ids):
+                    img.paste((255, 0, 0, 255), (100, 100, 200, 200))
+                tile_array[tid] = Tile(tid, img=img)
+            return tile_array
+
+        left, bottom, right, top = mercantile.bounds(3, 6, 4)
+        bbox = LatLonBBox(left=left, bottom=bottom, right=right, top=top)
+        with local_server(handler) as url:
+            mb = MapBox(
+                token="test", base_url=url, high_res=False, static_images=static_images
+            )
+            res = FakeRange("").render_range_map(mb, plan, bbox, fetch, 512)
+        stats = res.info["render_stats"]
+        assert res.size == (512, 512)
+        assert res.getpixel((0, 0))[2] > 250
+        assert stats.bg_requests == len(handler.requests)
+        if static_images:
+            assert len(handler.requests) == 1
+            assert "basemap_window" in stats.stage_times
+            # 256px tiles at zoom 4 are 512px tiles at zoom 3.
+            center, size = handler.requests[0].rsplit("/", 2)[1:]
+            lon, lat, zoom = (float(v) for v in center.split(","))
+            assert (zoom, size) == (3, "512x512")
+            assert plan.bounds.left < lon < plan.bounds.right
+            assert plan.bounds.bottom < lat < plan.bounds.top
+        else:
+            assert len(handler.requests) == 4
+            assert all(r.startswith("/v4/") for r in handler.requests)
+
+    def test_static_images_antimeridian(self):
+        handler = type("Handler", (MapBoxHandler,), {"requests": []})
+        plan = empty_tilearray_from_ids([(2, x, 1) for x in (3, 4)])
+        with local_server(handler) as url:
+            mb = MapBox(token="test", base_url=url, static_images=True)
+            img = mb.get_window(plan, (128, 0, 384, 256), 256)
+        assert img.size == (256, 256)
+        center = handler.requests[0].rsplit("/", 2)[1]
+        lon, lat, _ = (float(v) for v in center.split(","))
+        # Centered on the antimeridian, not past it.
+        assert abs(lon) == pytest.approx(180)
+        assert -180 <= lon < 180
+
+    def test_tile_decoded_at_resolution(self, tmp_path):
+        cache = TileCache(path=tmp_path)
+        mb = MapBox(token="test", tile_cache=cache)
+        d = BytesIO()
+        Image.new("RGB", (512, 512), (0, 0, 255)).save(d, "JPEG")
+        cache.put(TileKey("mapbox", "satellite", "jpg90", 512, 2, 1, 1), d.getvalue())
+        # Served from the cached high res bytes, without a download.
+        assert mb.get_tile(TileID(2, 1, 1), resolution=256).resolution == 256
+        assert mb.get_tile(TileID(2, 1, 1)).resolution == 512
+
+    def test_low_res_download(self):
+        handler = type("Handler", (MapBoxHandler,), {"requests": []})
+        with local_server(handler) as url:
+            mb = MapBox(token="test", base_url=url)
+            assert mb.get_tile(TileID(2, 1, 1), resolution=256).resolution == 256
+            assert mb.get_tile(TileID(2, 1, 1), resolution=512).resolution == 512
+        # Only as big as needed.
+        assert handler.requests == [
+            "/v4/mapbox.satellite/2/1/1.jpg90",
+            "/v4/mapbox.satellite/2/1/1@2x.jpg90",
+        ]
+
+    def test_pyramid_tiles(self, tmp_path):
+        cache = TileCache(path=tmp_path)
+        colours = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+        for tid, colour in zip(TileID(2, 1, 1).children, colours):
+            d = BytesIO()
+            Image.new("RGB", (512, 512), colour).save(d, "PNG")
+            cache.put(TileKey("mapbox", "satellite", "jpg90", 512, *tid), d.getvalue())
+        NotFoundHandler.requests = []
+        with local_server(NotFoundHandler) as url:
+            mb = MapBox(token="test", base_url=url, tile_cache=cache)
+            # All 4 children are cached, so it's never downloaded.
+            parent = mb.get_tile(TileID(2, 1, 1))
+            assert NotFoundHandler.requests == []
+            assert parent.resolution == 512
+            assert parent.img.getpixel((128, 128)) == colours[0]
+            assert parent.img.getpixel((384, 384)) == colours[2]
+            # The download fails, so it's scaled up from its cached parent.
+            child = mb.get_tile(TileID(4, 6, 4))
+            assert len(NotFoundHandler.requests) == 1
+            assert child.resolution == 512
+            assert child.img.getpixel((256, 256)) == colours[1]
+            mb.pyramid_levels = 0
+            assert mb.get_tile(TileID(4, 6, 4)) is None
+
 
 class TestEbird:
     ebird: eBirdMap = eBirdMap()
@@ -416,20 +731,18 @@ class TestEbird:
         [
             (
                 "tui1",
-                [(4, 15, 9), (4, 15, 10), (4, 0, 9), (4, 0, 10)],
+                [(4, 15, 9), (4, 15, 10), (4, 16, 9), (4, 16, 10)],
             )
         ],
     )
     def test_get_tiles(self, species_code, expected_ids):
         res = self.ebird.get_tiles(species_code)
         print("res:\n", res)
-        for x in res:
-            for t in x.values():
-                t.save()
+        for t in res.values():
+            t.save()
 
-        for e in res:
-            for x in e:
-                assert tuple(x) in expected_ids
+        for x in res:
+            assert tuple(x) in expected_ids
 
     @pytest.mark.vcr("new")
     @pytest.mark.parametrize(
@@ -453,3 +766,229 @@ class TestEbird:
         res, res_no_data = self.ebird.make_map(species_code, self.mapbox, size)
         assert res_no_data == no_data
         res.save(f"final-ebird-{species_code}_{size}.png")
+
+
+class TestEbirdWMS:
+    @pytest.fixture
+    def handler(self):
+        return type("Handler", (WMSHandler,), {"requests": []})
+
+    def plan(self, xs, ys, z=2):
+        return empty_tilearray_from_ids([(z, x, y) for x in xs for y in ys])
+
+    def test_one_request(self, handler):
+        plan = self.plan((1, 2), (0, 1, 2))
+        with local_server(handler) as url:
+            ebird = eBirdMap(wms_url=url + "wms")
+            res = ebird.fetch_range_layer(plan, "RS1")
+        assert len(handler.requests) == 1
+        query = handler.requests[0]
+        assert (query["REQUEST"], query["WIDTH"], query["HEIGHT"]) == (
+            "GetMap",
+            "512",
+            "768",
+        )
+        assert query["CQL_FILTER"] == "result_set_id='RS1'"
+        left, bottom, right, top = map(float, query["BBOX"].split(","))
+        west = mercantile.xy_bounds(1, 0, 2)
+        east = mercantile.xy_bounds(2, 2, 2)
+        assert (left, top) == pytest.approx((west.left, west.top))
+        assert (right, bottom) == pytest.approx((east.right, east.bottom))
+        assert list(res) == list(plan)
+        for tid, tile in res.items():
+            assert tile.size == (256, 256)
+            colour = ((tid.x - 1) * 50, tid.y * 50, 0, 255)
+            assert tile.img.getpixel((128, 128)) == colour
+
+    def test_antimeridian(self, handler):
+        plan = self.plan((2, 3, 4), (1,))
+        with local_server(handler) as url:
+            ebird = eBirdMap(wms_url=url + "wms")
+            res = ebird.fetch_range_layer(plan, "RS1")
+        # One request for each side.
+        assert [q["WIDTH"] for q in handler.requests] == ["512", "256"]
+        colours = [res[TileID(2, x, 1)].img.getpixel((0, 0)) for x in (2, 3, 4)]
+        assert colours == [(0, 0, 255, 255), (50, 0, 255, 255), (0, 0, 0, 255)]
+
+    def test_fallback(self, handler):
+        handler.broken = True
+        plan = self.plan((1, 2), (1, 2))
+        with local_server(handler) as url:
+            ebird = eBirdMap(wms_url=url + "wms", map_tile_url=url + "gmaps")
+            res = ebird.fetch_range_layer(plan, "RS1")
+        assert len(handler.requests) == 1 + len(plan)
+        assert sorted(res) == sorted(plan)
+        assert all(t.size == (256, 256) for t in res.values())
+
+
+class TestGBIFEmptyTiles:
+    def test_no_content(self):
+        handler = type("Handler", (NotFoundHandler,), {"requests": [], "status": 204})
+        tids = [TileID(2, 1, 1), TileID(2, 1, 1), TileID(2, 2, 1)]
+        with local_server(handler) as url:
+            gbif = GBIF(base_url=url)
+            tiles = [gbif.get_hex_tile(tid, taxonKey=1) for tid in tids]
+            # The same tile for another taxon isn't known to be empty.
+            other = gbif.get_hex_tile(tids[0], taxonKey=2)
+        assert len(handler.requests) == 3
+        assert gbif.empty_tiles.stats == {"hits": 1, "misses": 3, "tiles": 3}
+        for tile in tiles + [other]:
+            assert tile.empty
+            assert tile.size == (512, 512)
+        assert tiles[0].img is tiles[2].img is other.img
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in overlay tile server that honours If-None-Match. Change etag to change the tile.
+    """
+
+    requests = []
+    etag = '"v1"'
+
+    def do_GET(self):
+        self.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.etag)
+            self.end_headers()
+            return
+        body = Image.new("RGBA", (512, 512), (255, 0, 0, 255)).asbytes()
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRevalidation:
+    # Decoded tiles in image_cache are revalidated all the same.
+    @pytest.mark.parametrize("cache_images", [False, True])
+    def test_gbif(self, tmp_path, cache_images):
+        handler = type("Handler", (ETagHandler,), {"requests": []})
+        cache = TileCache(path=tmp_path)
+        tid = TileID(2, 1, 1)
+        with local_server(handler) as url:
+            gbif = GBIF(
+                base_url=url,
+                tile_cache=cache,
+                image_cache=ImageCache() if cache_images else None,
+                max_age=0,
+            )
+            first = gbif.get_hex_tile(tid, taxonKey=1)
+            # Stale straight away, so revalidated.
+            second = gbif.get_hex_tile(tid, taxonKey=1)
+            handler.etag = '"v2"'
+            third = gbif.get_hex_tile(tid, taxonKey=1)
+            gbif.max_age = 60
+            fourth = gbif.get_hex_tile(tid, taxonKey=1)
+        assert handler.requests == [None, '"v1"', '"v1"']
+        for tile in (first, second, third, fourth):
+            assert tile.img.getpixel((0, 0)) == (255, 0, 0, 255)
+        stats = gbif.revalidation
+        assert (stats.fresh, stats.not_modified, stats.modified) == (1, 1, 1)
+        assert stats.full_fetches == 2
+        # The 304 and the fresh tile.
+        body = Image.new("RGBA", (512, 512), (255, 0, 0, 255)).asbytes()
+        assert stats.bytes_saved == 2 * len(body)
+        assert stats.added_latency is not None
+
+    @pytest.mark.parametrize("cache_images", [False, True])
+    def test_ebird(self, tmp_path, cache_images):
+        handler = type("Handler", (ETagHandler,), {"requests": []})
+        cache = TileCache(path=tmp_path)
+        with local_server(handler) as url:
+            ebird = eBirdMap(
+                map_tile_url=url,
+                tile_cache=cache,
+                image_cache=ImageCache() if cache_images else None,
+                max_age=0,
+            )
+            for _ in range(2):
+                tile = ebird.download_tile(TileID(2, 1, 1), "RS1")
+                assert tile.size == (512, 512)
+        assert handler.requests == [None, '"v1"']
+        assert ebird.revalidation.not_modified == 1
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the GBIF and eBird metadata endpoints.
+    """
+
+    requests = []
+    bbox = {"minLat": 15, "maxLat": 55, "minLng": -127, "maxLng": 14}
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.requests.append(path)
+        if path.endswith("/rsid"):
+            body = b"RS108970032"
+        elif "/species/search/" in path:
+            result = {"species": "Psaltriparus minimus", "nubKey": 2494988}
+            body = json.dumps({"count": 1, "results": [result]}).encode()
+        else:
+            body = json.dumps(self.bbox).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMetadataCache:
+    def test_warm_lookups(self, tmp_path):
+        handler = type("Handler", (MetadataHandler,), {"requests": []})
+        path = tmp_path / "metadata.json"
+        with local_server(handler) as url:
+            for _ in range(2):
+                # A new cache each time, loaded from the last one's file.
+                cache = MetadataCache(path=path)
+                gbif = GBIF(base_url=url, metadata_cache=cache)
+                ebird = eBirdMap(base_url=url, metadata_cache=cache)
+                assert gbif.lookup_species("Bushtit") == (
+                    "Psaltriparus minimus",
+                    2494988,
+                )
+                bbox = gbif.get_bbox(2494988)
+                assert (bbox.left, bbox.top, bbox.right, bbox.bottom) == (
+                    -127,
+                    55,
+                    14,
+                    15,
+                )
+                assert ebird.get_bbox("bushti") == bbox
+                assert ebird.get_rsid("bushti", 0) == "RS108970032"
+                assert ebird.get_rsid("bushti", 8) == "RS108970032"
+        # Only the first round made any requests.
+        assert len(handler.requests) == 5
+        assert cache.stats["hits"] == 5
+        assert cache.stats["misses"] == 0
+
+    def test_not_found_refetched(self, tmp_path):
+        class NoSpeciesHandler(MetadataHandler):
+            requests = []
+
+            def do_GET(self):
+                self.requests.append(urlparse(self.path).path)
+                body = json.dumps({"count": 0, "results": []}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        path = tmp_path / "metadata.json"
+        with local_server(NoSpeciesHandler) as url:
+            for _ in range(2):
+                cache = MetadataCache(path=path)
+                gbif = GBIF(base_url=url, metadata_cache=cache)
+                assert gbif.lookup_species("Snark") == (None, None)
+        # Nothing was cached, so the second round asked again.
+        assert len(NoSpeciesHandler.requests) == 2
+        assert cache.stats["hits"] == 0
@@ -0,0 +1,83 @@
+import asyncio
+import pytest
+import sys
+import os
+
+sys.path.append(os.getcwd())
+
+from static_maps.cache import RenderCache, RenderKey
+from static_maps.render_pool import RenderPool
+
+
+# Jobs and make_maps are sent to the workers, so need to be module level.
+def make_maps():
+    return {"pid": os.getpid()}
+
+
+def echo(maps, data):
+    return data
+
+
+def with_pid(maps, data):
+    return data, maps["pid"]
+
+
+def failed(maps):
+    return None
+
+
+def raises(maps):
+    raise ValueError("render failed")
+
+
+@pytest.fixture
+def pool():
+    pool = RenderPool(make_maps, max_workers=1, render_cache=RenderCache())
+    yield pool
+    pool.shutdown()
+
+
+def shm_blocks():
+    # Only shared_memory blocks, not the pool's own semaphores.
+    if not os.path.isdir("/dev/shm"):
+        return set()
+    return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")}
+
+
+class TestRenderPool:
+    @pytest.mark.parametrize("data", [b"png" * 100000, b""], ids=["png", "empty"])
+    def test_render(self, pool, data):
+        before = shm_blocks()
+        assert asyncio.run(pool.render(echo, data)) == data
+        # The parent frees each block once it's read.
+        assert shm_blocks() <= before
+        assert pool.renders == 1
+
+    def test_tuple(self, pool):
+        data, pid = asyncio.run(pool.render(with_pid, b"png"))
+        assert data == b"png"
+        # Rendered in a worker, with maps made there.
+        assert pid != os.getpid()
+
+    def test_failed(self, pool):
+        assert asyncio.run(pool.render(failed, key="dodo")) is None
+        assert "dodo" not in pool.render_cache
+        with pytest.raises(ValueError):
+            asyncio.run(pool.render(raises))
+
+    def test_render_cache(self, pool):
+        key = RenderKey("gbif+mapbox", 2494988, 512)
+
+        async def renders():
+            # Rendered once, while the others wait for it.
+            first = await asyncio.gather(
+                *(pool.render(echo, b"png", key=key) for _ in range(3))
+            )
+            return first + [await pool.render(echo, b"other", key=key)]
+
+        assert asyncio.run(renders()) == [b"png"] * 4
+        assert pool.renders == 1
+        assert pool.render_cache.stats["misses"] == 1
+        assert pool.render_cache.stats["coalesced"] == 2
+        assert pool.render_cache.stats["hits"] == 1
+        assert pool.stats["running"] == 0
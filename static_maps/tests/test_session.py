@@ -0,0 +1,112 @@
+import pytest
+import sys
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import requests
+
+sys.path.append(os.getcwd())
+
+from static_maps.imager import Image
+from static_maps.mapper import MapBox
+from static_maps.session import ProviderSession
+from static_maps.tiles import TileID
+
+
+@contextmanager
+def keep_alive_server(statuses=()):
+    """
+    Stand-in server that keeps connections open. Answers with each of statuses in turn, then 200 with a tile.
+    """
+    statuses = list(statuses)
+    d = BytesIO()
+    Image.new("RGB", (256, 256), (0, 0, 255)).save(d, "JPEG")
+    tile = d.getvalue()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            status = statuses.pop(0) if statuses else 200
+            body = tile if status == 200 else b""
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", "0")
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class TestProviderSession:
+    def test_reuse(self):
+        session = ProviderSession()
+        assert session.stats == {}
+        with keep_alive_server() as url:
+            for _ in range(5):
+                assert session.get(url).status_code == 200
+        host = url[len("http://") : -1]
+        assert session.stats == {host: {"requests": 5, "connections": 1, "reused": 4}}
+
+    @pytest.mark.parametrize("statuses", [(503,), (429, 500)])
+    def test_retry(self, statuses):
+        session = ProviderSession(backoff=0)
+        with keep_alive_server(statuses) as url:
+            res = session.get(url)
+        assert res.status_code == 200
+        (host_stats,) = session.stats.values()
+        assert host_stats["requests"] == len(statuses) + 1
+
+    def test_retries_run_out(self):
+        session = ProviderSession(retries=1, backoff=0)
+        with keep_alive_server((502, 503, 504)) as url:
+            res = session.get(url)
+        # The last response is returned, not raised.
+        assert res.status_code == 503
+
+    def test_unreachable_not_retried(self):
+        # A port nothing is listening on.
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        session = ProviderSession(backoff=10)
+        start = time.perf_counter()
+        with pytest.raises(requests.exceptions.ConnectionError):
+            session.get(f"http://127.0.0.1:{port}/")
+        # Would be tens of seconds with backoff.
+        assert time.perf_counter() - start < 5
+
+    def test_not_retried(self):
+        session = ProviderSession(backoff=0)
+        with keep_alive_server((404,)) as url:
+            assert session.get(url).status_code == 404
+            assert session.get(url).status_code == 200
+
+
+def test_map_connection_reuse():
+    with keep_alive_server() as url:
+        mapbox = MapBox(token="test", base_url=url, high_res=False, max_workers=2)
+        tiles = mapbox.get_tiles([TileID(2, x, y) for x in range(4) for y in range(2)])
+    assert len(tiles) == 8
+    assert mapbox.session.pool_size == 2
+    (host_stats,) = mapbox.connection_stats.values()
+    assert host_stats["requests"] == 8
+    # One connection for each download thread, at most.
+    assert host_stats["connections"] <= 2
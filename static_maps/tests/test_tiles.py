@@ -6,6 +6,7 @@ from dataclasses import dataclass
 
 import sys
 import os
+from io import BytesIO
 
 sys.path.append(os.getcwd())
 
@@ -16,8 +17,14 @@ from static_maps.tiles import (
     constants,
     empty_tilearray_from_ids,
     bounding_box_to_tiles,
+    make_child,
+    make_parent,
+    mosaic_content_bboxes,
+    split_mosaic,
 )
+from static_maps.imager import swap_left_right
 from static_maps.geo import LatLonBBox, PixBbox
+from static_maps import imager, tiles
 
 import PIL.Image as Img
 
@@ -157,6 +164,41 @@ class TestTileIDs:
         tid = TileID(6, -8, 42)
         assert tid.urlform == "6/-8/42"
 
+    @pytest.mark.parametrize(
+        "test_id",
+        [
+            (1, 0, 0),
+            (4, 10, 9),
+            (8, 255, 3),
+            (15, 16827, 10771),
+        ],
+    )
+    # Relatives are calculated arithmetically, so make sure they still match mercantile.
+    def test_relatives(self, test_id):
+        tid = TileID(test_id)
+        mt = tid.asmrcantile
+        assert tid.parent == TileID(mercantile.parent(mt))
+        assert tid.children == [TileID(c) for c in mercantile.children(mt)]
+        assert tid.siblings == [
+            TileID(c) for c in mercantile.children(mercantile.parent(mt))
+        ]
+
+    def test_fast(self):
+        tid = TileID.fast(2, 1, 3)
+        assert tid == TileID(2, 1, 3)
+        assert hash(tid) == hash(TileID(z=2, x=1, y=3))
+        with pytest.raises(FrozenInstanceError):
+            tid.x = 0
+
+    def test_ordering(self):
+        tids = [TileID(2, 1, 0), TileID(1, 1, 1), TileID(2, 0, 3), TileID(2, 0, 1)]
+        assert sorted(tids) == [
+            TileID(1, 1, 1),
+            TileID(2, 0, 1),
+            TileID(2, 0, 3),
+            TileID(2, 1, 0),
+        ]
+
 
 class TestTile:
     @pytest.mark.parametrize(
@@ -289,6 +331,45 @@ class TestTileArray:
         tile_array = self.create_tilearray(tile_ids, images)
         assert tile_array.xy_dims == dims
 
+    def test_extents(self, tile_ids, images):
+        tile_array = self.create_tilearray(tile_ids, images)
+        assert tile_array.x_min == min(t.x for t in tile_ids)
+        assert tile_array.x_max == max(t.x for t in tile_ids)
+        assert tile_array.y_min == min(t.y for t in tile_ids)
+        assert tile_array.y_max == max(t.y for t in tile_ids)
+        for tid in tile_ids:
+            assert tile_array.tile_at(tid.x, tid.y) is tile_array[tid]
+        assert tile_array.tile_at(tile_array.x_max + 1, tile_array.y_max) is None
+
+    def test_extents_delete(self, tile_ids, images):
+        tile_array = self.create_tilearray(tile_ids, images)
+        removed = [t for t in tile_ids if t.x == tile_array.x_max]
+        for tid in removed:
+            del tile_array[tid]
+        assert tile_array.xy_dims == (1, 2)
+        assert tile_array.tile_at(removed[0].x, removed[0].y) is None
+
+    def test_bounds_match_tiles(self, tile_ids, images):
+        tile_array = self.create_tilearray(tile_ids, images)
+        bboxes = [t.bounds for t in tile_array.values()]
+        res = tile_array.bounds
+        assert res.left == min(x.left for x in bboxes)
+        assert res.right == max(x.right for x in bboxes)
+        assert res.top == max(x.top for x in bboxes)
+        assert res.bottom == min(x.bottom for x in bboxes)
+
+    def test_content_bbox(self, tile_ids, images):
+        blank = [Img.new("RGBA", x.size) for x in images]
+        tile_array = self.create_tilearray(tile_ids, blank)
+        # A dot in two of the tiles, so the bounding box spans tiles.
+        tile_array[tile_ids[0]].img.putpixel((200, 10), (255, 0, 0, 255))
+        tile_array[tile_ids[-1]].img.putpixel((30, 100), (255, 0, 0, 255))
+        mosaic = tile_array._composite_all()
+        assert tile_array.content_bbox == mosaic.getbbox()
+        bbox, swapped_bbox = mosaic_content_bboxes([tile_array])
+        assert bbox == mosaic.getbbox()
+        assert swapped_bbox == swap_left_right(mosaic).getbbox()
+
     def test_mixed_zoom(self, tile_ids, images):
         fiddled_ids = [TileID(z + 1 if x % 2 == 0 else z, x, y) for z, x, y in tile_ids]
         with pytest.raises(TileArray.MixedZoomError):
@@ -567,14 +648,172 @@ class TestFindTiles:
             assert am_invalid
             assert len(res) == 0
             assert res.zoom is not None
-        elif len(res) == 1:
-            assert res[0].zoom == end_zoom
-            assert not am_invalid
         else:
-            assert res[0].zoom == end_zoom
-            assert res[1].zoom == end_zoom
+            assert res.zoom == end_zoom
             assert not am_invalid
+            # Contiguous, even across the antimeridian.
+            x_dim, y_dim = res.xy_dims
+            assert len(res) == x_dim * y_dim
         # assert False
 
+    @pytest.mark.parametrize(
+        "bbox",
+        [
+            LatLonBBox(west=160.15, south=-53.38, east=-176.17, north=-25.13),
+            LatLonBBox(west=165, north=-29, east=185, south=-53),
+        ],
+    )
+    def test_bbox_to_tiles_wrapped(self, bbox):
+        res = bounding_box_to_tiles(bbox)
+        world = 2 ** res.zoom
+        assert res.x_min < world <= res.x_max
+        # Tiles past the antimeridian are the same tiles the server has, one world over.
+        west, east = bbox.am_split()
+        normalized = {tid.normalized for tid in res}
+        for part in (west, east):
+            bounds = (part.left, part.bottom, part.right, part.top)
+            for t in mercantile.tiles(*bounds, res.zoom):
+                assert TileID(t) in normalized
+        wrapped = TileID(res.zoom, res.x_max, res.y_min)
+        assert wrapped.normalized == TileID(res.zoom, res.x_max - world, res.y_min)
+        assert (
+            wrapped.normalized.urlform == f"{res.zoom}/{res.x_max - world}/{res.y_min}"
+        )
+        assert res.bounds.right > 180
+
+    def test_bbox_to_tiles_memoized(self):
+        bbox = LatLonBBox(west=63.44, south=6.77, east=109.26, north=35.08)
+        first = bounding_box_to_tiles(bbox)
+        tid = next(iter(first))
+        first[tid].img = Img.new("RGB", (256, 256), (255, 0, 0))
+        hits = tiles._plan_bounding_box.cache_info().hits
+        second = bounding_box_to_tiles(bbox)
+        assert tiles._plan_bounding_box.cache_info().hits == hits + 1
+        # Each call gets its own TileArray.
+        assert second is not first
+        assert list(second.keys()) == list(first.keys())
+        assert second[tid].img.getbbox() is None
+
     # def test_alternative_bbox(self, bad_bbox, bbox_guess):
     #     pass
+
+
+class TestPyramid:
+    colours = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+
+    def children(self, tid, size=256):
+        return [
+            Tile(c, img=Img.new("RGB", (size, size), colour))
+            for c, colour in zip(tid.children, self.colours)
+        ]
+
+    @pytest.mark.parametrize("tid", [TileID(3, 2, 5), TileID(3, 9, 5)])
+    @pytest.mark.parametrize("size, resolution", [(256, None), (128, 256)])
+    def test_make_parent(self, tid, size, resolution):
+        parent = make_parent(reversed(self.children(tid, size)), resolution)
+        assert parent.tid == tid
+        assert parent.size == (256, 256)
+        # children are top-left, top-right, bottom-right, bottom-left.
+        for (x, y), colour in zip(
+            [(64, 64), (192, 64), (192, 192), (64, 192)], self.colours
+        ):
+            assert parent.img.getpixel((x, y)) == colour
+
+    def test_make_parent_not_siblings(self):
+        kids = self.children(TileID(3, 2, 5))
+        assert make_parent(kids[:3]) is None
+        kids[0] = Tile(TileID(4, 0, 0), img=kids[0].img)
+        assert make_parent(kids) is None
+
+    @pytest.mark.parametrize("depth", [1, 2])
+    def test_make_child(self, depth):
+        parent = make_parent(self.children(TileID(3, 2, 5)))
+        # The top-right corner of the parent.
+        tid = TileID(3 + depth, (2 << depth) + (1 << depth) - 1, 5 << depth)
+        child = make_child(parent, tid, 512)
+        assert child.tid == tid
+        assert child.size == (512, 512)
+        assert child.img.getpixel((256, 256)) == self.colours[1]
+        assert make_child(parent, TileID(4, 0, 0)) is None
+        assert make_child(parent, parent.tid) is None
+
+
+def test_empty_tile():
+    a = Tile.new_empty(TileID(2, 1, 1), 512)
+    b = Tile.new_empty(TileID(2, 2, 1), 512, name="b")
+    assert a.empty and a.blank
+    assert a.size == (512, 512)
+    assert a.img is b.img
+    assert a.content_bbox is None
+    # Fully transparent tiles are empty too, but not blank.
+    transparent = Tile(TileID(2, 1, 1), img=Img.new("RGBA", (512, 512)))
+    assert transparent.empty and not transparent.blank
+    assert not Tile(TileID(2, 1, 1), img=Img.new("RGB", (512, 512))).empty
+
+
+def test_tile_content_bbox():
+    img = Img.new("RGBA", (256, 256))
+    img.putpixel((40, 10), (255, 0, 0, 255))
+    tile = Tile(TileID(2, 1, 1), img=img)
+    assert tile.content_bbox == (40, 10, 41, 11)
+    # A new image clears the box kept from the last one.
+    img = Img.new("RGBA", (256, 256))
+    img.putpixel((100, 200), (255, 0, 0, 255))
+    tile.img = img, False
+    assert tile.content_bbox == (100, 200, 101, 201)
+    tile.img = Img.new("RGBA", (256, 256)), False
+    assert tile.content_bbox is None and tile.empty
+
+
+def test_composite_layer_skips_empty():
+    tids = [TileID(2, 1, 1), TileID(2, 2, 1)]
+    bg = TileArray.from_dict(
+        {t: Tile(t, img=Img.new("RGB", (256, 256), (0, 0, 255))) for t in tids}
+    )
+    fg = TileArray.from_dict(
+        {
+            tids[0]: Tile.new_empty(tids[0]),
+            tids[1]: Tile(tids[1], img=Img.new("RGBA", (256, 256), (255, 0, 0, 255))),
+        }
+    )
+    res = bg._composite_layer(fg)
+    # Not blended, so it's the same tile.
+    assert res[tids[0]] is bg[tids[0]]
+    assert res[tids[1]].img.getpixel((0, 0)) != (0, 0, 255)
+
+
+@pytest.mark.parametrize(
+    "tile_ids",
+    [
+        [TileID(2, x, y) for x in (1, 2) for y in (0, 1, 2)],
+        # Crossing the antimeridian.
+        [TileID(2, x, y) for x in (3, 4) for y in (1, 2)],
+    ],
+)
+def test_split_mosaic(tile_ids):
+    tile_array = empty_tilearray_from_ids(tile_ids)
+    for tid in tile_ids:
+        colour = (tid.x * 50, tid.y * 50, 0, 255)
+        tile_array[tid] = Tile(tid, img=Img.new("RGBA", (64, 64), colour))
+    res = split_mosaic(tile_array._composite_all(), tile_ids, name="split")
+    assert list(res) == tile_ids
+    assert res.xy_dims == tile_array.xy_dims
+    for tid, tile in res.items():
+        assert tile.size == (64, 64)
+        assert tile.name == "split"
+        assert tile.img.getcolors() == [(64 * 64, (tid.x * 50, tid.y * 50, 0, 255))]
+
+
+def test_split_mosaic_content_bbox():
+    tile_ids = [TileID(1, x, y) for y in range(2) for x in range(2)]
+    mosaic = Img.new("RGBA", (512, 512), (0, 0, 0, 0))
+    mosaic.putpixel((300, 10), (255, 0, 0, 255))
+    # Decoded like a WMS response, so the mosaic's box is already known.
+    d = BytesIO()
+    mosaic.save(d, "PNG")
+    res = split_mosaic(imager.image_from_bytes(d.getvalue()), tile_ids)
+    for tile in res.values():
+        assert tile.content_bbox == tile.img.getbbox()
+    assert res[TileID(1, 1, 0)].content_bbox == (44, 10, 45, 11)
+    assert res[TileID(1, 0, 0)].content_bbox is None
+    assert res.content_bbox == (300, 10, 301, 11)
@@ -1,8 +1,9 @@
 from types import new_class
 import warnings
 from collections import namedtuple
-from dataclasses import dataclass, field, InitVar
-from io import BytesIO
+from dataclasses import dataclass, field, FrozenInstanceError, InitVar
+from functools import lru_cache, total_ordering
+import math
 from pathlib import Path
 from typing import Dict, List, Tuple
 from typing import Any, Iterable, Optional, Union
@@ -21,45 +22,78 @@ from pprint import pprint
 Point = namedtuple("Point", ("x", "y"))
 
 
-@dataclass(frozen=True)
-class BaseID:
-    z: int
-    x: int
-    y: int
+def _zxy(z: int, x: int, y: int) -> Tuple[int, int, int]:
+    """
+    Gives TileID's generic constructor the same argument handling (and TypeErrors) as a plain z, x, y signature.
+    """
+    return z, x, y
+
+
+# Offset and width for packing x and y into a TileID key. Allows -2 ** 31 <= x, y < 2 ** 31, which covers wrapped tiles too.
+_key_offset = 2 ** 31
+_key_bits = 32
 
 
-class TileID(BaseID):
+@total_ordering
+class TileID:
     """
     TileID to represent the z(zoom), x and y coordinates of a tile.
     Accepts either a single mercantile.Tile, and a combination list iterables (lists and tuples) and kwargs.
     While this may on the surface look hacky, it works better than several alternatives attempted.
+    TileIDs are immutable, and hash and sort on a packed (z, x, y) integer key.
+    x may run past 2 ** z for tiles east of the antimeridian in an array that crosses it, see normalized.
+    Use TileID.fast(z, x, y) to skip the argument parsing and warnings when the values are known to be good.
     """
 
+    __slots__ = ("z", "x", "y", "_key")
     warn: bool = True
 
     def __init__(self, *args: Tuple[Any], **kwargs: Dict[str, Any]) -> None:
-        new_args = []
-        for a in args:
-            if isinstance(a, mercantile.Tile):
-                new_args += [a.z, a.x, a.y]
-            else:
-                try:
-                    iter(a)
-                    new_args += [x for x in a]
-                except TypeError:
-                    new_args += [a]
-        args = tuple(new_args)
-        super().__init__(*args, **kwargs)
+        if len(args) == 3 and not kwargs and all(type(a) is int for a in args):
+            z, x, y = args
+        else:
+            new_args = []
+            for a in args:
+                if isinstance(a, mercantile.Tile):
+                    new_args += [a.z, a.x, a.y]
+                else:
+                    try:
+                        iter(a)
+                        new_args += [x for x in a]
+                    except TypeError:
+                        new_args += [a]
+            z, x, y = _zxy(*new_args, **kwargs)
+        self._set(z, x, y)
         self._warn()
 
+    @classmethod
+    def fast(cls, z: int, x: int, y: int) -> "TileID":
+        """
+        Creates a TileID without any argument parsing or validation.
+        """
+        tid = object.__new__(cls)
+        tid._set(z, x, y)
+        return tid
+
+    def _set(self, z: int, x: int, y: int) -> None:
+        object.__setattr__(self, "z", z)
+        object.__setattr__(self, "x", x)
+        object.__setattr__(self, "y", y)
+        key = (
+            (z << (2 * _key_bits))
+            | ((x + _key_offset) << _key_bits)
+            | (y + _key_offset)
+        )
+        object.__setattr__(self, "_key", key)
+
     def _warn(self) -> None:
         """
         Warnings for things that will probably be a problem, but may not always be.
-         - Warns if z and y are outside the maximum bounds of the zxy tile system.
+         - Warns if z and y are outside the maximum bounds of the zxy tile system. x can wrap around the world once.
          - Warns is the zoom out outside the allowed range specified in constants.py
         """
         if self.warn:
-            if self.y > 2 ** self.z or self.x > 2 ** self.z:
+            if self.y > 2 ** self.z or self.x > 2 ** (self.z + 1):
                 warnings.warn("x and y should be in the range [0..2 ** z].")
             if self.x < 0 or self.y < 0:
                 warnings.warn("x and y sould be > 0")
@@ -68,6 +102,44 @@ class TileID(BaseID):
                     f"zoom not in [{constants.min_zoom}..{constants.max_zoom}]."
                 )
 
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise FrozenInstanceError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self, name: str) -> None:
+        raise FrozenInstanceError(f"cannot delete field '{name}'")
+
+    def __repr__(self) -> str:
+        return f"TileID(z={self.z}, x={self.x}, y={self.y})"
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ is self.__class__:
+            return self._key == other._key
+        return NotImplemented
+
+    def __lt__(self, other: "TileID") -> bool:
+        if other.__class__ is self.__class__:
+            return self._key < other._key
+        return NotImplemented
+
+    def __reduce__(self) -> Tuple[Any, Tuple[int, int, int]]:
+        return (self.fast, (self.z, self.x, self.y))
+
+    def __copy__(self) -> "TileID":
+        return self
+
+    def __deepcopy__(self, memo: Dict) -> "TileID":
+        return self
+
+    @property
+    def key(self) -> int:
+        """
+        The packed (z, x, y) integer this TileID hashes and sorts on.
+        """
+        return self._key
+
     @property
     def zoom(self) -> int:
         return self.z
@@ -82,42 +154,86 @@ class TileID(BaseID):
     def asmrcantile(self) -> mercantile.Tile:
         return mercantile.Tile(x=self.x, y=self.y, z=self.z)
 
+    @property
+    def normalized(self) -> "TileID":
+        """
+        This tile with x wrapped back into [0..2 ** z), which is what tile servers and caches expect.
+        """
+        x = self.x % (1 << self.z)
+        if x == self.x:
+            return self
+        return TileID.fast(self.z, x, self.y)
+
     @property
     def urlform(self):
         return f"{self.z}/{self.x}/{self.y}"
 
     @property
-    def parent(self) -> "TileID":
+    def parent(self) -> Optional["TileID"]:
         """
-        Return the TileId for the parent.
+        Return the TileId for the parent, or None at zoom 0.
         """
-        return TileID(mercantile.parent(self.asmrcantile))
+        if self.z == 0:
+            return None
+        return TileID.fast(self.z - 1, self.x >> 1, self.y >> 1)
 
     @property
     def children(self) -> List["TileID"]:
         """
         Returns a list of this tile's 4 child tile ids.
+        Ordered the same as mercantile: top-left, top-right, bottom-right, bottom-left.
         """
-        return [TileID(mt) for mt in mercantile.children(self.asmrcantile)]
+        z = self.z + 1
+        x = self.x << 1
+        y = self.y << 1
+        return [
+            TileID.fast(z, x, y),
+            TileID.fast(z, x + 1, y),
+            TileID.fast(z, x + 1, y + 1),
+            TileID.fast(z, x, y + 1),
+        ]
 
     @property
     def siblings(self) -> List["TileID"]:
         """
-        Returns a list of this tile's siblings.
+        Returns a list of this tile's siblings. At zoom 0, the tile is its own only sibling.
         """
+        if self.z == 0:
+            return [self]
+        z = self.z
+        x = self.x & ~1
+        y = self.y & ~1
         return [
-            TileID(mt)
-            for mt in mercantile.children(mercantile.parent(self.asmrcantile))
+            TileID.fast(z, x, y),
+            TileID.fast(z, x + 1, y),
+            TileID.fast(z, x + 1, y + 1),
+            TileID.fast(z, x, y + 1),
         ]
 
 
+# Placeholder image for tiles that haven't been filled yet.
+_blank_image = imager.blank()
+
+
+@lru_cache(maxsize=None)
+def _empty_image(mode: str, size: int) -> "Image":
+    """
+    Shared image for empty tiles, see Tile.new_empty(). Read only, so anything pasted onto it copies it first.
+    """
+    img = imager.blank(mode, (size, size))
+    img.readonly = 1
+    return img
+
+
 @dataclass
 class Tile:
     tid: TileID
-    img: "Image" = field(default=imager.blank())
+    img: "Image" = field(default=_blank_image)
     name: str = "tile"
     resolution: int = 256
-    blank: bool = True
+    # Set from the image if not given: True for the placeholder image, or with tile.img = img, True.
+    blank: Optional[bool] = None
+    _content_bbox: Any = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         self.resolution = self.img.size[0]
@@ -145,22 +261,39 @@ class Tile:
         """
         if name == "img":
             img = value
-            self.blank = False
-            blank = False
+            blank = img is _blank_image
             if isinstance(value, tuple):
                 img, blank = value
-            if blank:
-                self.blank = blank
+            object.__setattr__(self, "blank", blank)
+            object.__setattr__(self, "_content_bbox", None)
             self.resolution = img.size[0]
             object.__setattr__(self, "img", img)
+        elif name == "blank" and value is None:
+            # Not given, so keep what the image set.
+            return
         else:
             object.__setattr__(self, name, value)
 
     @property
     def asbytes(self) -> bytes:
-        d = BytesIO()
-        self.img.save(d, "png")
-        return BytesIO(d.getvalue())
+        return self.img.asbytes()
+
+    @classmethod
+    def new_empty(
+        cls, tid: TileID, size: int = 256, name: str = "tile", mode: str = "RGBA"
+    ) -> "Tile":
+        """
+        Makes a tile known to have nothing in it, like a map provider's "no data" response.
+        Empty tiles of the same size and mode share one read-only transparent image, so making one doesn't allocate any pixels.
+        """
+        return cls(tid, img=_empty_image(mode, size), name=name, blank=True)
+
+    @property
+    def empty(self) -> bool:
+        """
+        True if there's nothing to draw from this tile: it's blank, or all of its pixels are transparent.
+        """
+        return self.blank or self.content_bbox is None
 
     @property
     def center(self) -> Point:
@@ -226,6 +359,21 @@ class Tile:
     def __len__(self) -> int:
         return 0 if self.blank else self.resolution
 
+    @property
+    def content_bbox(self) -> Optional[imager.PixBbox]:
+        """
+        Bounding box of the tile's non-transparent pixels, or None if it's blank or fully transparent.
+        Found the first time it's needed, and kept until the tile's image is replaced with tile.img = img.
+        The image shouldn't be edited in place after that.
+        """
+        if self.blank:
+            return None
+        if self._content_bbox is None:
+            bbox = imager.content_bbox(self.img)
+            # Wrapped, so a fully transparent tile isn't scanned again either.
+            object.__setattr__(self, "_content_bbox", (bbox,))
+        return self._content_bbox[0]
+
     def composite_image(self, foreground_tile: "Tile") -> "Tile":
         new_img = imager.transparency_composite(self.img, foreground_tile.img)
         return Tile(self.tid, img=new_img)
@@ -235,11 +383,28 @@ class Tile:
 class TileArray(dict):
     """
     Stores a 2d array of tiles. Tiles are accessed by their TileID.
+    x coordinates wrap modulo 2 ** zoom, so an array crossing the antimeridian carries on past x = 2 ** zoom - 1 and stays contiguous.
     Internally, stores data as a dictionary, with the key being a TileID and the value being the Tile.
+    Alongside the dictionary, tiles are kept in a dense grid offset by the array's origin (x_min, y_min).
+    The extents and the lat/lon bounds are updated as tiles are added, so reading them doesn't scan every tile.
     """
 
     zoom_level: int = None
     name: str = "TileArray"
+    # Tiles that couldn't be filled, and why. Set by the map providers when downloads fail.
+    failed: Dict[TileID, Exception] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+    _x_min: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+    _x_max: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+    _y_min: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+    _y_max: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+    _grid: List[List[Optional[Tile]]] = field(
+        default_factory=list, init=False, repr=False, compare=False
+    )
+    _bounds: Optional[Tuple[float, float, float, float]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     def __post__init__(self) -> None:
         s = set(t.z for t in self.keys())
@@ -272,7 +437,80 @@ class TileArray(dict):
             self.zoom = k.z
         elif self.zoom != k.z:
             raise self.MixedZoomError
-        return super().__setitem__(k, v)
+        super().__setitem__(k, v)
+        self._grid_set(k.x, k.y, v)
+
+    def __delitem__(self, k: TileID) -> None:
+        super().__delitem__(k)
+        self._reindex()
+
+    def pop(self, k: TileID, *args: Any) -> Tile:
+        v = super().pop(k, *args)
+        self._reindex()
+        return v
+
+    def popitem(self) -> Tuple[TileID, Tile]:
+        item = super().popitem()
+        self._reindex()
+        return item
+
+    def clear(self) -> None:
+        super().clear()
+        self._reindex()
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def setdefault(self, k: TileID, default: Tile = None) -> Tile:
+        if k not in self:
+            self[k] = default
+        return self[k]
+
+    def _grid_set(self, x: int, y: int, tile: Tile) -> None:
+        """
+        Puts a tile into the dense grid, growing the grid and moving its origin if needed.
+        """
+        if self._x_min is None:
+            self._x_min = self._x_max = x
+            self._y_min = self._y_max = y
+            self._grid = [[None]]
+            self._bounds = None
+        elif not (self._x_min <= x <= self._x_max and self._y_min <= y <= self._y_max):
+            x_min = min(self._x_min, x)
+            x_max = max(self._x_max, x)
+            y_min = min(self._y_min, y)
+            y_max = max(self._y_max, y)
+            grid = [[None] * (x_max - x_min + 1) for _ in range(y_max - y_min + 1)]
+            x_off = self._x_min - x_min
+            y_off = self._y_min - y_min
+            for row_idx, row in enumerate(self._grid):
+                grid[row_idx + y_off][x_off : x_off + len(row)] = row
+            self._x_min, self._x_max = x_min, x_max
+            self._y_min, self._y_max = y_min, y_max
+            self._grid = grid
+            self._bounds = None
+        self._grid[y - self._y_min][x - self._x_min] = tile
+
+    def _reindex(self) -> None:
+        """
+        Rebuilds the grid and extents from scratch. Only needed when tiles are removed.
+        """
+        self._x_min = self._x_max = self._y_min = self._y_max = None
+        self._grid = []
+        self._bounds = None
+        for k, v in self.items():
+            self._grid_set(k.x, k.y, v)
+
+    def tile_at(self, x: int, y: int) -> Optional[Tile]:
+        """
+        Returns the tile at x, y in this array's zoom level, or None if there isn't one.
+        """
+        if self._x_min is None:
+            return None
+        if not (self._x_min <= x <= self._x_max and self._y_min <= y <= self._y_max):
+            return None
+        return self._grid[y - self._y_min][x - self._x_min]
 
     @property
     def zoom(self) -> int:
@@ -304,19 +542,19 @@ class TileArray(dict):
 
     @property
     def x_min(self) -> int:
-        return min(t.x for t in self.keys())
+        return self._x_min
 
     @property
     def x_max(self) -> int:
-        return max(t.x for t in self.keys())
+        return self._x_max
 
     @property
     def y_min(self) -> int:
-        return min(t.y for t in self.keys())
+        return self._y_min
 
     @property
     def y_max(self) -> int:
-        return max(t.y for t in self.keys())
+        return self._y_max
 
     @property
     def xy_dims(self) -> Tuple[int, int]:
@@ -325,11 +563,17 @@ class TileArray(dict):
     @property
     def bounds(self) -> geo.LatLonBBox:
         """Returns the maximal bounds that this TileArray covers."""
-        bboxes = [t.bounds for t in self.values()]
-        left = min([x.left for x in bboxes])
-        right = max([x.right for x in bboxes])
-        top = max([x.top for x in bboxes])
-        bottom = min([x.bottom for x in bboxes])
+        if self._bounds is None:
+            # The corner tiles of the extents give the same answer as checking every tile.
+            top_left = mercantile.bounds(self.x_min, self.y_min, self.zoom)
+            bottom_right = mercantile.bounds(self.x_max, self.y_max, self.zoom)
+            self._bounds = (
+                top_left.west,
+                top_left.north,
+                bottom_right.east,
+                bottom_right.south,
+            )
+        left, top, right, bottom = self._bounds
         return geo.LatLonBBox(left=left, right=right, top=top, bottom=bottom)
 
     @property
@@ -340,6 +584,15 @@ class TileArray(dict):
         """
         return geo.bounding_lat_lon_to_pixels(self.bounds, self.zoom)
 
+    @property
+    def content_bbox(self) -> Optional[imager.PixBbox]:
+        """
+        Bounding box of the non-transparent pixels in this TileArray's mosaic (see _composite_all()).
+        Merged from the tiles' own content bounding boxes, so the mosaic is never scanned.
+        """
+        bbox, _ = mosaic_content_bboxes([self], wrapped=False)
+        return bbox
+
     def ids_to_mercantiles(self) -> List[mercantile.Tile]:
         return [t.asmercantile for t in self.keys()]
 
@@ -382,36 +635,15 @@ class TileArray(dict):
         # print(filtered_siblings)
         return filtered_siblings
 
-    # def make_parent(tiles, scale=False, quality=1):
-    #     """
-    #     Combines 4 tiles into a parent tile only if they are siblings.
-    #     Args:
-    #         tiles (list(Tile)): List of 4 tiles to combine into a parent tile.
-    #         scale (bool, optional): If True, scale the resulting tile down to preserve the tile resolution.
-    #         quality (int, optional): Quality level, from 0 to 4. Higher quality is slower. Defaults to 1.
-    #     Returns:
-    #         Tile: A parent tile. None if they don't share a parent.
-    #     """
-
-    #     if len({tile.parent for tile in tiles}) != 1:
-    #         return None
-    #     # new_image = composite_quad(tiles)
-    #     # res = tiles[0].resolution + 1
-    #     # if scale:
-    #     #     res -= 1
-    #     #     size = res * 256
-    #     #     new_image = new_image.resize((size, size), resample=resample["quality"])
-    #     parent_id = tiles[0].parent
-    #     return Tile(parent_id, new_image, name=tiles[0].name, resolution=res)
-
     def _composite_all(self) -> "Image":
         """
         Takes all of the tiles in the TileArray and composited them into one big image.
         Returns:
             Image: the output image.
         """
-        idx_imgs = {(tid.x, tid.y): img.img for tid, img in self.items()}
-        return imager.composite_mxn(idx_imgs)
+        idx_imgs = {(tid.x, tid.y): tile.img for tid, tile in self.items()}
+        blank = {(tid.x, tid.y) for tid, tile in self.items() if tile.blank}
+        return imager.composite_mxn(idx_imgs, blank=blank)
 
     def _composite_layer(self, foreground_ta: "TileArray") -> "TileArray":
         """
@@ -423,25 +655,27 @@ class TileArray(dict):
         Returns:
             TileArray: new composited tiles.
         """
-        x_range = range(self.x_min, self.x_max + 1)
-        y_range = range(self.y_min, self.y_max + 1)
         z = self.zoom_level
         fg_z = foreground_ta.zoom_level
         if z != fg_z:
             raise self.MixedZoomError(
                 f"Can't composite with different zoom levels (bg={z}, fg={fg_z})"
             )
-        tids_check = [TileID(z, x, y) for x in x_range for y in y_range]
-        fg_tids = [x for x in foreground_ta.keys() if x in tids_check]
         result = TileArray()
         for tid, tile in self.items():
-            if tid in fg_tids:
-                result[tid] = tile.composite_image(foreground_ta[tid])
-                fg_tids.remove(tid)
+            fg_tile = foreground_ta.tile_at(tid.x, tid.y)
+            # Blending an empty tile wouldn't change anything.
+            if fg_tile is not None and not fg_tile.empty:
+                result[tid] = tile.composite_image(fg_tile)
             else:
                 result[tid] = tile
-        for tid in fg_tids:
-            result[tid] = foreground_ta[tid]
+        # Foreground tiles that fill holes inside this array's extents are kept as-is.
+        for tid, fg_tile in foreground_ta.items():
+            inside = (
+                self.x_min <= tid.x <= self.x_max and self.y_min <= tid.y <= self.y_max
+            )
+            if inside and self.tile_at(tid.x, tid.y) is None:
+                result[tid] = fg_tile
         return result
 
     def composite_layers_out(self, foreground_ta: "TileArray") -> "Image":
@@ -502,10 +736,136 @@ def tileid_from_bbox(self, bbox: geo.LatLonBBox, tile_scale: int = 1) -> List[Ti
     return [TileID(z=m.z, x=m.x, y=m.y) for m in tile_ids]
 
 
+def make_parent(
+    tiles: Iterable[Tile], resolution: Optional[int] = None, quality: int = 1
+) -> Optional[Tile]:
+    """
+    Combines 4 sibling tiles into their parent tile, scaling them down to keep the tile resolution.
+    Args:
+        tiles (Iterable[Tile]): The 4 child tiles of the parent.
+        resolution (int, optional): Size of the parent tile. Defaults to the children's size.
+            With children half this size (decoded that way with imager.image_from_bytes()), they're pasted together without any scaling.
+        quality (int, optional): Quality level, from 0 to 4, see imager.scale_image(). Higher quality is slower. Defaults to 1.
+    Returns:
+        Optional[Tile]: A parent tile. None if they aren't all the children of one parent.
+    """
+    tiles = list(tiles)
+    tile_ids = {t.tid for t in tiles}
+    if len(tile_ids) != 4 or len({tid.parent for tid in tile_ids}) != 1:
+        return None
+    # Children of one parent are the only tiles with these offsets, wrapped or not.
+    images = {(t.x & 1, t.y & 1): t.img for t in tiles}
+    img = imager.composite_mxn(images)
+    resolution = resolution or tiles[0].size[0]
+    img = imager.resize_square(img, resolution, quality)
+    return Tile(tiles[0].tid.parent, img=img, name=tiles[0].name)
+
+
+def make_child(
+    parent: Tile, tid: TileID, resolution: Optional[int] = None, quality: int = 4
+) -> Optional[Tile]:
+    """
+    Builds a tile by cropping its part out of an ancestor tile, and scaling it up.
+    Anything more than a couple of zoom levels up is very blurry, so this is a fallback for when the tile itself can't be had.
+    Args:
+        parent (Tile): Tile from any zoom level above tid, that contains it.
+        tid (TileID): Tile to build.
+        resolution (int, optional): Size of the new tile. Defaults to the parent's size.
+        quality (int, optional): Quality level, from 0 to 4, see imager.scale_image(). Defaults to 4.
+    Returns:
+        Optional[Tile]: The new tile. None if parent doesn't contain tid, or has less than a pixel of it.
+    """
+    depth = tid.z - parent.z
+    if depth <= 0 or (tid.x >> depth, tid.y >> depth) != (parent.x, parent.y):
+        return None
+    size = parent.size[0]
+    span = size / (1 << depth)
+    if span < 1:
+        return None
+    left = (tid.x - (parent.x << depth)) * span
+    top = (tid.y - (parent.y << depth)) * span
+    box = (left, top, left + span, top + span)
+    resolution = resolution or size
+    img = imager.resize_square(parent.img, resolution, quality, box)
+    return Tile(tid, img=img, name=parent.name)
+
+
+def split_mosaic(
+    image: "Image", tile_ids: Iterable[TileID], name: str = "TileArray"
+) -> TileArray:
+    """
+    Splits one image covering a block of tiles, laid out like TileArray._composite_all(), back into tiles.
+    Args:
+        image (Image): The image. Its width and height have to be a whole number of tiles.
+        tile_ids (Iterable[TileID]): Tiles the image covers, all at one zoom level. Tiles inside their extents that aren't listed are left out.
+        name (str, optional): Name of the tiles and the resulting TileArray. Defaults to "TileArray".
+    Returns:
+        TileArray: The tiles.
+    """
+    tile_ids = list(tile_ids)
+    x_min = min(tid.x for tid in tile_ids)
+    y_min = min(tid.y for tid in tile_ids)
+    x_dim = max(tid.x for tid in tile_ids) - x_min + 1
+    size = image.size[0] // x_dim
+    tile_array = TileArray(name=name)
+    for tid in tile_ids:
+        left = (tid.x - x_min) * size
+        top = (tid.y - y_min) * size
+        img = image.crop((left, top, left + size, top + size))
+        tile_array[tid] = Tile(tid, img=img, name=name)
+    return tile_array
+
+
+def mosaic_content_bboxes(
+    tile_arrays: List[TileArray], wrapped: bool = True
+) -> Tuple[Optional[imager.PixBbox], Optional[imager.PixBbox]]:
+    """
+    Finds the bounding box of the non-transparent pixels in the mosaic of some TileArrays, pasted left to right as imager.paste_halves() does.
+    With wrapped, also finds it for the mosaic with its left and right halves swapped (see imager.swap_left_right()), which is tighter for ranges crossing the antimeridian.
+    Both are merged from the tiles' own content bounding boxes. Only a tile straddling the middle of the mosaic has its pixels scanned, to split it in two.
+    Args:
+        tile_arrays (List[TileArray]): TileArrays making up the mosaic.
+        wrapped (bool, optional): Whether to find the swapped bounding box too. Defaults to True.
+    Returns:
+        Tuple[Optional[PixBbox], Optional[PixBbox]]: bbox, swapped_bbox. Either is None if there's no content, swapped_bbox is also None without wrapped.
+    """
+    placed = []
+    width = 0
+    for tile_array in tile_arrays:
+        size = 0
+        for tid, tile in tile_array.items():
+            size = tile.size[0]
+            x = width + (tid.x - tile_array.x_min) * size
+            y = (tid.y - tile_array.y_min) * size
+            placed.append((x, y, tile))
+        width += tile_array.xy_dims[0] * size if size else 0
+    bbox = imager.merge_bboxes(
+        imager.shift_bbox(tile.content_bbox, x, y) for x, y, tile in placed
+    )
+    if not wrapped:
+        return bbox, None
+
+    half = width // 2
+    pieces = []
+    for x, y, tile in placed:
+        size_x, size_y = tile.size
+        if x + size_x <= half:
+            pieces.append(imager.shift_bbox(tile.content_bbox, x + half, y))
+        elif x >= half:
+            pieces.append(imager.shift_bbox(tile.content_bbox, x - half, y))
+        elif tile.content_bbox is not None:
+            split = half - x
+            left = imager.content_bbox(tile.img, (0, 0, split, size_y))
+            right = imager.content_bbox(tile.img, (split, 0, size_x, size_y))
+            pieces.append(imager.shift_bbox(left, x + half, y))
+            pieces.append(imager.shift_bbox(right, x - half, y))
+    return bbox, imager.merge_bboxes(pieces)
+
+
 def empty_tilearray_from_ids(tile_ids: List[Union[TileID, Tuple[int]]]) -> TileArray:
     tile_array = TileArray()
     for tid in tile_ids:
-        tile_id = TileID(tid)
+        tile_id = tid if isinstance(tid, TileID) else TileID(tid)
         tile = Tile(tid=tile_id)
         tile_array[tile_id] = tile
     return tile_array
@@ -513,27 +873,46 @@ def empty_tilearray_from_ids(tile_ids: List[Union[TileID, Tuple[int]]]) -> TileA
 
 def bounding_box_to_tiles(
     bbox: geo.LatLonBBox, start_zoom: int = 0, size: int = 512, alt_bbox: bool = False
-) -> Tuple["TileArray"]:
+) -> TileArray:
     """
     Takes a bounding box and finds the TileArray that best covers that bounding box.
-    This may result in tiles that are across the anti-meridian from the rest.
     The end result is a TileArray of either 4, 6 or 9 tiles that fully contain the bounding box.
-    In the event that the bounding box crosses the antimeridian, will return two TileArrays, one for each side.
-        While a TileArray can store non-contiguous tiles, this is easier for now.
+    In the event that the bounding box crosses the antimeridian, the tiles east of it carry on with x past 2 ** zoom, so the array is still contiguous.
+    Plans are memoized on the bounding box and arguments, so the same range is only planned once. Every call gets a new TileArray.
     Args:
         bbox (LatLonBBox): Bounding box to find the tile covering for.
         start_zoom (int, optional): starting zoom level. Probably best to leave this as the default. Defaults to 0.
         size (int, optional): Size of the map, in pixels. Should be a multiple of 256. Defaults to 512.
     Returns:
-        Tuple["TileArray"]: A TileArray covering the bounding box that isn't larger than size.
-            If the antimeridian is crossed, this will return two TileArrays, one for each side, except in the case of zoom = 1, in which case all tiles are returned.
+        TileArray: A TileArray covering the bounding box that isn't larger than size.
+            If the antimeridian is crossed at zoom = 1, all tiles are returned, without wrapping.
             If there's a bad bounding box, returns an empty TileArray. Eventually, this should try an alternative approach to finding the proper covering.
     """
-    n = bbox.north
+    bounds = (bbox.left, bbox.top, bbox.right, bbox.bottom)
+    plan, zoom_level = _plan_bounding_box(bounds, start_zoom, size, alt_bbox)
+    if plan is None:
+        return TileArray(zoom_level=zoom_level)
+    return empty_tilearray_from_ids(plan)
+
+
+@lru_cache(maxsize=1024)
+def _plan_bounding_box(
+    bounds: Tuple[float, float, float, float],
+    start_zoom: int,
+    size: int,
+    alt_bbox: bool,
+) -> Tuple[Optional[Tuple[TileID, ...]], int]:
+    """
+    Does the work for bounding_box_to_tiles(). Not really intended to be used directly.
+    Args:
+        bounds (Tuple[float, float, float, float]): (left, top, right, bottom) of the bounding box.
+    Returns:
+        Tuple[Optional[Tuple[TileID, ...]], int]: The tile ids, or None for a bad bounding box, and the zoom level.
+    """
+    left, top, right, bottom = bounds
+    bbox = geo.LatLonBBox(left=left, top=top, right=right, bottom=bottom)
     w = bbox.west
-    s = bbox.south
     e = bbox.east
-    zoom_level = start_zoom
     bad_bbox = False
     # Is this likely to be an incorrect bounding box that forgets that the map is actually a cynlinder?
     # This is really just a heuristic test for an incorrect bounding box, because it's hard to deal with bad data.
@@ -547,20 +926,8 @@ def bounding_box_to_tiles(
     if (w > e or abs(w) > 180 or abs(e) > 180) and not bad_bbox:
         print("Bbox crosses anti-meridian.")
         bbox_west, bbox_east = bbox.am_split()
-        tile_west, alt_west, zoom_west = _bounding_box_candidates(
-            bbox_west, zoom_level, size
-        )
-        tile_east, alt_east, zoom_east = _bounding_box_candidates(
-            bbox_east, zoom_level, size
-        )
-        print("West:")
-        pprint(tile_west)
-        print("West alt:")
-        pprint(alt_west)
-        print("East:")
-        pprint(tile_east)
-        print("East alt:")
-        pprint(alt_east)
+        _, zoom_west = _covering_zoom(bbox_west, start_zoom, size)
+        _, zoom_east = _covering_zoom(bbox_east, start_zoom, size)
         # If one bbox is tigher than the other, this is a problem. Only take the furthest out one.
         minimum_zoom = min(zoom_west, zoom_east) - 1
         if zoom_west != zoom_east:
@@ -569,85 +936,97 @@ def bounding_box_to_tiles(
         # This may be the only fix, but it may need some edge case handling.
         # This is to avoid getting both bounding boxes showing tiles for the whole planet. Each tile should only be returned once.
         if minimum_zoom == 1:
-            tids = [TileID(z=1, x=x, y=y) for x in (0, 1) for y in (0, 1)]
-            ta = empty_tilearray_from_ids(tids)
-            return (ta,)
-        # Ignore the alts, because they're spurious for this case as a 2x2 split across the am will always trigger the alt for a 2x 2x2 bbox, which is wrong.
-        # best_west = _best_tile_covering(bbox_west, tile_west, alt_west, minimum_zoom)
-        # best_east = _best_tile_covering(bbox_east, tile_east, alt_east, minimum_zoom)
-        best_west = _best_tile_covering(bbox_west, tile_west, TileArray(), minimum_zoom)
-        best_east = _best_tile_covering(bbox_east, tile_east, TileArray(), minimum_zoom)
-        return best_west, best_east
+            tids = tuple(TileID.fast(1, x, y) for x in (0, 1) for y in (0, 1))
+            return tids, minimum_zoom
+        # Ignore the alternative line coverings, because they're spurious for this case as a 2x2 split across the am will always trigger the alt for a 2x 2x2 bbox, which is wrong.
+        best_west = _covering_tile_ids(bbox_west, minimum_zoom)
+        # The east side continues on from the west side, one world over.
+        best_east = _covering_tile_ids(bbox_east, minimum_zoom, 1 << minimum_zoom)
+        print("West:", best_west)
+        print("East:", best_east)
+        return best_west + best_east, minimum_zoom
     else:
-        tile_ids, tile_ids_alt, end_zoom_level = _bounding_box_candidates(
-            bbox, zoom_level, size
-        )
-        best = _best_tile_covering(bbox, tile_ids, tile_ids_alt, end_zoom_level)
-        if not bad_bbox:
-            return (best,)
-        else:
-            return TileArray(zoom_level=end_zoom_level)
+        best_zoom, end_zoom_level = _covering_zoom(bbox, start_zoom, size)
+        if bad_bbox:
+            return None, end_zoom_level
+        best = _covering_tile_ids(bbox, best_zoom)
+        # Do we have a line of tiles that would better cover this bbox?
+        if best_zoom != end_zoom_level and len(best) in (2, 3):
+            alt = empty_tilearray_from_ids(best).find_line_sibling_tile_ids()
+            if alt is not None:
+                best = tuple(alt.keys())
+        return best, best_zoom
 
 
-def _best_tile_covering(
-    in_bbox: geo.LatLonBBox,
-    tile_ids: TileArray,
-    alt_tile_ids: TileArray,
-    zoom_level: int,
-) -> TileArray:
+def _covering_zoom(bbox: geo.LatLonBBox, zoom_level: int, size: int) -> Tuple[int, int]:
     """
-    Find the best tile covering of a normal and an alternate TileArray.
-    Not really intended to be used directly.
-    Alt can be empty for the best zoom level.
-    Args:
-        in_bbox (geo.LatLonBBox): input bounding box.
-        tile_ids (TileArray): normal tiles to check.
-        alt_tile_ids (TileArray): alternative tiles to check.
-        zoom_level (int): zoom level to use.
+    Finds the zoom level that best covers a bounding box. Not really intended to be used directly.
+    The bounding box's pixel extent doubles with every zoom level, so the first zoom where it's larger than size is found in closed form from its extent at the maximum zoom.
+    A zoom is also too far in if its tiles don't contain the bounding box, which only needs the corner tiles of each zoom below that.
     Returns:
-        TileArray: zoom level and choice from the two input arrays.
+        Tuple[int, int]: best zoom, zoom reached. The best zoom is one less than the zoom reached, unless the tiles stopped containing the bounding box.
     """
-    max_idx = max(max(tile_ids.keys()), max([-1] + list(alt_tile_ids.keys())))
-    max_idx = min(max_idx, zoom_level)
-    best = alt_tile_ids.get(max_idx, tile_ids[max_idx])
-    return best
+    max_zoom = constants.max_zoom
+    extent = max(geo.bounding_lat_lon_to_pixels(bbox, max_zoom).xy_dims)
+    if extent == 0:
+        limit = max_zoom
+    else:
+        limit = math.floor(max_zoom - math.log2(extent / size)) + 1
+        limit = min(max(limit, zoom_level), max_zoom)
+        # Pixels are rounded, so check the estimate against the exact test the map will see.
+        while limit > zoom_level and not _fits(bbox, limit - 1, size):
+            limit -= 1
+        while limit < max_zoom and _fits(bbox, limit, size):
+            limit += 1
+    # Same test as LatLonBBox.contains(), without making a LatLonBBox for every zoom.
+    left, top, right, bottom = (
+        round(v, 5) for v in (bbox.left, bbox.top, bbox.right, bbox.bottom)
+    )
+    for zoom in range(zoom_level, limit):
+        x_min, y_min, x_max, y_max = _tile_range(bbox, zoom)
+        top_left = mercantile.bounds(x_min, y_min, zoom)
+        bottom_right = mercantile.bounds(x_max, y_max, zoom)
+        if not (
+            round(top_left.west, 5) <= left
+            and round(bottom_right.east, 5) >= right
+            and round(top_left.north, 5) >= top
+            and round(bottom_right.south, 5) <= bottom
+        ):
+            return zoom, zoom
+    if limit == zoom_level:
+        raise ValueError(
+            f"Bounding box is larger than {size} pixels at zoom {zoom_level}."
+        )
+    return limit - 1, limit
+
 
+def _fits(bbox: geo.LatLonBBox, zoom: int, size: int) -> bool:
+    x_dim, y_dim = geo.bounding_lat_lon_to_pixels(bbox, zoom).xy_dims
+    return x_dim <= size and y_dim <= size
 
-def _bounding_box_candidates(
-    bbox: geo.LatLonBBox, zoom_level: int, size: int
-) -> Tuple[Dict[int, "TileArray"], int]:
+
+def _tile_range(bbox: geo.LatLonBBox, zoom: int) -> Tuple[int, int, int, int]:
     """
-    Find bounding box candidates. Not really intended to be used directly.
-    Given a bounding box, zoom level and size, finds the maximumx zoom and the tiles on the way there.
-        The algorithm to figure out it out is pretty simple, check and see if the bounding box as pixels is larger than the image's size. If it is, the last zoom level was the best.
+    Finds the corner tiles that mercantile.tiles() would cover a bounding box with, without making every tile in between.
+    The bounding box must not cross the antimeridian.
     Returns:
-        Tuple[Dict[int, "TileArray"], int]: Normal tiles, alternative tiles, zoom reached.
+        Tuple[int, int, int, int]: (x_min, y_min, x_max, y_max)
     """
-    n = bbox.north
-    w = bbox.west
-    s = bbox.south
-    e = bbox.east
-    tile_ids = {}
-    tile_ids_alt = {}
-    while zoom_level < constants.max_zoom:
-        # If the bounding box at this zoom is larger than our maximum size, we've gone too far.
-        bbox_pix = geo.bounding_lat_lon_to_pixels(bbox, zoom_level)
-        x_dim, y_dim = bbox_pix.xy_dims
-        print("xy dims:", bbox_pix.xy_dims, zoom_level)
-        if x_dim > size or y_dim > size:
-            print("xy break dims:", size, bbox_pix.xy_dims, zoom_level)
-            break
-        # First, get the bounding box for this zoom level.
-        mt_tids = list(
-            mercantile.tiles(east=e, north=n, west=w, south=s, zooms=zoom_level)
-        )
-        ta = empty_tilearray_from_ids(mt_tids)
-        tile_ids[zoom_level] = ta
-        # Do our current set of tiles still cover the whole bounding box?
-        if not ta.bounds.contains(bbox):
-            break
-        # Do we have a line of tiles that would better cover this bbox?
-        if len(ta) in (2, 3):
-            tile_ids_alt[zoom_level] = ta.find_line_sibling_tile_ids()
-        zoom_level += 1
-    return tile_ids, tile_ids_alt, zoom_level
+    w = max(-180.0, bbox.west)
+    s = max(-85.051129, bbox.south)
+    e = min(180.0, bbox.east)
+    n = min(85.051129, bbox.north)
+    ul = mercantile.tile(w, n, zoom)
+    lr = mercantile.tile(e - mercantile.LL_EPSILON, s + mercantile.LL_EPSILON, zoom)
+    return ul.x, ul.y, lr.x, lr.y
+
+
+def _covering_tile_ids(
+    bbox: geo.LatLonBBox, zoom: int, x_offset: int = 0
+) -> Tuple[TileID, ...]:
+    x_min, y_min, x_max, y_max = _tile_range(bbox, zoom)
+    return tuple(
+        TileID.fast(zoom, x + x_offset, y)
+        for x in range(x_min, x_max + 1)
+        for y in range(y_min, y_max + 1)
+    )